@@ -12,7 +12,10 @@ from pprint import pprint as pp
 import os as _os
 import string as _str
 import re as _re
-from collections import namedtuple as _namedtuple
+from collections import (
+	namedtuple as _namedtuple,
+	OrderedDict as _OrderedDict,
+)
 
 from drl_py23 import (
 	str_t as _str_t,
@@ -21,6 +24,7 @@ from drl_py23 import (
 	izip as _izip,
 	xrange as _xrange,
 	raw_input as _input,
+	py2 as _py2,
 )
 
 
@@ -124,7 +128,7 @@ reg_vector4 = {
 	PsRegister.b: False,
 	PsRegister.s: True,
 	PsRegister.aL: False,
-	PsRegister.p: False,
+	PsRegister.p: True,
 
 	PsRegister.vFace: False,
 	PsRegister.vPos: True,
@@ -186,6 +190,19 @@ ShaderLineRanges = _namedtuple(
 	'ShaderLineRanges',
 	['pre_comment', 'code', 'post_comment']
 )  # type: (Optional[Range], CodeBlock, Optional[Range])
+ShaderBlock = _namedtuple(
+	'ShaderBlock',
+	['type', 'sm', 'pre_comments', 'code_lines', 'post_comments']
+)  # type: (ShaderType, int, List[str], List[LineData], List[str])
+
+AsmOp = _namedtuple(
+	'AsmOp',
+	['base', 'suffix', 'sat', 'shift']
+)  # type: (str, str, bool, Optional[str])
+Operand = _namedtuple(
+	'Operand',
+	['neg', 'reg', 'index', 'rel', 'swizzle', 'mod']
+)  # type: (str, str, Optional[int], Optional[str], Optional[str], Optional[str])
 
 
 class RegisterVar(object):
@@ -443,6 +460,10 @@ frag_extensions = {
 in_extensions = {'.fx', '.cg', '.cgfx', '.asm'}.union(vert_extensions).union(frag_extensions)
 out_ext = '.hlsl'
 
+# Increase it whenever the generated code changes, to invalidate the incremental cache:
+converter_version = 2
+manifest_file_name = '.asm2hlsl_manifest.json'
+
 # endregion
 
 
@@ -497,350 +518,530 @@ def _classify_line(
 	return LineData(op, args, comment)
 
 
-_sm_map = {
-	'vs': ShaderType.vert,
-	'ps': ShaderType.frag
-}
-_block_prefixes = ('ps', 'vs')
-_digit_str_set = set('0123456789')
+# A single pattern splitting the whole line to op / args / comment at once.
+# It matches any line, and in multiline mode it can parse the entire file text.
+# Up to 5 args (the most an ASM instruction can have) are captured as separate groups.
+# Anything else is captured as a "leftover" and is split to args separately.
+_re_lex_arg_str = '([^\s,/](?:[^,/\n]*[^\s,/])?)'
+_re_lex_arg_sep = '[^\S\n]*,[^\S\n]*'
+_re_lex_line = _re.compile(
+	'^[^\S\n]*(?:'
+	# op: anything up to the first whitespace or '//':
+	'((?:[^\s/]|/(?!/))[^\s/]*(?:/(?!/)[^\s/]*)*)'
+	# args:
+	'(?:[^\S\n]+' + _re_lex_arg_str + (
+		'(?:' + _re_lex_arg_sep + _re_lex_arg_str
+	) * 4 + ')?' * 4 + ')?'
+	# leftover: anything up to the first '//', which isn't matched as args:
+	'[^\S\n]*((?:[^\s/]|/(?!/))(?:[^/\n]|/(?!/))*)?'
+	')?'
+	# comment, with no trailing whitespaces:
+	'(//(?:[^\n]*\S)?)?[^\S\n]*$',
+	flags=_re.MULTILINE | _re.UNICODE
+)
+# Each arg is a comma-separated non-empty string with no surrounding whitespaces:
+_re_lex_arg = _re.compile('[^\s,](?:[^,\n]*[^\s,])?', flags=_re.UNICODE)
+_lex_ops = dict()  # type: Dict[_str_h, _str_h]
 
 
-def _detect_shader_ranges(
-	lines,  # type: List[LineData]
-	ext  # type: str
+def _lex_match_args(
+	m,  # type: Match
+	groups,  # type: Tuple[Optional[_str_h], ...]
+	string,  # type: _str_h
+	_find_args=_re_lex_arg.findall,
 ):
 	"""
-	Split one linear list of `LineData` items to independent 'shader blocks' -
-	in case a single file has multiple blocks of ASM code inside it.
-
-	Each shader block contains the following metadata (no actual lines):
-		* pre-comment range (start/end), None if not present
-		* the main code range as `CodeBlock`, also specifying the shader type and SM
-		* post-comment range (start/end), None if not present
+	Extract args tuple from the match of `_re_lex_line`.
 	"""
-	if not lines:
+	if groups[6]:
+		# unusual formatting, the leftover needs to be split to args the slow way:
+		return tuple(_find_args(string[m.end(1):m.end(7)])) or None
+	if groups[1] is None:
 		return None
+	if groups[5] is None:
+		return groups[1:groups.index(None, 2)]
+	return groups[1:6]
 
-	max_line_i = len(lines) - 1
 
-	def is_block_start(
-		line  # type: LineData
-	):
-		"""
-		Roughly detect if the given line represents shader type and model declaration.
-		Do so by simply matching the line prefix, so the test may be false-positive.
-		"""
-		if line.args or not line.op:
-			return False
-		op = line.op.lower()  # type: str
-		return any(op.startswith(pref) for pref in _block_prefixes)
+def _lex_match_to_line_data(
+	m,  # type: Match
+	string,  # type: _str_h
+	_intern_op=_lex_ops.setdefault,
+):
+	"""
+	Turn the match of `_re_lex_line` to `LineData`.
+	"""
+	groups = m.groups()
+	op = groups[0]
+	if not op:
+		comment = groups[7]
+		return LineData(None, None, comment) if comment else None
+	return LineData(_intern_op(op, op), _lex_match_args(m, groups, string), groups[7])
 
-	def detect_shader_type(
-		op  # type: str
-	):
-		"""
-		The actual parse of the SM-line. It should be called only for those lines which pass a test by is_block_start().
-		Now we do it precisely, so no false detections should occur.
-		"""
-		def res_typed(
-			shader_type,  # type: Optional[ShaderType]
-			shader_model  # type: int
-		):
-			"""
-			Just a wrapper function to generate type hints in the returned value.
-			"""
-			return shader_type, shader_model
 
-		sm = op.lower()
+def _lex_line(
+	line,  # type: _str_h
+	_match=_re_lex_line.match,
+):
+	"""
+	The lexer version of `_classify_line()`, producing the same `LineData`.
 
-		# special case: when the whole string is simply 'vs' or 'ps':
-		try:
-			sm_op = _sm_map[sm]  # type: ShaderType
-			return res_typed(sm_op, 0)
-		except KeyError:
-			pass  # just continue, it's a more general case
+	Instead of a chain of splits, the line is parsed with a single precompiled
+	pattern, and op strings are interned (each unique op is stored only once,
+	no matter how many lines use it).
 
-		sm = [s for s in sm.split('_') if s]
-		if not sm:
-			return res_typed(None, 0)
+	The only difference from `_classify_line()` is that whitespaces inside an arg
+	(not around it) are kept as-is instead of being collapsed to a single space.
+	"""
+	return _lex_match_to_line_data(_match(line), line)
 
-		sm_mode = sm.pop(0)  # should be 'vs' or 'ps'
-		try:
-			sm_mode = _sm_map[sm_mode]  # type: ShaderType
-		except KeyError:
-			return res_typed(None, 0)
 
-		if not sm:
-			return res_typed(sm_mode, 0)
+def _lex_text(
+	text,  # type: _str_h
+	_finditer=_re_lex_line.finditer,
+):
+	"""
+	Generator turning the entire file contents to `LineData` items.
+	It's the fastest way to classify lines: the whole text is split
+	by a single regex scan.
 
-		sm = tuple(
-			(
-				int(v)
-				if len(v) == 1 and v in _digit_str_set
-				else -1
-			) for v in sm
-		)
-		if any(v == -1 for v in sm) or sm[0] < 1:
-			return res_typed(None, 0)
-		if len(sm) > 2:
-			return res_typed(None, 0)
-
-		if len(sm) == 1:
-			sm = (sm[0], 0)
-
-		assert (
-			sm_mode and
-			sm and
-			all(v >= 0 for v in sm) and
-			sm[0] > 0 and
-			len(sm) == 2
-		)
+	Empty lines are skipped.
+	"""
+	to_line_data = _lex_match_to_line_data
+	for m in _finditer(text):
+		line = to_line_data(m, text)
+		if line is not None:
+			yield line
 
-		sm = sm[0] * 10 + sm[1]
-		return res_typed(sm_mode, sm)
 
-	def continuous_code_blocks_sequence():
+class CompactLines(object):
+	"""
+	A memory-efficient alternative to the list of `LineData`, with struct-of-arrays layout:
+		* all the op and arg strings are stored only once, in a single table;
+		* ops are stored as string ids, in an `array`;
+		*
+			args of all the lines are stored as a single flat `array` of string ids,
+			with another `array` of per-line offsets in it;
+		*
+			comments aren't stored as separate strings at all: it's only their
+			start/end offsets in the source text (which is kept as a whole).
+
+	It behaves as a read-only sequence of `LineData`: each item is built on request.
+	A slice doesn't copy anything: it's another `CompactLines` sharing the same arrays.
+	So any code working with a list of `LineData` can use it as well.
+	"""
+	def __init__(
+		self,
+		text='',  # type: _str_h
+		_storage=None,  # type: Optional[_CompactStorage]
+		_first=0,  # type: int
+		_stop=None  # type: Optional[int]
+	):
+		super(CompactLines, self).__init__()
+		if _storage is None:
+			_storage = _CompactStorage(text)
+		self.__storage = _storage
+		num_lines = len(_storage.ops)
+		self.__first = min(max(_first, 0), num_lines)
+		self.__stop = num_lines if _stop is None else min(max(_stop, self.__first), num_lines)
+
+	def __len__(self):
+		return self.__stop - self.__first
+
+	def __line(
+		self,
+		i  # type: int
+	):
 		"""
-		Split the entire list of lines to the list of code ranges.
-		These ranges may have incorrect comment-to-block association.
-		But the result is guaranteed to be:
-			* continuous. I.e., each next block starts at the next line after previous was ended.
-			* the 1st block starting at line 0
-			* the last block ending at the last line
-			*
-				all the blocks but the first one start with a shader-type specifier.
-				I.e., 'ps_3_0'.
-				These lines are actually what splits the original lines list.
-			*
-				If the shader type wasn't found in the whole list of lines,
-				the func tries to detect it from the file extension.
-			* If all attempts have failed, `None` is returned.
+		Build `LineData` for the line at the given absolute index.
 		"""
-		def res_typed(
-			res  # type: Optional[List[CodeBlock]]
-		):
-			return res
+		storage = self.__storage
+		strings = storage.strings
+		op_id = storage.ops[i]
+		args = tuple(
+			strings[arg_id] for arg_id in
+			storage.arg_ids[storage.args_from[i]:storage.args_from[i + 1]]
+		)
+		comment_from = storage.comment_from[i]
+		return LineData(
+			strings[op_id] if op_id > -1 else None,
+			args if args else None,
+			storage.text[comment_from:storage.comment_to[i]] if comment_from > -1 else None
+		)
 
-		res_blocks = (
-			(l.op, i) for i, l in enumerate(lines)
-			if is_block_start(l)
+	def __getitem__(
+		self,
+		item  # type: Union[int, slice]
+	):
+		if isinstance(item, slice):
+			start, stop, step = item.indices(len(self))
+			if step != 1:
+				return [self.__line(self.__first + i) for i in _xrange(start, stop, step)]
+			return CompactLines(
+				_storage=self.__storage,
+				_first=self.__first + start,
+				_stop=self.__first + max(stop, start)
+			)
+		if item < 0:
+			item += len(self)
+		if not (0 <= item < len(self)):
+			raise IndexError('CompactLines index out of range: {0}'.format(item))
+		return self.__line(self.__first + item)
+
+	def __iter__(self):
+		line = self.__line
+		for i in _xrange(self.__first, self.__stop):
+			yield line(i)
+
+	def __repr__(self):
+		return '<CompactLines: {0} lines, {1} unique strings>'.format(
+			len(self), len(self.__storage.strings)
 		)
-		res_blocks = [
-			CodeBlock(sm_i[0], sm_i[1], l_i, -1) for sm_i, l_i in (
-				(detect_shader_type(op), i) for op, i in res_blocks
-			) if sm_i[0]
-		]
-		if not res_blocks:
-			# we haven't found vertex/pixel specification in the shader code itself.
-			# let's try to detect it by a file extension:
-			if ext and ext in vert_extensions:
-				res_blocks = [CodeBlock(ShaderType.vert, 0, -1, -1)]
-			elif ext and ext in frag_extensions:
-				res_blocks = [CodeBlock(ShaderType.frag, 0, -1, -1)]
-			else:
-				# we couldn't even detect whether the shader is vertex or pixel
-				return res_typed(None)
-
-		# for the first and last block, snap ranges to the first/last line:
-		block = res_blocks[0]
-		res_blocks[0] = CodeBlock(block.type, block.sm, 0, block.last_line)
-		block = res_blocks[-1]
-		res_blocks[-1] = CodeBlock(block.type, block.sm, block.first_line, max_line_i)
-
-		# generate range ends for intermediate ranges:
-		next_range_start = res_blocks[-1].first_line
-		for i in reversed(_xrange(len(res_blocks) - 1)):  # from pre-last to first range
-			cur = res_blocks[i]  # type: CodeBlock
-			cur = CodeBlock(cur.type, cur.sm, cur.first_line, next_range_start - 1)
-			next_range_start = cur.first_line
-			res_blocks[i] = cur
-		return res_typed(res_blocks)
-
-	def detect_comment_ranges():
-		"""
-		List of comment blocks specified as tuples of first and last line index for each block.
-		"""
-		in_comment = False
-		comment_start = -1
-		res_ranges = []  # type: List[Range]
-		append = res_ranges.append
-		for i, l in enumerate(lines):
-			cur_is_comment = bool(l.comment) and not(l.op or l.args)
-			if cur_is_comment == in_comment:
-				# one more line either continuing comment or staying outside of it
-				continue
-			if cur_is_comment:
-				# we've just entered a new comment block
-				in_comment = True
-				comment_start = i
+
+
+class _CompactStorage(object):
+	"""
+	The actual arrays shared by `CompactLines` and it's slices.
+	"""
+	__slots__ = ('text', 'strings', 'ops', 'args_from', 'arg_ids', 'comment_from', 'comment_to')
+
+	def __init__(
+		self,
+		text  # type: _str_h
+	):
+		super(_CompactStorage, self).__init__()
+		from array import array
+
+		strings = list()  # type: List[_str_h]
+		string_ids = dict()  # type: Dict[_str_h, int]
+		ops = array('i')
+		args_from = array('l', [0])
+		arg_ids = array('i')
+		comment_from = array('l')
+		comment_to = array('l')
+
+		def string_id(
+			string  # type: _str_h
+		):
+			str_i = string_ids.get(string)
+			if str_i is None:
+				str_i = len(strings)
+				string_ids[string] = str_i
+				strings.append(string)
+			return str_i
+
+		for m in _re_lex_line.finditer(text):
+			groups = m.groups()
+			op = groups[0]
+			comment = groups[7]
+			if not(op or comment):
 				continue
-			# we've just finished the comment block and currently are on the next line
-			append(Range(comment_start, i-1))
-			in_comment = False
-		if in_comment and comment_start > -1:
-			append(Range(comment_start, max_line_i))
-		return res_ranges
-
-	def shader_line_ranges(
-		code_blocks_list,  # type: List[CodeBlock]
-		comment_ranges_list  # type: List[Range]
+			if op:
+				ops.append(string_id(op))
+				args = _lex_match_args(m, groups, text)
+				if args:
+					arg_ids.extend([string_id(a) for a in args])
+			else:
+				ops.append(-1)
+			args_from.append(len(arg_ids))
+			if comment:
+				comment_from.append(m.start(8))
+				comment_to.append(m.end(8))
+			else:
+				comment_from.append(-1)
+				comment_to.append(-1)
+
+		self.text = text
+		self.strings = strings
+		self.ops = ops
+		self.args_from = args_from
+		self.arg_ids = arg_ids
+		self.comment_from = comment_from
+		self.comment_to = comment_to
+
+
+_sm_map = {
+	'vs': ShaderType.vert,
+	'ps': ShaderType.frag
+}
+_block_prefixes = ('ps', 'vs')
+_digit_str_set = set('0123456789')
+
+
+def _is_block_start(
+	line  # type: LineData
+):
+	"""
+	Roughly detect if the given line represents shader type and model declaration.
+	Do so by simply matching the line prefix, so the test may be false-positive.
+	"""
+	if line.args or not line.op:
+		return False
+	op = line.op.lower()  # type: str
+	return any(op.startswith(pref) for pref in _block_prefixes)
+
+
+def _detect_shader_type(
+	op  # type: str
+):
+	"""
+	The actual parse of the SM-line. It should be called only for those lines which pass a test by `_is_block_start()`.
+	Now we do it precisely, so no false detections should occur.
+	"""
+	def res_typed(
+		shader_type,  # type: Optional[ShaderType]
+		shader_model  # type: int
 	):
 		"""
-		Combine a list of code-blocks and of comment-ranges to a single continuous list of shader ranges,
-		each containing:
-			* pre-comment
-			* the general code block
-			* post-comment
+		Just a wrapper function to generate type hints in the returned value.
 		"""
-		def res_typed(
-			res  # type: List[ShaderLineRanges]
-		):
-			return res
+		return shader_type, shader_model
+
+	sm = op.lower()
+
+	# special case: when the whole string is simply 'vs' or 'ps':
+	try:
+		sm_op = _sm_map[sm]  # type: ShaderType
+		return res_typed(sm_op, 0)
+	except KeyError:
+		pass  # just continue, it's a more general case
+
+	sm = [s for s in sm.split('_') if s]
+	if not sm:
+		return res_typed(None, 0)
+
+	sm_mode = sm.pop(0)  # should be 'vs' or 'ps'
+	try:
+		sm_mode = _sm_map[sm_mode]  # type: ShaderType
+	except KeyError:
+		return res_typed(None, 0)
+
+	if not sm:
+		return res_typed(sm_mode, 0)
+
+	sm = tuple(
+		(
+			int(v)
+			if len(v) == 1 and v in _digit_str_set
+			else -1
+		) for v in sm
+	)
+	if any(v == -1 for v in sm) or sm[0] < 1:
+		return res_typed(None, 0)
+	if len(sm) > 2:
+		return res_typed(None, 0)
+
+	if len(sm) == 1:
+		sm = (sm[0], 0)
+
+	assert (
+		sm_mode and
+		sm and
+		all(v >= 0 for v in sm) and
+		sm[0] > 0 and
+		len(sm) == 2
+	)
 
-		assert bool(code_blocks_list)
-		res_ranges = res_typed(
-			[ShaderLineRanges(None, c, None) for c in code_blocks_list]
-		)
-		if not comment_ranges_list:
-			# no comment blocs, just return initial shader reanges intact:
-			return res_ranges
-
-		# we have some comment ranges.
-		# we gonna update the res list by iteratively appending preceding comment ranges
-		comment_ranges_left = comment_ranges_list[:]  # this will be modified, with ranges removed one by one
-		first_code = res_ranges[0].code  # type: CodeBlock
-		first_pre_c_ids = [
-			i for i, cmt in enumerate(comment_ranges_left)
-			if cmt.first == 0
-		]
-		if first_pre_c_ids:
-			# found comment ranges starting from the 0 line,
-			# attach them to the first shader-range:
-			first_pre_c_ids = set(first_pre_c_ids)
-			first_cmt_ranges = [
-				cmt for i, cmt in enumerate(comment_ranges_left)
-				if i in first_pre_c_ids
-			]  # type: List[Range]
-			comment_ranges_left = [
-				cmt for i, cmt in enumerate(comment_ranges_left)
-				if i not in first_pre_c_ids
-			]  # type: List[Range]
-			first_cmt_last_line = (
-				max(cmt.last for cmt in first_cmt_ranges)
-				if len(first_cmt_ranges) > 1
-				else first_cmt_ranges[0].last
-			)  # type: int
-			res_ranges[0] = ShaderLineRanges(
-				Range(0, first_cmt_last_line),
-				CodeBlock(first_code.type, first_code.sm, first_cmt_last_line + 1, first_code.last_line),
-				None
-			)
+	sm = sm[0] * 10 + sm[1]
+	return res_typed(sm_mode, sm)
 
-		for i_res in _xrange(1, len(res_ranges)):  # skip the 1st one
-			cur_code = res_ranges[i_res].code  # type: CodeBlock
-			cur_start, cur_end = cur_code.first_line, cur_code.last_line  # type: int
-			preceding_comments = [
-				i for i, cmt in enumerate(comment_ranges_left)
-				if cmt.last == cur_start-1
-			]
-			if not preceding_comments:
-				continue
 
-			if len(preceding_comments) == 1:
-				pre_com_range = comment_ranges_left.pop(preceding_comments[0])
-			else:
-				# multiple preceding comments found, we need to combine their ranges
-				# theoretically, this should never happen. But just in case...
-				preceding_comments = set(preceding_comments)
-				pre_ranges = [  # turn comment-range indices to the actual ranges...
-					cmt for i, cmt in enumerate(comment_ranges_left) if i in preceding_comments
-				]  # type: List[Range]
-				comment_ranges_left = [  # ... and remove those ranges from the list
-					cmt for i, cmt in enumerate(comment_ranges_left) if i not in preceding_comments
-				]  # type: List[Range]
-				range_min = min(pre_r.first for pre_r in pre_ranges)
-				pre_com_range = Range(range_min, pre_ranges[0].last)
-
-			# we've found the range of the preceding comp.
-			# now we need to remove it from the previous code block ...
-			prev_i = i_res - 1
-			prev_res = res_ranges[prev_i]  # type: ShaderLineRanges
-			prev_pre_c, prev_cd, prev_post_c = prev_res  # type: (Optional[Range], CodeBlock, None)
-			prev_cd = CodeBlock(
-				prev_cd.type, prev_cd.sm,
-				prev_cd.first_line,
-				min([prev_cd.last_line, pre_com_range.first - 1])
-			)
-			res_ranges[prev_i] = ShaderLineRanges(prev_pre_c, prev_cd, None)
+def _is_approx_comment(
+	line  # type: LineData
+):
+	"""
+	Whether the line is the compiler's stats comment, which ends the shader block above it.
+	"""
+	return not line.op and line.comment.lower().startswith('// approximately ')
 
-			# ...and attach it to the current one as comment block:
-			res_ranges[i_res] = ShaderLineRanges(pre_com_range, cur_code, None)
 
-		# we've finished attaching comment blocks to their respective shader blocks.
-		assert bool(res_ranges) and all(
-			shd_r.post_comment is None
-			for shd_r in res_ranges
-		)
-		if not any(shd_r.pre_comment for shd_r in res_ranges):
-			# there are no comment blocks that can be identified as in-between shader code ranges,
-			# so all of the comment ranges are None
-			return res_ranges
-
-		# so far, all of the post-comment should be none.
-		# Let's check if we could populate them with some lines
-		# from the next block's preceding comment:
-		for i_res in _xrange(len(res_ranges) - 1):  # skip the last one
-			next_i = i_res + 1
-			next_block = res_ranges[next_i]  # type: ShaderLineRanges
-			next_pre_c, next_cd, next_post_c = next_block  # type: (Optional[Range], CodeBlock, Optional[Range])
-			if not next_pre_c:
-				continue
-			comment_line = lines[next_pre_c.first]
-			if not(
-				comment_line.comment.lower().startswith('// approximately ')
-				and not comment_line.op
-			):
-				continue
-			cur_block = res_ranges[i_res]  # type: ShaderLineRanges
-			cur_pre_c, cur_cd, cur_post_c = cur_block  # type: (Optional[Range], CodeBlock, Optional[Range])
-			cur_post_c = Range(next_pre_c.first, next_pre_c.first)
-			trimmed_next_start = next_pre_c.first + 1
-			if next_pre_c.last <= trimmed_next_start:
-				next_pre_c = None
+def _iter_shader_spans(
+	items,  # type: Iterable[Tuple[LineData, int, int]]
+	ext,  # type: str
+	next_pos_f=lambda last: last + 1  # type: Callable[[int], int]
+):
+	"""
+	The actual implementation of `_iter_shader_ranges()`, which isn't bound to line indices.
+
+	Each item is a line with the first and last "position" it takes.
+	For line indices, both of them are just the line index.
+	But they could be anything else, like byte offsets of a line start/end in the file.
+	Each range in the result then starts at the first position of its first line
+	and ends at the last position of its last line.
+
+	:param next_pos_f:
+		A function returning the first position right after the given last one.
+		It's used only for an empty code block when the whole file is a comment.
+	"""
+	any_items = False
+	start_first = -1  # the first position of the very first line
+	prev_last = -1  # the last position of the previous line
+
+	# the current comment run:
+	in_run = False
+	run_first = -1
+	run_first_line_last = -1  # the last position of the first line in run
+	run_second_first = -1  # the first position of the second line in run
+	run_prev_last = -1  # the last position of the line preceding the run
+	run_len = 0
+	run_is_approx = False  # whether the current comment run starts with '// approximately'
+	run_is_zero = False  # whether the current comment run starts at the very first line
+
+	zero_run = None  # type: Optional[Range]  # the comment run starting at the first line
+	zero_run_next_first = -1  # the first position of the line after it
+	any_pre = False
+
+	# the block which is not finished yet: pre-comment, type, SM and the first code position:
+	pending = None  # type: Optional[Tuple[Optional[Range], ShaderType, int, int]]
+
+	for line, first, last in items:
+		if not any_items:
+			start_first = first
+		if line.comment and not(line.op or line.args):
+			if not in_run:
+				in_run = True
+				run_first = first
+				run_first_line_last = last
+				run_prev_last = prev_last
+				run_len = 1
+				run_is_approx = _is_approx_comment(line)
+				run_is_zero = not any_items
+			else:
+				if run_len == 1:
+					run_second_first = first
+				run_len += 1
+			any_items = True
+			prev_last = last
+			continue
+
+		# a code line:
+		any_items = True
+		if in_run and run_is_zero:
+			zero_run = Range(run_first, prev_last)
+			zero_run_next_first = first
+		closed_run = in_run
+		in_run = False
+		line_prev_last = prev_last
+		prev_last = last
+
+		if not _is_block_start(line):
+			continue
+		shader_type, sm = _detect_shader_type(line.op)
+		if not shader_type:
+			continue
+
+		if pending is None:
+			# the very first block:
+			if zero_run is not None:
+				any_pre = True
+				pending = (zero_run, shader_type, sm, zero_run_next_first)
 			else:
-				next_pre_c = Range(trimmed_next_start, next_pre_c.last)
+				pending = (None, shader_type, sm, start_first)
+			continue
+
+		# the previous block is finished now:
+		cur_pre, cur_type, cur_sm, cur_first = pending
+		cur_last = line_prev_last
+		cur_post = None
+		next_pre = None
+		if closed_run:
+			any_pre = True
+			cur_last = run_prev_last
+			next_pre = Range(run_first, line_prev_last)
+			if run_is_approx:
+				cur_post = Range(run_first, run_first_line_last)
+				next_pre = (
+					None if run_len <= 2
+					else Range(run_second_first, line_prev_last)
+				)
+		yield ShaderLineRanges(cur_pre, CodeBlock(cur_type, cur_sm, cur_first, cur_last), cur_post)
+		pending = (next_pre, shader_type, sm, first)
 
-			res_ranges[i_res] = ShaderLineRanges(cur_pre_c, cur_cd, cur_post_c)
-			res_ranges[next_i] = ShaderLineRanges(next_pre_c, next_cd, next_post_c)
+	if not any_items:
+		return
+	if in_run and run_is_zero:
+		zero_run = Range(run_first, prev_last)
+		zero_run_next_first = next_pos_f(prev_last)
+
+	if pending is None:
+		# we haven't found vertex/pixel specification in the shader code itself.
+		# let's try to detect it by a file extension:
+		if ext and ext in vert_extensions:
+			shader_type = ShaderType.vert
+		elif ext and ext in frag_extensions:
+			shader_type = ShaderType.frag
+		else:
+			# we couldn't even detect whether the shader is vertex or pixel
+			return
+		if zero_run is not None:
+			any_pre = True
+			pending = (zero_run, shader_type, 0, zero_run_next_first)
+		else:
+			pending = (None, shader_type, 0, start_first)
+
+	last_pre, last_type, last_sm, last_first = pending
+	if in_run and not run_is_zero and any_pre:
+		yield ShaderLineRanges(
+			last_pre,
+			CodeBlock(last_type, last_sm, last_first, run_prev_last),
+			Range(run_first, prev_last)
+		)
+		return
+	yield ShaderLineRanges(last_pre, CodeBlock(last_type, last_sm, last_first, prev_last), None)
 
-		# we've processed post-comment for all the ranges but the last one.
-		# do it now:
-		last_comments = [
-			cmt for cmt in comment_ranges_left
-			if cmt.last == max_line_i
-		]
-		if last_comments:
-			last_comment_start = min(cmt.first for cmt in last_comments)
-			last_shd_range = res_ranges[-1]  # type: ShaderLineRanges
-			last_pre, last_cd, last_post = last_shd_range  # type:  (Optional[Range], CodeBlock, Optional[Range])
-			res_ranges[-1] = ShaderLineRanges(
-				last_pre,
-				CodeBlock(last_cd.type, last_cd.sm, last_cd.first_line, last_comment_start - 1),
-				Range(last_comment_start, max_line_i)
-			)
-		return res_ranges
 
-	# split all the lines to the blocks by 'ps_3_0' lines:
-	code_blocks = continuous_code_blocks_sequence()
-	if not code_blocks:
-		return None
+def _iter_shader_ranges(
+	lines,  # type: Iterable[LineData]
+	ext  # type: str
+):
+	"""
+	Generator version of `_detect_shader_ranges()`.
+
+	It's a single-pass state machine: each line is looked at only once,
+	and each shader block is yielded as soon as the start of the next block is found.
+	So it can consume lines right from the lexer, with no need to keep them.
+
+	The blocks are detected as follows:
+		*
+			lines like 'ps_3_0' split the file to code blocks.
+			The first block always starts at line 0, the last one ends at the last line.
+		*
+			If no such line is found, the whole file is a single block,
+			with the shader type detected from the file extension.
+			If this fails, too, nothing is yielded.
+		*
+			A run of comment-only lines at the file start is the 1st block's pre-comment.
+			A run ending right before the next block start is the next block's pre-comment.
+		*
+			If such a pre-comment starts with the '// approximately ...' stats line,
+			this line is the previous block's post-comment instead.
+		*
+			A comment run at the file end is the post-comment of the last block,
+			but only if any pre-comments were found in the file.
+	"""
+	for shader_range in _iter_shader_spans(
+		((l, i, i) for i, l in enumerate(lines)), ext
+	):
+		yield shader_range
+
+
+def _detect_shader_ranges(
+	lines,  # type: Iterable[LineData]
+	ext  # type: str
+):
+	"""
+	Split one linear list of `LineData` items to independent 'shader blocks' -
+	in case a single file has multiple blocks of ASM code inside it.
 
-	# now let's detect ranges of comment blocks:
-	comment_ranges = detect_comment_ranges()
+	Each shader block contains the following metadata (no actual lines):
+		* pre-comment range (start/end), None if not present
+		* the main code range as `CodeBlock`, also specifying the shader type and SM
+		* post-comment range (start/end), None if not present
 
-	# now, let's combine comment and code ranges to split the entire file
-	# to the actual shader blocks, with pre- and post-comments
-	return shader_line_ranges(code_blocks, comment_ranges)
+	:return: `None` if no shader blocks detected.
+	"""
+	res = list(_iter_shader_ranges(lines, ext))  # type: List[ShaderLineRanges]
+	return res if res else None
 
 # endregion
 
@@ -849,14 +1050,9 @@ def _detect_shader_ranges(
 
 _comment_prefix = '^\s*//[\s/]*'
 
-_re_comment_empty = _re.compile('^\s*//[\s/_-]*$')
-
-_re_params_start = _re.compile(
-	_comment_prefix + 'parameters?[\W_]*$',  # '// Parameters:'
-	flags=_re.IGNORECASE | _re.UNICODE
-)
-_re_var_decl = _re.compile(
-	_comment_prefix +
+_re_comment_empty_str = '[\s/_-]*$'
+_re_params_start_str = 'parameters?[\W_]*$'  # '// Parameters:'
+_re_var_decl_str = (
 	'('
 	'(?:'
 	'(?:bool|int|uint|dword|half|float|double|min10float|min16float|min12int|min16int|min16uint)'
@@ -876,16 +1072,9 @@ _re_var_decl = _re.compile(
 	'(.+)'
 	')?$'
 )
-_re_regs_start = _re.compile(
-	_comment_prefix + 'registers?[\W_]*$',  # '// Registers:'
-	flags=_re.IGNORECASE | _re.UNICODE
-)
-_re_regs_title = _re.compile(
-	_comment_prefix + 'names?[\s/]+reg(?:ister)?s?[\s/]+sizes?[-\s/_]*$',
-	flags=_re.IGNORECASE | _re.UNICODE
-)
-_re_regs_mapping = _re.compile(
-	_comment_prefix +
+_re_regs_start_str = 'registers?[\W_]*$'  # '// Registers:'
+_re_regs_title_str = 'names?[\s/]+reg(?:ister)?s?[\s/]+sizes?[-\s/_]*$'
+_re_regs_mapping_str = (
 	'('
 	# variable's name:
 	'(?:[_a-zA-Z]\w+)|(?:[a-zA-Z])'
@@ -898,6 +1087,42 @@ _re_regs_mapping = _re.compile(
 	')?[-\s_/]*$'
 )
 
+_re_comment_empty = _re.compile(_comment_prefix + _re_comment_empty_str)
+_re_params_start = _re.compile(
+	_comment_prefix + _re_params_start_str,
+	flags=_re.IGNORECASE | _re.UNICODE
+)
+_re_var_decl = _re.compile(_comment_prefix + _re_var_decl_str)
+_re_regs_start = _re.compile(
+	_comment_prefix + _re_regs_start_str,
+	flags=_re.IGNORECASE | _re.UNICODE
+)
+_re_regs_title = _re.compile(
+	_comment_prefix + _re_regs_title_str,
+	flags=_re.IGNORECASE | _re.UNICODE
+)
+_re_regs_mapping = _re.compile(_comment_prefix + _re_regs_mapping_str)
+
+# The same patterns, fused to classify a comment line with a single match.
+# The kind of line is detected by `lastindex` (an outer group is closed after it's inner ones):
+# case-sensitive ones, which are the vast majority of lines in a comment block...
+_re_comment_meta = _re.compile(
+	_comment_prefix + '(?:(' + ')|('.join([
+		_re_var_decl_str, _re_regs_mapping_str, _re_comment_empty_str
+	]) + '))'
+)
+_meta_decl_i = 1
+_meta_mapping_i = _meta_decl_i + 1 + _re_var_decl.groups
+_meta_empty_i = _meta_mapping_i + 1 + _re_regs_mapping.groups
+# ... and case-insensitive titles:
+_re_comment_titles = _re.compile(
+	_comment_prefix + '(?:(' + ')|('.join([
+		_re_regs_start_str, _re_regs_title_str, _re_params_start_str
+	]) + '))',
+	flags=_re.IGNORECASE | _re.UNICODE
+)
+_titles_regs_i, _titles_names_i, _titles_params_i = 1, 2, 3
+
 
 def _extract_var_names(
 	comment_lines  # type: List[_str_h]
@@ -905,6 +1130,18 @@ def _extract_var_names(
 	"""
 	Try to detect the original names of registers from the block of comments.
 
+	It's a single scan over the lines, each of them is classified with
+	(at most) two fused regex matches. Two kinds of metadata are detected:
+		*
+			var declarations (like '//   float4 _Color;').
+			These lines are removed, as well as the trailing empty lines and
+			the 'Parameters:' title preceding the first declaration.
+		*
+			shaderVar-to-register mappings (like '//   _Color   c0   1'),
+			in a continuous block optionally started with
+			'Registers:' and 'Name Reg Size' titles.
+			The whole block is removed.
+
 	:return:
 		* list of detected mappings
 		* modified comment_lines list, with all used mappings removed
@@ -915,160 +1152,116 @@ def _extract_var_names(
 	if not comment_lines:
 		return vars_list, comment_lines
 
-	def first_true_index(
-		values  # type: Iterable
-	):
-		"""
-		Find the index of a first item which value is `True` when converted to `bool`.
-		"""
-		for i, val in enumerate(values):
-			if val:
-				return i
-		return -1
-
-	def last_true_index(
-		values  # type: Union[List, Tuple]
-	):
-		for i in reversed(_xrange(len(values))):
-			if values[i]:
-				return i
-		return -1
-
-	# first, extract the block of param definitions:
-	matches = tuple(
-		_re_var_decl.match(l) for l in comment_lines
-	)
-	assert matches
-	start_line = first_true_index(matches)
-	if start_line > -1:
-		# we already have all the vars' data so we're free to filter matches out,
-		# at the same time splitting the block to a "pre-matches" and "whatever is left" part:
-		comment_lines = [  # first, let's mark those lines we need to keep
-			(not is_var, l) for is_var, l
-			in _izip(matches, comment_lines)
-		]  # type: List[Tuple[bool, str]]
-		# and now let's split and filter:
-		pre_block = [
-			l for is_l, l in comment_lines[:start_line] if is_l
-		]  # type: List[_str_h]
-		comment_lines = [
-			l for is_l, l in comment_lines[start_line:] if is_l
-		]  # type: List[_str_h]
-
-		# remove any lines related to the block from the pre-block and combine it with left comment_lines:
-		if pre_block:
-			# if we remove trailing comment lines and the "Parameters:" line,
-			# which is the last line we need to keep:
-			start_line = last_true_index([
-				not(_re_comment_empty.match(l) or _re_params_start.match(l))
-				for l in pre_block
-			])
-			if start_line > -1:
-				pre_block = pre_block[:start_line+1]
-				comment_lines = pre_block + comment_lines  # type: List[_str_h]
-
-		vars_list = [
-			DeclaredVar(
-				nm,
-				int(sz) if sz else None,
-				tp_str,
-				c
-			) for tp_str, nm, sz, c in (
-				v.groups() for v in matches if v
-			)
-		]
-
-	# now, let's try to detect shaderVar-to-register mappings:
-	shared = type('Shared', (object,), dict())
-	shared.found_title = False
-	shared.found_names = False
-	shared.stage = 0
-	shared.start = -1  # block first line index
-	shared.end = -1  # the 1st line after the block
-	shared.perfect_match_from = -1
-
-	def match_as_reg_mapping(
-		line,  # type: _str_h
-		line_i  # type: int
-	):
-		"""
-		A function that generates a match object for lines
-		inside the shaderVar-to-register mapping block.
-
-		This cannot be done as a simple expression in list comprehension
-		because this function needs to remember which stage we are at:
-		whether we have already entered and if we have got out of this block.
-
-		Stages:
-			* 0 - haven't entered the block yet
-			* 1 - in block
-			* 2 - left the block already
-		"""
-
-		stage = shared.stage
-		if stage > 1:
-			# we have already passed the block
-			return None
-		if not line or _re_comment_empty.match(line):
-			# just skip empty lines
-			return None
-		if _re_regs_start.match(line):
+	match_meta = _re_comment_meta.match
+	match_titles = _re_comment_titles.match
+
+	kept_lines = list()  # type: List[_str_h]
+	keep = kept_lines.append
+
+	# Empty/'Parameters:' lines which aren't kept until we know they aren't
+	# the trailing ones right before the first declaration:
+	held_lines = list()  # type: List[_str_h]
+	found_decl = False
+
+	# the state of the shaderVar-to-register mapping block, in the indices of kept lines:
+	#   * 0 - haven't entered the block yet
+	#   * 1 - in block
+	#   * 2 - left the block already
+	stage = 0
+	block_start = -1  # block first line index
+	block_end = -1  # the 1st line after the block
+	found_title = False
+	found_names = False
+	perfect_match_from = -1
+	mappings = list()  # type: List[Tuple[int, Tuple[str, str, Optional[str]]]]
+
+	for line in comment_lines:
+		meta = match_meta(line)
+		meta_i = meta.lastindex if meta else 0
+		if meta_i == _meta_decl_i:
+			if not found_decl:
+				found_decl = True
+				del held_lines[:]
+			tp_str, nm, sz, c = meta.group(2, 3, 4, 5)
+			vars_list.append(DeclaredVar(nm, int(sz) if sz else None, tp_str, c))
+			continue
+
+		titles_i = 0
+		if not meta:
+			titles = match_titles(line) if line else None
+			titles_i = titles.lastindex if titles else 0
+
+		if not found_decl:
+			if meta_i == _meta_empty_i or titles_i == _titles_params_i:
+				held_lines.append(line)
+				continue
+			if held_lines:
+				# not trailing, so they're kept:
+				for held in held_lines:
+					if stage == 1 and not _re_comment_empty.match(held):
+						# 'Parameters:' is an arbitrary comment, which ends the mapping block
+						stage = 2
+						block_end = len(kept_lines)
+					keep(held)
+				del held_lines[:]
+
+		line_i = len(kept_lines)
+		keep(line)
+
+		if stage > 1 or not line or meta_i == _meta_empty_i:
+			# we have already passed the block or it's just an empty line
+			continue
+		if titles_i == _titles_regs_i:
 			if stage < 1:
-				shared.stage = 1
-				shared.start = line_i
-			shared.found_title = True
-			return None
-		if _re_regs_title.match(line):
+				stage = 1
+				block_start = line_i
+			found_title = True
+			continue
+		if titles_i == _titles_names_i:
 			if stage < 1:
-				shared.stage = 1
-				shared.start = line_i
-			shared.found_names = True
-			return None
-
-		match = _re_regs_mapping.match(line)
-		if match:
-			if shared.perfect_match_from < 0:
-				if shared.found_title and shared.found_names:
-					shared.perfect_match_from = line_i
+				stage = 1
+				block_start = line_i
+			found_names = True
+			continue
+		if meta_i == _meta_mapping_i:
+			if perfect_match_from < 0 and found_title and found_names:
+				perfect_match_from = line_i
 			if stage < 1:
-				shared.stage = 1
-				shared.start = line_i
-			return match
-
-		# we get here only in one case: it's an arbitrary
-		# non-empty comment which doesn't match the mapping pattern.
-		if shared.stage == 1:
-			shared.stage = 2
-			shared.end = line_i
-		return None
-
-	matches = tuple(match_as_reg_mapping(l, i) for i, l in enumerate(comment_lines))
-	assert matches
-	assert shared.perfect_match_from >= shared.start
-
-	if shared.perfect_match_from > -1 and any(matches[shared.start:shared.perfect_match_from]):
+				stage = 1
+				block_start = line_i
+			mappings.append((line_i, meta.group(7, 8, 9)))
+			continue
+		# it's an arbitrary non-empty comment which doesn't match the mapping pattern:
+		if stage == 1:
+			stage = 2
+			block_end = line_i
+
+	if held_lines:
+		# no declarations found, so those lines are just regular comments:
+		for held in held_lines:
+			if stage == 1 and not _re_comment_empty.match(held):
+				stage = 2
+				block_end = len(kept_lines)
+			keep(held)
+
+	if perfect_match_from > -1 and mappings and mappings[0][0] < perfect_match_from:
 		# crop the false start
-		shared.start = shared.perfect_match_from
-	if shared.stage == 1:
+		block_start = perfect_match_from
+	if stage == 1:
 		# the last line is also the end of block, we haven't exited it yet.
-		shared.end = len(comment_lines) + 1
-	if shared.start > shared.end:
-		shared.start = shared.end
-
-	if shared.start < 0 or shared.end < 0 or not any(matches[shared.start:shared.end]):
+		block_end = len(kept_lines) + 1
+	if block_start > block_end:
+		block_start = block_end
+
+	mappings = [
+		groups for line_i, groups in mappings
+		if block_start <= line_i < block_end
+	]  # type: List[Tuple[str, str, Optional[str]]]
+	if block_start < 0 or block_end < 0 or not mappings:
 		# no mappings found, return whatever vars_list we already have detected (if any)
-		return vars_list, comment_lines
+		return vars_list, kept_lines
 
-	# cleanup any false matches me may have:
-	matches = tuple(
-		(m if shared.start <= i < shared.end else None)
-		for i, m in enumerate(matches)
-	)
-	comment_lines = [
-		l for i, (do_m, l) in enumerate(_izip(matches, comment_lines))
-		if not do_m and (i < shared.start or i >= shared.end)
-	]  # type: List[_str_h]
-	matches = (m.groups() for m in matches if m)
+	comment_lines = kept_lines[:block_start] + kept_lines[block_end:]  # type: List[_str_h]
 
 	if not vars_list:
 		# we haven't found any declarations, let's at least return mappings:
@@ -1077,7 +1270,7 @@ def _extract_var_names(
 				nm,
 				register=reg,
 				regs_num=int(sz) if sz else None
-			) for nm, reg, sz in matches
+			) for nm, reg, sz in mappings
 		]
 		return vars_list, comment_lines
 
@@ -1095,7 +1288,7 @@ def _extract_var_names(
 		vars_dict[name] = new_var
 		return new_var
 
-	for nm, reg, sz in matches:
+	for nm, reg, sz in mappings:
 		var = get_var(nm)
 		var.register = reg
 		var.regs_num = int(sz) if sz else None
@@ -1105,85 +1298,2109 @@ def _extract_var_names(
 # endregion
 
 
-def _hlsl_code(
-	shader_type,  # type: ShaderType
-	shader_model,  # type: int  # not used yet 'cause the script only handles SM 3.0, could be anything for now
-	pre_comments,  # type: List[str]
-	code_lines,  # type: List[LineData]
-	post_comments  # type: List[str]
-):
+# region Memory-mapped lazy access to blocks in huge files
+
+# Only the lines which matter for block detection: comment-only lines and 'ps_3_0'-like ones (an op with no args):
+_re_bytes_block_line = _re.compile(
+	b'^[ \t\r\f\v]*(?:'
+	b'(//[^\n]*)'
+	b'|'
+	b'([pPvV][sS][^\s/]*)[ \t\r\f\v,]*(?://[^\n]*)?$'
+	b')',
+	flags=_re.MULTILINE
+)
+_re_bytes_non_space = _re.compile(b'\S')
+# any code line which is neither a comment nor a block start:
+_code_line_stub = LineData(None, None, None)
+# any comment line which isn't the first one in a comment run:
+_comment_line_stub = LineData(None, None, '//')
+
+
+class MappedShaderFile(object):
 	"""
-	The main function which actually performs ASM->HLSL code conversion.
-	It takes lines as multiple arguments, pre-processed to detect their grouping
-	and in-line basic structure. And therefore is called from the other, higher-level func.
-	All the arguments are mandatory, but empty lists or zero SM can be provided.
+	Access to shader blocks of a (possibly huge) file without reading it as a whole.
 
-	:param shader_model: integer representing SM multiplied by 10. I.e., 14, 20, 30, 35
+	The file is memory-mapped, and on creation, it's scanned only for the lines
+	needed to detect the shader blocks (comments and 'ps_3_0'-like lines),
+	giving the same blocks as `_detect_shader_ranges()` does.
+	The ranges are stored as byte offsets (first inclusive, last exclusive),
+	and each block is decoded and parsed only when it's requested.
+
+	Use it as a context manager (or call `close()` explicitly).
 	"""
+	def __init__(
+		self,
+		file_path,  # type: _str_h
+		encoding='utf-8'
+	):
+		super(MappedShaderFile, self).__init__()
+		import mmap
 
-	error_start = '// ERROR ASM-> HLSL: '
+		self.__path = file_path
+		self.__encoding = encoding
+		self.__file = open(file_path, 'rb')
+		try:
+			if _os.fstat(self.__file.fileno()).st_size:
+				self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				# an empty file can't be mapped
+				self.__map = b''
+			ext = _os.path.splitext(file_path)[-1].lower()
+			self.__ranges = list(
+				_iter_shader_spans(self.__scan(), ext, lambda last: last)
+			)  # type: List[ShaderLineRanges]
+		except Exception:
+			self.close()
+			raise
+
+	def __scan(self):
+		"""
+		Generate items for `_iter_shader_spans()` from the mapped file.
+		Any non-empty run of other lines is a single code item.
+		"""
+		data = self.__map
+		encoding = self.__encoding
+		search_non_space = _re_bytes_non_space.search
+		prev_end = 0
+		in_comment_run = False
+		for m in _re_bytes_block_line.finditer(data):
+			start = m.start()
+			code = search_non_space(data, prev_end, start)
+			if code:
+				in_comment_run = False
+				yield _code_line_stub, code.start(), start
+			comment, op = m.groups()
+			if comment is None:
+				in_comment_run = False
+				line = LineData(op.decode(encoding, 'replace'), None, None)
+			elif in_comment_run:
+				# only the first comment in a run is actually looked at
+				line = _comment_line_stub
+			else:
+				in_comment_run = True
+				line = LineData(None, None, comment.rstrip().decode(encoding, 'replace'))
+			prev_end = m.end()
+			yield line, start, prev_end
+		code = search_non_space(data, prev_end)
+		if code:
+			yield _code_line_stub, code.start(), len(data)
 
-	if not(shader_type and shader_type in all_shader_types):
-		return [error_start + 'Unknown shader type']
+	@property
+	def file_path(self):
+		return self.__path
 
-	res = list()  # type: List[str]
+	@property
+	def ranges(self):
+		"""
+		The blocks detected in file, as byte offsets.
+		"""
+		return self.__ranges[:]
 
-	# TODO
+	def __len__(self):
+		return len(self.__ranges)
 
-	# TODO 1: detect metadata (var names and types) from the pre-comment block
+	def __lines(
+		self,
+		byte_range  # type: Optional[Range]
+	):
+		if not byte_range or byte_range.first >= byte_range.last:
+			return list()
+		text = self.__map[byte_range.first:byte_range.last].decode(self.__encoding, 'replace')
+		return list(_lex_text(text))
 
-	return res
+	def block(
+		self,
+		i  # type: int
+	):
+		"""
+		Decode and parse the block with the given index.
 
+		:return: `ShaderBlock`, which items are the arguments for `_hlsl_code()`.
+		"""
+		pre_c_r, code_r, post_c_r = self.__ranges[i]  # type: (Optional[Range], CodeBlock, Optional[Range])
+		return ShaderBlock(
+			code_r.type, code_r.sm,
+			[l.comment for l in self.__lines(pre_c_r)],
+			self.__lines(Range(code_r.first_line, code_r.last_line)),
+			[l.comment for l in self.__lines(post_c_r)]
+		)
 
-def parse_file(file_path, print_path=False):
-	"""
-	Parse a single assembly file and convert it to an hlsl shader.
-	"""
-	if not _os.path.isfile(file_path):
-		return
+	def __iter__(self):
+		for i in _xrange(len(self.__ranges)):
+			yield self.block(i)
 
-	if print_path:
-		print('Reading: ' + file_path)
+	def close(self):
+		data = getattr(self, '_MappedShaderFile__map', None)
+		if data is not None and not isinstance(data, bytes):
+			data.close()
+		self.__map = b''
+		self.__file.close()
 
-	# file_path = r'E:\1-Projects\SFM\_Tools\dx-shader-decompiler\ME-face-0.ps'
+	def __enter__(self):
+		return self
 
-	base_path, ext = _os.path.splitext(file_path)
-	ext = ext.lower()
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
 
-	with open(file_path, 'r') as fl:
-		lines = (_classify_line(l) for l in fl)
-		lines = filter(None, lines)  # type: List[LineData]
-	if not lines:
-		return
+	def __repr__(self):
+		return '<MappedShaderFile: {0} blocks in {1}>'.format(len(self.__ranges), repr(self.__path))
 
-	if print_path:
-		print('\tParsing... ' + file_path)
-	shader_ranges = _detect_shader_ranges(lines, ext)
-	hlsl_shaders = []  # type: List[List[str]]
-	for pre_c_r, code_r, post_c_r in shader_ranges:  # type: (Optional[Range], CodeBlock, Optional[Range])
-		pre_comments = (
-			[l.comment for l in lines[pre_c_r.first:pre_c_r.last+1]]
-			if pre_c_r
-			else list()
-		)  # type: List[str]
-
-		post_comments = (
-			[l.comment for l in lines[post_c_r.first:post_c_r.last+1]]
-			if post_c_r
-			else list()
-		)  # type: List[str]
-
-		shader_type, shader_model, code_first, code_last = code_r  # type: (ShaderType, int, int, int)
-		hlsl_shaders.append(
-			_hlsl_code(shader_type, shader_model, pre_comments, lines[code_first:code_last+1], post_comments)
-		)
-	del lines
+# endregion
 
 
-def is_proper_input_file(file_path):
-	"""
-	Whether the given file path seems to be an HLSL-assembly file.
-	"""
+# region ASM -> HLSL translation of instructions
+
+# Each unique op/operand string is parsed only once, these caches are shared by all the blocks:
+_op_cache = dict()  # type: Dict[_str_h, AsmOp]
+_operand_cache = dict()  # type: Dict[_str_h, Operand]
+
+_op_shifts = {
+	'x2': '2', 'x4': '4', 'x8': '8',
+	'd2': '0.5', 'd4': '0.25', 'd8': '0.125',
+}
+_op_ignored_modifiers = {'pp', 'centroid'}
+
+_re_operand = _re.compile(
+	'^\s*([-!])?\s*(1\s*-\s*)?'  # negation and SM 1.x complement: '1-r0'
+	'([a-zA-Z]+)(\d*)'  # register literal and index
+	'(?:\[([^\]]+)\])?'  # relative addressing: c[a0.x + 5]
+	'(?:_([a-z0-9]+))?'  # source modifier: r0_abs
+	'(?:\.([xyzwrgba]{1,4}))?'  # swizzle / write mask
+	'(?:_([a-z0-9]+))?\s*$'  # source modifier after swizzle
+)
+_swizzle_chars = {'x': 'x', 'y': 'y', 'z': 'z', 'w': 'w', 'r': 'x', 'g': 'y', 'b': 'z', 'a': 'w'}
+_component_i = {'x': 0, 'y': 1, 'z': 2, 'w': 3}
+
+_src_mod_formats = {
+	'abs': 'abs({0})',
+	'bias': '({0} - 0.5)',
+	'bx2': '({0} * 2 - 1)',
+	'x2': '({0} * 2)',
+	'comp': '(1 - {0})',
+}
+
+_cmp_ops = {'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<=', 'eq': '==', 'ne': '!='}
+_float_types = {1: 'float', 2: 'float2', 3: 'float3', 4: 'float4'}
+
+# registers which are scalars, rather than 4-component vectors:
+_scalar_literals = {
+	shader_type: {nm for nm, reg in regs.items() if not reg_vector4[reg]}
+	for shader_type, regs in register_type.items()
+}  # type: Dict[ShaderType, Set[str]]
+
+_sampler_types = {'2d': SamplerType.s2d, 'cube': SamplerType.cube, 'volume': SamplerType.volume}
+_sampler_decl_types = {
+	SamplerType.s2d: 'sampler2D', SamplerType.cube: 'samplerCUBE', SamplerType.volume: 'sampler3D',
+}
+# texture-fetch function and the number of coordinates for each sampler type:
+_sampler_funcs = {
+	SamplerType.s2d: ('tex2D', 'xy'),
+	SamplerType.cube: ('texCUBE', 'xyz'),
+	SamplerType.volume: ('tex3D', 'xyz'),
+}
+
+_uniform_literals = ('c', 'i', 'b', 's')
+_rel_array_sizes = {'c': 256, 'i': 16, 'b': 16}
+_default_semantics = {
+	ShaderType.vert: {
+		'oPos': 'POSITION', 'oD': 'COLOR', 'oT': 'TEXCOORD', 'oFog': 'FOG', 'oPts': 'PSIZE',
+	},
+	ShaderType.frag: {
+		'v': 'COLOR', 't': 'TEXCOORD', 'vPos': 'VPOS', 'vFace': 'VFACE',
+		'oC': 'COLOR', 'oDepth': 'DEPTH',
+	},
+}  # type: Dict[ShaderType, Dict[str, str]]
+_input_literals = {'v', 't', 'vPos', 'vFace'}
+# HLSL type of a register, if it's not float/float4:
+_reg_base_types = {'b': 'bool', 'p': 'bool', 'i': 'int', 'aL': 'int'}
+_reg_decl_overrides = {'vPos': 'float2', 'oFog': 'float', 'oPts': 'float'}
+
+
+def _parse_op(
+	op  # type: _str_h
+):
+	"""
+	Split an instruction name to the base op and it's modifiers: 'mad_sat_pp' -> 'mad' + saturate.
+	Any other underscore-separated part is kept as suffix: comparison for 'if_gt',
+	usage for 'dcl_texcoord1' or shader model for 'ps_3_0'.
+	"""
+	try:
+		return _op_cache[op]
+	except KeyError:
+		pass
+
+	parts = op.lstrip('+').split('_')
+	sat = False
+	shift = None
+	suffix = list()  # type: List[str]
+	for part in parts[1:]:
+		if part == 'sat':
+			sat = True
+		elif part in _op_shifts:
+			shift = _op_shifts[part]
+		elif part not in _op_ignored_modifiers:
+			suffix.append(part)
+	res = AsmOp(parts[0], '_'.join(suffix), sat, shift)
+	_op_cache[op] = res
+	return res
+
+
+def _split_predicate(
+	op,  # type: _str_h
+	args  # type: Optional[Tuple[_str_h, ...]]
+):
+	"""
+	The lexer sees the predicate of '(p0) mov r0, r1' as an op: '(p0)' with args ('mov r0', 'r1').
+	Split it into the actual instruction.
+
+	:return: the predicate operand ('!p0.x' -> 'p0.x' and negation) or `None`, the actual op and args.
+	"""
+	if not (op.startswith('(') and op.endswith(')')) or not args:
+		return None, False, op, args
+	pred = op[1:-1].strip()
+	negated = pred.startswith('!')
+	parts = args[0].split(None, 1)
+	return pred.lstrip('!'), negated, parts[0], tuple(parts[1:]) + tuple(args[1:])
+
+
+def _parse_operand(
+	arg  # type: _str_h
+):
+	"""
+	Parse a single source/destination argument: register, relative index, swizzle and modifiers.
+
+	The swizzle (or the write mask, for a destination) is kept as written,
+	only with 'rgba' converted to 'xyzw'. For anything that isn't a register
+	(a literal value), it's None and the whole string is kept as `reg`.
+	"""
+	try:
+		return _operand_cache[arg]
+	except KeyError:
+		pass
+
+	m = _re_operand.match(arg)
+	if m is None:
+		# not a register, most likely a literal: keep as is
+		res = Operand('', arg.strip(), None, None, None, None)
+	else:
+		neg, comp, literal, index, rel, mod, swizzle, mod_after = m.groups()
+		swizzle = ''.join([_swizzle_chars[c] for c in swizzle]) if swizzle else ''
+		res = Operand(
+			neg or '',
+			literal,
+			int(index) if index else None,
+			' '.join(rel.split()) if rel else None,
+			swizzle,
+			'comp' if comp else (mod or mod_after),
+		)
+	_operand_cache[arg] = res
+	return res
+
+
+_swizzle_suffixes = dict()  # type: Dict[Tuple[str, str], str]
+
+
+def _swizzle_suffix(
+	swizzle,  # type: str
+	mask  # type: str
+):
+	"""
+	The swizzle of a source, reduced to the components actually read for the given write mask:
+	'r0.wzyx' written to '.xz' -> 'r0.wy'. Empty string if all 4 components are read as-is.
+	"""
+	key = (swizzle, mask)
+	try:
+		return _swizzle_suffixes[key]
+	except KeyError:
+		pass
+	expanded = swizzle + swizzle[-1] * (4 - len(swizzle)) if swizzle else 'xyzw'
+	components = ''.join([expanded[_component_i[c]] for c in mask])
+	res = '' if components == 'xyzw' else '.' + components
+	_swizzle_suffixes[key] = res
+	return res
+
+
+def _folded_const(
+	operand,  # type: Operand
+	values,  # type: List[str]
+	mask  # type: str
+):
+	"""
+	Literal value of an inline constant, as it's read by the given source operand:
+	with swizzle and modifiers applied. A single number if all the components are the same.
+	None if the values aren't numbers.
+	"""
+	try:
+		nums = [float(values[c]) for c in _read_components_ordered(operand.swizzle, mask)]
+	except ValueError:
+		return None
+	mod_f = _const_mod_funcs.get(operand.mod)
+	if mod_f is not None:
+		nums = [mod_f(x) for x in nums]
+	if operand.neg == '-':
+		nums = [-x for x in nums]
+	elif operand.neg:
+		return None
+	strings = ['{0:.9g}'.format(x + 0.0) for x in nums]
+	if all(s == strings[0] for s in strings):
+		return strings[0]
+	return '{0}({1})'.format(_float_types[len(strings)], ', '.join(strings))
+
+
+_const_mod_funcs = {
+	'abs': abs,
+	'bias': lambda x: x - 0.5,
+	'bx2': lambda x: x * 2 - 1,
+	'x2': lambda x: x * 2,
+	'comp': lambda x: 1 - x,
+}  # type: Dict[str, Callable[[float], float]]
+
+
+def _read_components_ordered(
+	swizzle,  # type: str
+	mask  # type: str
+):
+	"""
+	Indices of the source components read for each component of the write mask, in order.
+	"""
+	expanded = swizzle + swizzle[-1] * (4 - len(swizzle)) if swizzle else 'xyzw'
+	return [_component_i[expanded[_component_i[c]]] for c in mask]
+
+
+class _TranslationContext(object):
+	"""
+	The state of a single block being translated: declared samplers, inputs, outputs,
+	inline constants and the set of all the referenced registers.
+
+	Rendered operands are cached per block, since register names depend on the constant table.
+
+	With `fold_consts`, reading a register defined inline by `def` produces
+	the literal value itself, rather than a reference to the static constant.
+	"""
+	def __init__(
+		self,
+		shader_type,  # type: ShaderType
+		names=None,  # type: Optional[Dict[str, str]]
+		rel_literals=None,  # type: Optional[Set[str]]
+		fold_consts=False
+	):
+		super(_TranslationContext, self).__init__()
+		self.shader_type = shader_type
+		self.fold_consts = fold_consts
+		self.names = names if names else dict()  # type: Dict[str, str]
+		self.rel_literals = rel_literals if rel_literals else set()  # type: Set[str]
+		self.scalars = _scalar_literals[shader_type]
+
+		self.used = set()  # type: Set[Tuple[str, Optional[int]]]
+		self.samplers = dict()  # type: Dict[Tuple[str, Optional[int]], SamplerType]
+		self.semantics = dict()  # type: Dict[Tuple[str, Optional[int]], str]
+		self.consts = list()  # type: List[Tuple[str, Tuple[str, Optional[int]], str, List[str]]]
+		self.defined = set()  # type: Set[Tuple[str, Optional[int]]]
+		self.const_values = dict()  # type: Dict[Tuple[str, Optional[int]], List[str]]
+		self.loops = 0
+
+		self.__src_exprs = dict()  # type: Dict[Tuple[_str_h, str, int], str]
+		self.__dest_exprs = dict()  # type: Dict[_str_h, Tuple[str, str]]
+
+	def reg_name(
+		self,
+		operand,  # type: Operand
+		offset=0
+	):
+		literal, index, rel = operand.reg, operand.index, operand.rel
+		if index is not None:
+			index += offset
+		if rel or literal in self.rel_literals and (literal, index) not in self.defined:
+			# the whole array is declared at once
+			self.used.add((literal, None))
+			if rel:
+				# the address register itself ('a0.x', 'aL'), possibly followed by an offset:
+				rel_operand = _parse_operand(rel.split('+')[0])
+				if rel_operand.swizzle is not None:
+					self.used.add((rel_operand.reg, rel_operand.index))
+			if not rel:
+				return '{0}[{1}]'.format(literal, index)
+			if index:
+				return '{0}[{1} + {2}]'.format(literal, index, rel)
+			return '{0}[{1}]'.format(literal, rel)
+
+		self.used.add((literal, index))
+		reg = literal if index is None else '{0}{1}'.format(literal, index)
+		return self.names.get(reg, reg)
+
+	def src(
+		self,
+		arg,  # type: _str_h
+		mask,  # type: str
+		offset=0
+	):
+		"""
+		HLSL expression for a source argument, with the components read for the given write mask.
+		"""
+		key = (arg, mask, offset)
+		try:
+			return self.__src_exprs[key]
+		except KeyError:
+			pass
+
+		operand = _parse_operand(arg)
+		if operand.swizzle is None:
+			return operand.reg
+		if self.fold_consts and not operand.rel:
+			values = self.const_values.get((operand.reg, operand.index + offset if offset else operand.index))
+			if values is not None:
+				res = _folded_const(operand, values, mask)
+				if res is not None:
+					self.__src_exprs[key] = res
+					return res
+		res = self.reg_name(operand, offset)
+		if operand.reg not in self.scalars:
+			res += _swizzle_suffix(operand.swizzle, mask)
+		mod_format = _src_mod_formats.get(operand.mod)
+		if mod_format is not None:
+			res = mod_format.format(res)
+		if operand.neg:
+			res = operand.neg + res
+
+		self.__src_exprs[key] = res
+		return res
+
+	def dest(
+		self,
+		arg  # type: _str_h
+	):
+		"""
+		HLSL expression for a destination argument and it's write mask.
+		"""
+		try:
+			return self.__dest_exprs[arg]
+		except KeyError:
+			pass
+
+		operand = _parse_operand(arg)
+		if operand.swizzle is None:
+			# not a register: nothing to declare
+			self.__dest_exprs[arg] = (operand.reg, 'xyzw')
+			return operand.reg, 'xyzw'
+		res = self.reg_name(operand)
+		if operand.reg in self.scalars:
+			mask = 'x'
+		else:
+			mask = operand.swizzle or 'xyzw'
+			if mask != 'xyzw':
+				res = '{0}.{1}'.format(res, mask)
+		self.__dest_exprs[arg] = (res, mask)
+		return res, mask
+
+	@staticmethod
+	def assign(
+		op,  # type: AsmOp
+		dest,  # type: str
+		expr  # type: str
+	):
+		if op.shift:
+			expr = '({0}) * {1}'.format(expr, op.shift)
+		if op.sat:
+			expr = 'saturate({0})'.format(expr)
+		return '{0} = {1};'.format(dest, expr)
+
+
+# region Translators
+# Each one takes the context, the parsed op and the raw args,
+# and returns an HLSL statement, a list of them or None (nothing to output).
+
+_default_src_specs = ((1, None), (2, None), (3, None))
+
+
+def _tr_expr(
+	fmt,  # type: str
+	src_specs=_default_src_specs  # type: Sequence[Tuple[int, Optional[str]]]
+):
+	"""
+	Translator for an arithmetic instruction: `dest = expression;`
+
+	:param fmt:
+		Format of the expression with positional sources. Also, `{t}` is the float type
+		matching the write mask and `{sel}` - a swizzle selecting the written components
+		from a 4-component result.
+	:param src_specs:
+		For each positional source: the index of it's argument and the components read from it.
+		None means the write mask of the destination (a component-wise op).
+	"""
+	def translate(ctx, op, args):
+		dest, mask = ctx.dest(args[0])
+		srcs = [ctx.src(args[i], m or mask) for i, m in src_specs if i < len(args)]
+		expr = fmt.format(
+			*srcs,
+			t=_float_types[len(mask)],
+			sel='' if mask == 'xyzw' else '.' + mask
+		)
+		return ctx.assign(op, dest, expr)
+	return translate
+
+
+def _tr_const(
+	text  # type: Optional[str]
+):
+	return lambda ctx, op, args: text
+
+
+def _tr_cond(
+	fmt  # type: str
+):
+	"""
+	Translator for a conditional statement: plain (`if b0`) or comparison (`if_gt r0.x, c0.x`).
+	"""
+	def translate(ctx, op, args):
+		if op.suffix:
+			cond = '{0} {1} {2}'.format(ctx.src(args[0], 'x'), _cmp_ops[op.suffix], ctx.src(args[1], 'x'))
+		else:
+			cond = ctx.src(args[0], 'x')
+		return fmt.format(cond)
+	return translate
+
+
+def _tr_break(ctx, op, args):
+	if op.suffix or args:
+		return _tr_break_if(ctx, op, args)
+	return 'break;'
+
+
+_tr_break_if = _tr_cond('if ({0}) break;')
+
+
+def _tr_setp(ctx, op, args):
+	dest, mask = ctx.dest(args[0])
+	return ctx.assign(op, dest, '{0} {1} {2}'.format(
+		ctx.src(args[1], mask), _cmp_ops[op.suffix], ctx.src(args[2], mask)
+	))
+
+
+def _tr_rep(ctx, op, args):
+	i = ctx.loops
+	ctx.loops += 1
+	return 'for (int rep{0} = 0; rep{0} < {1}; rep{0}++) {{'.format(i, ctx.src(args[0], 'x'))
+
+
+def _tr_loop(ctx, op, args):
+	i = ctx.loops
+	ctx.loops += 1
+	counter = ctx.src(args[0], 'x')
+	return [
+		'{0} = {1};'.format(counter, ctx.src(args[1], 'y')),
+		'for (int loop{0} = 0; loop{0} < {1}; loop{0}++, {2} += {3}) {{'.format(
+			i, ctx.src(args[1], 'x'), counter, ctx.src(args[1], 'z')
+		),
+	]
+
+
+def _tr_sincos(ctx, op, args):
+	dest, mask = ctx.dest(args[0])
+	angle = ctx.src(args[1], 'w')
+	parts = [
+		('cos({0})' if c == 'x' else 'sin({0})').format(angle)
+		for c in mask if c in 'xy'
+	]
+	if len(parts) == 1:
+		return ctx.assign(op, dest, parts[0])
+	return ctx.assign(op, dest, '{0}({1})'.format(_float_types[len(parts)], ', '.join(parts)))
+
+
+def _tr_matrix(
+	src_mask,  # type: str
+	rows  # type: int
+):
+	"""
+	Translator for `m4x4` and the like: a dot product with each of the consecutive registers.
+	"""
+	def translate(ctx, op, args):
+		dest, mask = ctx.dest(args[0])
+		vec = ctx.src(args[1], src_mask)
+		dots = [
+			'dot({0}, {1})'.format(vec, ctx.src(args[2], src_mask, _component_i[c]))
+			for c in mask if _component_i[c] < rows
+		]
+		if len(dots) == 1:
+			return ctx.assign(op, dest, dots[0])
+		return ctx.assign(op, dest, '{0}({1})'.format(_float_types[len(dots)], ', '.join(dots)))
+	return translate
+
+
+def _tr_tex(
+	variant,  # type: str
+	full_coords  # type: bool
+):
+	"""
+	Translator for a texture fetch. The function depends on the sampler type declared by `dcl_*`.
+
+	:param variant: suffix of the function: tex2D + 'lod', ...
+	:param full_coords:
+		Whether all the 4 components of the coordinates are used
+		(the projection/bias/LOD is in .w), or only as much as the sampler type needs.
+	"""
+	def translate(ctx, op, args):
+		dest, mask = ctx.dest(args[0])
+		sampler = _parse_operand(args[2])
+		func, coords_mask = _sampler_funcs[
+			ctx.samplers.get((sampler.reg, sampler.index), SamplerType.s2d)
+		]
+		params = [ctx.reg_name(sampler), ctx.src(args[1], 'xyzw' if full_coords else coords_mask)]
+		params.extend(ctx.src(a, coords_mask) for a in args[3:5])  # gradients for texldd
+		return ctx.assign(op, dest, '{0}{1}({2}){3}'.format(
+			func, variant, ', '.join(params), '' if mask == 'xyzw' else '.' + mask
+		))
+	return translate
+
+
+def _tr_dcl(ctx, op, args):
+	operand = _parse_operand(args[0])
+	key = (operand.reg, operand.index)
+	sampler_type = _sampler_types.get(op.suffix)
+	if sampler_type is not None:
+		ctx.samplers[key] = sampler_type
+	elif op.suffix:
+		ctx.semantics[key] = op.suffix.upper()
+	ctx.used.add(key)
+	return None
+
+
+def _tr_def(
+	type_name  # type: str
+):
+	"""
+	Translator for an inline constant definition (`def c1, 0.5, ...`), which is declared as a static one.
+	"""
+	def translate(ctx, op, args):
+		operand = _parse_operand(args[0])
+		key = (operand.reg, operand.index)
+		values = [a.strip() for a in args[1:]]
+		# marked as defined first, to keep it's own name even if other registers are accessed as an array:
+		ctx.defined.add(key)
+		ctx.consts.append((type_name, key, '{0}{1}'.format(*key), values))
+		if type_name == 'float4' and len(values) == 4:
+			ctx.const_values[key] = values
+		return None
+	return translate
+
+
+_scalar_src = ((1, 'w'), )
+
+# The dispatch table: base op -> translator.
+_op_translators = {
+	'vs': _tr_const(None),
+	'ps': _tr_const(None),
+	'nop': _tr_const(None),
+	'dcl': _tr_dcl,
+	'def': _tr_def('float4'),
+	'defi': _tr_def('int4'),
+	'defb': _tr_def('bool'),
+
+	'mov': _tr_expr('{0}'),
+	'mova': _tr_expr('round({0})'),
+	'add': _tr_expr('{0} + {1}'),
+	'sub': _tr_expr('{0} - {1}'),
+	'mul': _tr_expr('{0} * {1}'),
+	'mad': _tr_expr('{0} * {1} + {2}'),
+	'min': _tr_expr('min({0}, {1})'),
+	'max': _tr_expr('max({0}, {1})'),
+	'slt': _tr_expr('({t})({0} < {1})'),
+	'sge': _tr_expr('({t})({0} >= {1})'),
+	'cmp': _tr_expr('{0} >= 0 ? {1} : {2}'),
+	'cnd': _tr_expr('{0} > 0.5 ? {1} : {2}'),
+	'lrp': _tr_expr('lerp({2}, {1}, {0})'),
+	'abs': _tr_expr('abs({0})'),
+	'frc': _tr_expr('frac({0})'),
+	'sgn': _tr_expr('sign({0})'),
+	'dsx': _tr_expr('ddx({0})'),
+	'dsy': _tr_expr('ddy({0})'),
+	'dst': _tr_expr('dst({0}, {1}){sel}', ((1, 'xyzw'), (2, 'xyzw'))),
+	'nrm': _tr_expr('{0} * rsqrt(dot({1}, {1}))', ((1, None), (1, 'xyz'))),
+	'crs': _tr_expr('cross({0}, {1}){sel}', ((1, 'xyz'), (2, 'xyz'))),
+	'lit': _tr_expr('lit({0}, {1}, {2}){sel}', ((1, 'x'), (1, 'y'), (1, 'w'))),
+	'dp2add': _tr_expr('dot({0}, {1}) + {2}', ((1, 'xy'), (2, 'xy'), (3, 'w'))),
+	'dp3': _tr_expr('dot({0}, {1})', ((1, 'xyz'), (2, 'xyz'))),
+	'dp4': _tr_expr('dot({0}, {1})', ((1, 'xyzw'), (2, 'xyzw'))),
+	'rcp': _tr_expr('1.0 / {0}', _scalar_src),
+	'rsq': _tr_expr('rsqrt({0})', _scalar_src),
+	'exp': _tr_expr('exp2({0})', _scalar_src),
+	'expp': _tr_expr('exp2({0})', _scalar_src),
+	'log': _tr_expr('log2({0})', _scalar_src),
+	'logp': _tr_expr('log2({0})', _scalar_src),
+	'pow': _tr_expr('pow({0}, {1})', ((1, 'w'), (2, 'w'))),
+	'sincos': _tr_sincos,
+	'm4x4': _tr_matrix('xyzw', 4),
+	'm4x3': _tr_matrix('xyzw', 3),
+	'm3x4': _tr_matrix('xyz', 4),
+	'm3x3': _tr_matrix('xyz', 3),
+	'm3x2': _tr_matrix('xyz', 2),
+	'setp': _tr_setp,
+
+	'texld': _tr_tex('', False),
+	'texldp': _tr_tex('proj', True),
+	'texldb': _tr_tex('bias', True),
+	'texldl': _tr_tex('lod', True),
+	'texldd': _tr_tex('grad', False),
+	'texkill': lambda ctx, op, args: 'clip({0});'.format(ctx.src(args[0], 'xyzw')),
+
+	'if': _tr_cond('if ({0}) {{'),
+	'else': _tr_const('} else {'),
+	'endif': _tr_const('}'),
+	'rep': _tr_rep,
+	'endrep': _tr_const('}'),
+	'loop': _tr_loop,
+	'endloop': _tr_const('}'),
+	'break': _tr_break,
+	'breakp': _tr_break_if,
+	# Subroutines aren't supported: the code after a 'label' would have to become a separate function,
+	# with all the registers it shares with the main one passed in/out.
+	# So 'call'/'callnz'/'label' have no translators, and they're reported as errors:
+	'ret': _tr_const('return;'),
+}  # type: Dict[str, Callable[[_TranslationContext, AsmOp, Tuple[str, ...]], Union[None, str, List[str]]]]
+
+# Indentation change for flow control: (before, after) the instruction.
+_op_indent = {
+	'if': (0, 1), 'else': (-1, 1), 'endif': (-1, 0),
+	'rep': (0, 1), 'endrep': (-1, 0),
+	'loop': (0, 1), 'endloop': (-1, 0),
+}  # type: Dict[str, Tuple[int, int]]
+
+# endregion
+
+
+def _register_names(
+	declared_vars  # type: List[DeclaredVar]
+):
+	"""
+	Map registers to the original var names from the constant table: 'c4' -> '_Color',
+	and for the vars taking multiple registers: 'c0' -> 'unity_ObjectToWorld[0]'.
+
+	:return: the mapping and the list of vars, which have a register assigned.
+	"""
+	names = dict()  # type: Dict[str, str]
+	mapped_vars = list()  # type: List[DeclaredVar]
+	for var in declared_vars:
+		reg = var.register
+		if not (var.name and reg):
+			continue
+		literal = reg.rstrip('0123456789')
+		first = int(reg[len(literal):])
+		num = var.regs_num if var.regs_num else 1
+		for i in _xrange(num):
+			names['{0}{1}'.format(literal, first + i)] = var.name if num == 1 else '{0}[{1}]'.format(var.name, i)
+		mapped_vars.append(var)
+	return names, mapped_vars
+
+
+def _reg_key_sorted(
+	keys  # type: Iterable[Tuple[str, Optional[int]]]
+):
+	return sorted(keys, key=lambda key: (key[0], -1 if key[1] is None else key[1]))
+
+
+def _reg_decl_type(
+	ctx,  # type: _TranslationContext
+	literal  # type: str
+):
+	try:
+		return _reg_decl_overrides[literal]
+	except KeyError:
+		pass
+	base = _reg_base_types.get(literal, 'float')
+	return base if literal in ctx.scalars else base + '4'
+
+
+def _translate_declarations(
+	ctx,  # type: _TranslationContext
+	mapped_vars  # type: List[DeclaredVar]
+):
+	"""
+	Declarations for all the registers referenced in the block, as they're collected by the context:
+		* uniforms (constants and samplers), using the original names if known;
+		* static constants defined inline;
+		* function parameters (inputs/outputs with their semantics);
+		* temporary local vars.
+
+	:return: 3 lists of lines: globals, function params and locals.
+	"""
+	used = ctx.used.difference(ctx.defined)
+	names = ctx.names
+
+	globals_lines = list()  # type: List[str]
+	declared_names = set()  # type: Set[str]
+	var_by_name = {var.name: var for var in mapped_vars}  # type: Dict[str, DeclaredVar]
+	for literal in _uniform_literals:
+		keys = [key for key in used if key[0] == literal]
+		if not keys:
+			continue
+		if literal in ctx.rel_literals:
+			globals_lines.append('{0} {1}[{2}] : register({1}0);'.format(
+				_reg_decl_type(ctx, literal), literal, _rel_array_sizes.get(literal, 16)
+			))
+			continue
+
+		for key in _reg_key_sorted(keys):
+			reg = '{0}{1}'.format(*key)
+			if literal == 's':
+				decl_type = _sampler_decl_types[ctx.samplers.get(key, SamplerType.s2d)]
+			else:
+				decl_type = _reg_decl_type(ctx, literal)
+
+			if reg not in names:
+				globals_lines.append('{0} {1} : register({1});'.format(decl_type, reg))
+				continue
+			var_nm = names[reg].split('[')[0]
+			if var_nm in declared_names:
+				continue
+			declared_names.add(var_nm)
+			var = var_by_name[var_nm]
+			regs_num = var.regs_num if var.regs_num else 1
+			line = '{0} {1}{2} : register({3});'.format(
+				decl_type, var_nm, '' if regs_num == 1 else '[{0}]'.format(regs_num), var.register
+			)
+			if var.type_str and var.type_str != decl_type:
+				line += '  // {0}'.format(var.type_str)
+			globals_lines.append(line)
+
+	for type_name, key, reg, values in ctx.consts:
+		if key not in ctx.used:
+			# never referenced (or all the reads are folded)
+			continue
+		globals_lines.append('static const {0} {1} = {2};'.format(
+			type_name, reg, values[0] if len(values) == 1 else '{0}({1})'.format(type_name, ', '.join(values))
+		))
+
+	default_semantics = _default_semantics[ctx.shader_type]
+	inputs = list()  # type: List[str]
+	outputs = list()  # type: List[str]
+	local_regs = dict()  # type: Dict[str, List[str]]
+	for literal, index in _reg_key_sorted(used):
+		if literal in _uniform_literals:
+			continue
+		reg = literal if index is None else '{0}{1}'.format(literal, index)
+		is_input = literal in _input_literals
+		if not(is_input or literal.startswith('o')):
+			local_regs.setdefault(_reg_decl_type(ctx, literal), list()).append(reg)
+			continue
+		semantic = ctx.semantics.get((literal, index))
+		if semantic is None and literal in default_semantics:
+			semantic = default_semantics[literal] + ('' if index is None else str(index))
+		(inputs if is_input else outputs).append('{0} {1} {2}{3}'.format(
+			'in' if is_input else 'out',
+			_reg_decl_type(ctx, literal),
+			reg,
+			' : ' + semantic if semantic else ''
+		))
+
+	locals_lines = [
+		'{0} {1};'.format(type_name, ', '.join(regs))
+		for type_name, regs in sorted(local_regs.items())
+	]
+	return globals_lines, inputs + outputs, locals_lines
+
+# endregion
+
+
+def _tr_predicated(
+	ctx,  # type: _TranslationContext
+	translate,  # type: Callable[[_TranslationContext, AsmOp, Tuple[_str_h, ...]], Any]
+	op,  # type: AsmOp
+	args,  # type: Tuple[_str_h, ...]
+	pred,  # type: _str_h
+	negated  # type: bool
+):
+	"""
+	A predicated instruction ('(p0) mov r0, r1', see `_split_predicate()`):
+	each component of the destination is written only if the matching component
+	of the predicate is on.
+
+	If all the written components depend on the same predicate component,
+	the instruction is just put under `if (p0.x)`. Otherwise, the previous value
+	of the destination is kept and the components are selected afterwards.
+	"""
+	pred_operand = _parse_operand(pred)
+	pred_name = ctx.reg_name(pred_operand)
+	pred_swizzle = pred_operand.swizzle or 'xyzw'
+	neg = '!' if negated else ''
+	statements = translate(ctx, op, args)
+	if statements is None:
+		return None
+	if not isinstance(statements, list):
+		statements = [statements]
+
+	dest_operand = _parse_operand(args[0]) if args and op.base not in _op_no_dest else None
+	mask = 'x'
+	if dest_operand is not None and dest_operand.swizzle is not None:
+		mask = ctx.dest(args[0])[1]
+	pred_components = _swizzle_suffix(pred_swizzle, mask).lstrip('.') or 'xyzw'
+	if len(set(pred_components)) == 1:
+		res = ['if ({0}{1}.{2}) {{'.format(neg, pred_name, pred_components[0])]
+		res.extend('\t' + st for st in statements)
+		res.append('}')
+		return res
+
+	prev_reg = ctx.reg_name(dest_operand)
+	dest = ctx.dest(args[0])[0]
+	suffix = '' if mask == 'xyzw' else '.' + mask
+	res = ['{', '\t{0} prev = {1};'.format(_reg_decl_type(ctx, dest_operand.reg), prev_reg)]
+	res.extend('\t' + st for st in statements)
+	pred_suffix = '' if pred_components == 'xyzw' else '.' + pred_components
+	res.append('\t{0} = {1}{2}{3} ? {0} : prev{4};'.format(dest, neg, pred_name, pred_suffix, suffix))
+	res.append('}')
+	return res
+
+
+def _hlsl_code(
+	shader_type,  # type: ShaderType
+	shader_model,  # type: int  # not used yet 'cause the script only handles SM 3.0, could be anything for now
+	pre_comments,  # type: List[str]
+	code_lines,  # type: Sequence[LineData]  # a list or `CompactLines`
+	post_comments,  # type: List[str]
+	fold_consts=False
+):
+	"""
+	The main function which actually performs ASM->HLSL code conversion.
+	It takes lines as multiple arguments, pre-processed to detect their grouping
+	and in-line basic structure. And therefore is called from the other, higher-level func.
+	All the arguments are mandatory, but empty lists or zero SM can be provided.
+
+	Each instruction is translated by the function from `_op_translators` dispatch table.
+	Ops and operands are parsed only once per unique string, so even the blocks
+	with thousands of instructions take a single pass over the lines.
+	An instruction which can't be translated is kept as an error comment,
+	which is also the case for all the subroutine instructions (`call`, `callnz`, `label`).
+
+	:param shader_model: integer representing SM multiplied by 10. I.e., 14, 20, 30, 35
+	:param fold_consts:
+		Put the values of inline `def` constants right into expressions,
+		instead of declaring them as static constants.
+	"""
+
+	error_start = '// ERROR ASM-> HLSL: '
+
+	if not(shader_type and shader_type in all_shader_types):
+		return [error_start + 'Unknown shader type']
+
+	declared_vars, pre_comments = _extract_var_names(pre_comments)
+	names, mapped_vars = _register_names(declared_vars)
+	rel_literals = {
+		_parse_operand(arg).reg
+		for line in code_lines if line.args
+		for arg in line.args if '[' in arg
+	}  # type: Set[str]
+	ctx = _TranslationContext(shader_type, names, rel_literals, fold_consts)
+
+	body = list()  # type: List[str]
+	indent = 1
+	translators = _op_translators
+	for op_str, args, comment in code_lines:
+		if op_str is None:
+			if comment:
+				body.append('\t' * indent + comment)
+			continue
+
+		pred, negated, instr_str, instr_args = _split_predicate(op_str, args)
+		op = _parse_op(instr_str)
+		dedent, indent_after = _op_indent.get(op.base, (0, 0))
+		indent = max(indent + dedent, 1)
+		translate = translators.get(op.base)
+		try:
+			if translate is None:
+				raise KeyError(op.base)
+			if pred is None:
+				statements = translate(ctx, op, instr_args if instr_args else ())
+			else:
+				statements = _tr_predicated(ctx, translate, op, instr_args, pred, negated)
+		except (IndexError, KeyError, ValueError):
+			statements = '{0}{1} {2}'.format(error_start, op_str, ', '.join(args) if args else '')
+		if statements is None:
+			if comment:
+				body.append('\t' * indent + comment)
+			statements = ()
+		elif not isinstance(statements, list):
+			statements = (statements, )
+		body.extend('\t' * indent + st for st in statements)
+		if comment and statements:
+			body[-1] += '  ' + comment
+		indent += indent_after
+
+	globals_lines, params, locals_lines = _translate_declarations(ctx, mapped_vars)
+
+	res = list(pre_comments)  # type: List[str]
+	if globals_lines:
+		res.append('')
+		res.extend(globals_lines)
+	res.append('')
+	res.append('void {0}('.format(shader_type.name))
+	res.extend('\t{0}{1}'.format(p, ',' if i < len(params) - 1 else '') for i, p in enumerate(params))
+	res.append(')')
+	res.append('{')
+	res.extend('\t' + l for l in locals_lines)
+	res.extend(body)
+	res.append('}')
+	res.extend(post_comments)
+	return res
+
+
+# region Deduplication of identical shader blocks
+
+def _normalized_comment(
+	comment  # type: Optional[_str_h]
+):
+	return ' '.join(comment.split()) if comment else ''
+
+
+class ShaderDedup(object):
+	"""
+	A cache of converted shader blocks, to convert each unique block only once.
+
+	Dumps usually contain lots of blocks which are the same, up to whitespaces.
+	Each block (its type, SM, code and comments) is normalized and hashed,
+	and the HLSL generated for the first occurrence is reused for all the others.
+
+	At most `max_size` of the most recently used blocks are kept (all of them, if it's 0),
+	so a long-living cache (like the process-wide one) doesn't grow with the corpus.
+	"""
+	def __init__(
+		self,
+		max_size=4096  # type: int
+	):
+		super(ShaderDedup, self).__init__()
+		self.max_size = max_size
+		self.__converted = _OrderedDict()  # type: Dict[str, Tuple[str, ...]]
+		self.blocks = 0  # all the blocks passed through `convert()`
+		self.converted = 0  # the blocks which were actually converted
+
+	@staticmethod
+	def block_key(
+		shader_type,  # type: ShaderType
+		shader_model,  # type: int
+		pre_comments,  # type: List[str]
+		code_lines,  # type: Sequence[LineData]
+		post_comments  # type: List[str]
+	):
+		"""
+		The hash of a normalized shader block.
+		"""
+		import hashlib
+		hasher = hashlib.sha1()
+
+		def update(
+			string  # type: _str_h
+		):
+			hasher.update((
+				string if isinstance(string, bytes) else string.encode('utf-8')
+			) + b'\n')
+
+		update('{0} {1}'.format(shader_type.name if shader_type else '', shader_model))
+		for c in pre_comments:
+			update(_normalized_comment(c))
+		update('')
+		for op, args, comment in code_lines:
+			update('{0} {1} {2}'.format(
+				op or '',
+				', '.join(args) if args else '',
+				_normalized_comment(comment)
+			))
+		update('')
+		for c in post_comments:
+			update(_normalized_comment(c))
+		return hasher.hexdigest()
+
+	def convert(
+		self,
+		shader_type,  # type: ShaderType
+		shader_model,  # type: int
+		pre_comments,  # type: List[str]
+		code_lines,  # type: Sequence[LineData]
+		post_comments,  # type: List[str]
+		fold_consts=False
+	):
+		"""
+		The drop-in replacement for `_hlsl_code()`, returning the cached result for duplicates.
+		It's a tuple, since the same one is returned for all of them.
+		"""
+		key = ShaderDedup.block_key(shader_type, shader_model, pre_comments, code_lines, post_comments)
+		if fold_consts:
+			key += '-folded'
+		self.blocks += 1
+		converted = self.__converted
+		try:
+			res = converted.pop(key)
+		except KeyError:
+			res = tuple(_hlsl_code(shader_type, shader_model, pre_comments, code_lines, post_comments, fold_consts))
+			self.converted += 1
+			while len(converted) >= self.max_size > 0:
+				converted.popitem(last=False)
+		# the most recently used is the last one:
+		converted[key] = res
+		return res
+
+	@property
+	def ratio(self):
+		"""
+		How many blocks are there per each actually converted one.
+		"""
+		return self.blocks / float(self.converted) if self.converted else 1.0
+
+	def __repr__(self):
+		return '<ShaderDedup: {0} blocks, {1} converted, ratio: {2:.2f}>'.format(
+			self.blocks, self.converted, self.ratio
+		)
+
+
+# The cache shared by all the files converted by `parse()` in the current process:
+_process_dedup = ShaderDedup()
+
+# endregion
+
+
+# region Register dataflow: def-use chains and liveness of register components
+
+# Registers, which values are tracked:
+dataflow_registers = {
+	VsRegister.r, VsRegister.a, VsRegister.p, VsRegister.o,
+	PsRegister.r, PsRegister.p, PsRegister.oC, PsRegister.oDepth,
+}  # type: Set[AnyRegister]
+# ... and those of them, which are the shader's output (all the values they have at the end are used):
+dataflow_live_out = {VsRegister.o, PsRegister.oC, PsRegister.oDepth}  # type: Set[AnyRegister]
+
+# Components read from each source (in the order of args after the destination).
+# None means the components written to the destination (a component-wise op).
+# Any op not listed here is component-wise.
+_op_read_masks = {
+	'dp2add': ('xy', 'xy', 'w'),
+	'dp3': ('xyz', 'xyz'),
+	'dp4': ('xyzw', 'xyzw'),
+	'crs': ('xyz', 'xyz'),
+	'nrm': ('xyzw', ),
+	'dst': ('xyzw', 'xyzw'),
+	'lit': ('xyzw', ),
+	'rcp': ('w', ), 'rsq': ('w', ), 'exp': ('w', ), 'expp': ('w', ), 'log': ('w', ), 'logp': ('w', ),
+	'pow': ('w', 'w'),
+	'sincos': ('w', 'xyzw', 'xyzw'),
+	'm4x4': ('xyzw', 'xyzw'), 'm4x3': ('xyzw', 'xyzw'),
+	'm3x4': ('xyz', 'xyz'), 'm3x3': ('xyz', 'xyz'), 'm3x2': ('xyz', 'xyz'),
+	'texld': ('xyzw', 'xyzw', 'xyzw', 'xyzw'),
+	'texldp': ('xyzw', 'xyzw'),
+	'texldb': ('xyzw', 'xyzw'),
+	'texldl': ('xyzw', 'xyzw'),
+	'texldd': ('xyzw', 'xyzw', 'xyzw', 'xyzw'),
+}  # type: Dict[str, Tuple[Optional[str], ...]]
+# the number of consecutive registers read by the matrix source (the 2nd one):
+_op_matrix_rows = {'m4x4': 4, 'm4x3': 3, 'm3x4': 4, 'm3x3': 3, 'm3x2': 2}
+# ops without a destination: all the args are sources, with the given components read:
+_op_no_dest = {
+	'if': 'x', 'break': 'x', 'breakp': 'x', 'callnz': 'x',
+	'texkill': 'xyzw', 'rep': 'xyzw', 'loop': 'xyzw',
+}  # type: Dict[str, str]
+_op_no_dataflow = {
+	'vs', 'ps', 'dcl', 'def', 'defi', 'defb', 'nop',
+	'else', 'endif', 'endrep', 'endloop', 'call', 'label', 'ret',
+}
+_op_loop_start = {'rep', 'loop'}
+_op_loop_end = {'endrep', 'endloop'}
+# subroutines aren't modeled, the blocks with them aren't analyzed (see `RegisterDataflow.analyzable`):
+_op_subroutines = {'call', 'callnz', 'label'}
+
+_re_rel_register = _re.compile('([a-zA-Z]+)(\d*)(?:\.([xyzw]))?')
+
+_read_components_cache = dict()  # type: Dict[Tuple[str, str], Tuple[int, ...]]
+
+
+def _read_components(
+	swizzle,  # type: str
+	mask  # type: str
+):
+	"""
+	Indices of the components actually read from a source with the given swizzle,
+	for the given write mask: 'r0.wzyx' written to '.xz' -> (1, 3).
+	"""
+	key = (swizzle, mask)
+	try:
+		return _read_components_cache[key]
+	except KeyError:
+		pass
+	expanded = swizzle + swizzle[-1] * (4 - len(swizzle)) if swizzle else 'xyzw'
+	res = tuple(sorted({_component_i[expanded[_component_i[c]]] for c in mask}))
+	_read_components_cache[key] = res
+	return res
+
+
+def _union(
+	a,  # type: List[int]
+	b  # type: List[int]
+):
+	if a is b or not b:
+		return a
+	if not a:
+		return b
+	return a + [x for x in b if x not in a]
+
+
+class RegisterDataflow(object):
+	"""
+	Def-use chains and live ranges of each register component in a single shader block.
+
+	It's built in a single pass over the code lines. All the results are stored
+	in flat integer arrays:
+		*
+			each component of each tracked register is a 'slot':
+			`register id * 4 + component index`;
+		*
+			`def_line`/`def_slot`: each write of a component (a 'def'),
+			in the order of lines;
+		* `use_line`/`use_slot`: the same for each read (a 'use');
+		*
+			`use_defs`: CSR-like mapping of each use to the defs it can read
+			(`use_defs_from[u]:use_defs_from[u+1]` range). Usually it's just one,
+			but there could be more with the flow control;
+		* `def_uses`: the same, in reverse;
+		*
+			`def_last`: the last line each def is still live at (-1 if it's never read).
+			The values of output registers, reaching the end, are live till `len(code_lines)`.
+
+	Flow control is handled conservatively: a write inside an `if` doesn't kill
+	the previous value, and the values read inside a loop are also reached
+	by the writes later in the loop body (from the previous iteration).
+	The same way, a predicated write ('(p0) mov r0, r1') doesn't kill the previous value,
+	and the predicate register is read by it.
+
+	Subroutines (`call`/`callnz`/`label`) aren't modeled: such a block has `analyzable` off,
+	and all of it's writes are considered live till the end.
+
+	Line indices are the ones in the given `code_lines` sequence.
+	"""
+	def __init__(
+		self,
+		shader_type,  # type: ShaderType
+		code_lines,  # type: Sequence[LineData]
+		registers=None  # type: Optional[Set[AnyRegister]]
+	):
+		super(RegisterDataflow, self).__init__()
+		from array import array
+
+		if registers is None:
+			registers = dataflow_registers
+		reg_types = register_type[shader_type]
+		self.shader_type = shader_type
+		self.num_lines = len(code_lines)
+		self.registers = list()  # type: List[Tuple[str, Optional[int]]]
+
+		self.def_line = array('i')
+		self.def_slot = array('i')
+		self.use_line = array('i')
+		self.use_slot = array('i')
+		self.def_last = array('i')
+		def_live_out = array('b')
+
+		# (use, def) pairs, in the order they're found:
+		pair_use = array('i')
+		pair_def = array('i')
+
+		reg_ids = dict()  # type: Dict[Tuple[str, Optional[int]], Optional[int]]
+		scalars = _scalar_literals[shader_type]
+		out_regs = set()  # type: Set[int]
+
+		def reg_id(
+			literal,  # type: str
+			index  # type: Optional[int]
+		):
+			key = (literal, index)
+			try:
+				return reg_ids[key]
+			except KeyError:
+				pass
+			reg_type = reg_types.get(literal)
+			if reg_type not in registers:
+				res = None
+			else:
+				res = len(self.registers)
+				self.registers.append(key)
+				if reg_type in dataflow_live_out:
+					out_regs.add(res)
+			reg_ids[key] = res
+			return res
+
+		reaching = dict()  # type: Dict[int, List[int]]
+		# Flow-control frames. Each one is a list:
+		# is loop, the first def id inside, values before the frame (per each slot written inside it),
+		# values at the end of 'then' branch / at each `break`, uses of the values coming into the loop.
+		frames = list()  # type: List[list]
+		loop_frames = list()  # type: List[list]
+
+		def read(
+			slot,  # type: int
+			line_i  # type: int
+		):
+			use_i = len(self.use_line)
+			self.use_line.append(line_i)
+			self.use_slot.append(slot)
+			defs = reaching.get(slot)
+			if defs:
+				for d in defs:
+					pair_use.append(use_i)
+					pair_def.append(d)
+					if self.def_last[d] < line_i:
+						self.def_last[d] = line_i
+			for frame in loop_frames:
+				first_def = frame[1]
+				if not defs or min(defs) < first_def:
+					frame[4].setdefault(slot, list()).append(use_i)
+
+		def write(
+			slot,  # type: int
+			line_i,  # type: int
+			conditional=False
+		):
+			def_i = len(self.def_line)
+			self.def_line.append(line_i)
+			self.def_slot.append(slot)
+			self.def_last.append(-1)
+			def_live_out.append(0)
+			if frames:
+				frames[-1][2].setdefault(slot, reaching.get(slot, list()))
+			reaching[slot] = _union(reaching.get(slot, list()), [def_i]) if conditional else [def_i]
+
+		def operand_slots(
+			arg,  # type: _str_h
+			mask,  # type: str
+			offset=0
+		):
+			operand = _parse_operand(arg)
+			res = list()  # type: List[int]
+			if operand.swizzle is None:
+				return res
+			if operand.rel:
+				m = _re_rel_register.match(operand.rel)
+				if m:
+					literal, index, component = m.groups()
+					rel_id = reg_id(literal, int(index) if index else None)
+					if rel_id is not None:
+						res.append(rel_id * 4 + (_component_i[component] if component else 0))
+				return res
+			index = operand.index
+			r_id = reg_id(operand.reg, index if index is None else index + offset)
+			if r_id is None:
+				return res
+			if operand.reg in scalars:
+				res.append(r_id * 4)
+			else:
+				res.extend(r_id * 4 + c for c in _read_components(operand.swizzle, mask))
+			return res
+
+		def dest_slots(
+			arg  # type: _str_h
+		):
+			operand = _parse_operand(arg)
+			if operand.swizzle is None or operand.rel:
+				return list(), 'xyzw'
+			r_id = reg_id(operand.reg, operand.index)
+			if operand.reg in scalars:
+				return ([] if r_id is None else [r_id * 4]), 'x'
+			mask = operand.swizzle or 'xyzw'
+			if r_id is None:
+				return list(), mask
+			return [r_id * 4 + _component_i[c] for c in mask], mask
+
+		def pop_frame():
+			frame = frames.pop()
+			if frames:
+				parent_saved = frames[-1][2]
+				for slot, before in frame[2].items():
+					parent_saved.setdefault(slot, before)
+			return frame
+
+		def add_exit(
+			loop_frame  # type: list
+		):
+			# a `break`: the current values of all the slots written in the loop so far leave the loop
+			exits = loop_frame[3]
+			for frame in frames[frames.index(loop_frame):]:
+				for slot in frame[2]:
+					exits[slot] = _union(exits.get(slot, list()), reaching.get(slot, list()))
+
+		self.analyzable = True
+		for line_i, (op_str, args, comment) in enumerate(code_lines):
+			if op_str is None:
+				continue
+			pred, _, op_str, args = _split_predicate(op_str, args)
+			base = _parse_op(op_str).base
+			if not args:
+				args = ()
+			if base in _op_subroutines:
+				self.analyzable = False
+
+			if base in _op_no_dataflow:
+				if base == 'else' and frames and not frames[-1][0]:
+					frame = frames[-1]
+					saved = frame[2]
+					frame[3] = {slot: reaching.get(slot, list()) for slot in saved}
+					for slot, before in saved.items():
+						reaching[slot] = before
+				elif base == 'endif' and frames and not frames[-1][0]:
+					frame = pop_frame()
+					then_out = frame[3]
+					for slot, before in frame[2].items():
+						reaching[slot] = _union(then_out.get(slot, before), reaching.get(slot, list()))
+				elif base in _op_loop_end and loop_frames:
+					frame = loop_frames.pop()
+					while frames[-1] is not frame:
+						pop_frame()
+					first_def = frame[1]
+					saved = frame[2]
+					for slot, uses in frame[4].items():
+						# the back edge: the values at the end of the body are read by the next iteration...
+						for d in reaching.get(slot, ()):
+							if d < first_def:
+								continue
+							for u in uses:
+								pair_use.append(u)
+								pair_def.append(d)
+							if self.def_last[d] < line_i:
+								self.def_last[d] = line_i
+						# ... and the values coming into the loop are live till it's end
+						for d in saved.get(slot, reaching.get(slot, ())):
+							if d < first_def and self.def_last[d] < line_i:
+								self.def_last[d] = line_i
+					pop_frame()
+					exits = frame[3]
+					for slot, before in frame[2].items():
+						reaching[slot] = _union(
+							_union(before, reaching.get(slot, list())), exits.get(slot, list())
+						)
+				continue
+
+			if base in _op_no_dest:
+				mask = _op_no_dest[base]
+				for arg in args:
+					for slot in operand_slots(arg, mask):
+						read(slot, line_i)
+				if base in _op_loop_start:
+					frame = [True, len(self.def_line), dict(), dict(), dict()]
+					frames.append(frame)
+					loop_frames.append(frame)
+				elif base == 'if':
+					frames.append([False, len(self.def_line), dict(), dict(), None])
+				elif base in ('break', 'breakp') and loop_frames:
+					add_exit(loop_frames[-1])
+				continue
+
+			dest_list, dest_mask = dest_slots(args[0]) if args else (list(), 'xyzw')
+			if pred is not None:
+				for slot in operand_slots(pred, dest_mask):
+					read(slot, line_i)
+			read_masks = _op_read_masks.get(base, ())
+			rows = _op_matrix_rows.get(base)
+			for i, arg in enumerate(args[1:]):
+				mask = read_masks[i] if i < len(read_masks) else None
+				if mask is None:
+					mask = dest_mask
+				if rows and i == 1:
+					for row in _xrange(rows):
+						for slot in operand_slots(arg, mask, row):
+							read(slot, line_i)
+					continue
+				for slot in operand_slots(arg, mask):
+					read(slot, line_i)
+			for slot in dest_list:
+				write(slot, line_i, pred is not None)
+
+		# the values of outputs, reaching the end, are the result of the shader:
+		end_line = len(code_lines)
+		for slot, defs in reaching.items():
+			if slot // 4 not in out_regs:
+				continue
+			for d in defs:
+				def_live_out[d] = 1
+				self.def_last[d] = end_line
+		if not self.analyzable:
+			# any value could be read by a subroutine (or after it's called):
+			for d in _xrange(len(self.def_last)):
+				self.def_last[d] = end_line
+		self.def_live_out = def_live_out
+
+		self.use_defs_from, self.use_defs = RegisterDataflow.__csr(pair_use, pair_def, len(self.use_line))
+		self.def_uses_from, self.def_uses = RegisterDataflow.__csr(pair_def, pair_use, len(self.def_line))
+
+	@staticmethod
+	def __csr(
+		keys,  # type: Sequence[int]
+		values,  # type: Sequence[int]
+		num_keys  # type: int
+	):
+		"""
+		Group values by keys with a counting sort: offsets of each key's range, and the values themselves.
+		"""
+		from array import array
+		offsets = array('i', [0]) * (num_keys + 1)
+		for k in keys:
+			offsets[k + 1] += 1
+		for i in _xrange(num_keys):
+			offsets[i + 1] += offsets[i]
+		fill = array('i', offsets)
+		res = array('i', [0]) * len(values)
+		for k, v in _izip(keys, values):
+			res[fill[k]] = v
+			fill[k] += 1
+		return offsets, res
+
+	def slot_name(
+		self,
+		slot  # type: int
+	):
+		"""
+		Human-readable name of a register component: 'r0.x'.
+		"""
+		literal, index = self.registers[slot // 4]
+		return '{0}{1}.{2}'.format(literal, '' if index is None else index, 'xyzw'[slot % 4])
+
+	def slot(
+		self,
+		register,  # type: str
+		component='x'  # type: str
+	):
+		"""
+		Slot id of the given register component, None if it's not used in the block.
+		"""
+		literal = register.rstrip('0123456789')
+		index = register[len(literal):]
+		key = (literal, int(index) if index else None)
+		try:
+			return self.registers.index(key) * 4 + _component_i[component]
+		except ValueError:
+			return None
+
+	def uses_of(
+		self,
+		def_i  # type: int
+	):
+		return self.def_uses[self.def_uses_from[def_i]:self.def_uses_from[def_i + 1]]
+
+	def defs_of(
+		self,
+		use_i  # type: int
+	):
+		return self.use_defs[self.use_defs_from[use_i]:self.use_defs_from[use_i + 1]]
+
+	def is_dead(
+		self,
+		def_i  # type: int
+	):
+		"""
+		Whether the value written by this def is never read.
+		"""
+		return self.def_last[def_i] < 0
+
+	def dead_defs(self):
+		return [d for d, last in enumerate(self.def_last) if last < 0]
+
+	def live_ranges(
+		self,
+		slot  # type: int
+	):
+		"""
+		Merged ranges of lines (first, last) where the given register component holds a live value.
+		"""
+		ranges = sorted(
+			(self.def_line[d], last)
+			for d, last in enumerate(self.def_last)
+			if last >= 0 and self.def_slot[d] == slot
+		)
+		res = list()  # type: List[Tuple[int, int]]
+		for first, last in ranges:
+			if res and first <= res[-1][1]:
+				if last > res[-1][1]:
+					res[-1] = (res[-1][0], last)
+				continue
+			res.append((first, last))
+		return res
+
+	def __repr__(self):
+		return '<RegisterDataflow: {0} registers, {1} defs, {2} uses>'.format(
+			len(self.registers), len(self.def_line), len(self.use_line)
+		)
+
+
+# Analysis results for the recently seen blocks, by their hash:
+_dataflow_cache = dict()  # type: Dict[str, RegisterDataflow]
+_dataflow_cache_size = 1024
+
+
+def register_dataflow(
+	shader_type,  # type: ShaderType
+	code_lines  # type: Sequence[LineData]
+):
+	"""
+	`RegisterDataflow` of the given block, cached by the hash of it's code lines.
+	So the analysis is done only once for all the identical blocks.
+	"""
+	key = ShaderDedup.block_key(shader_type, 0, [], code_lines, [])
+	try:
+		return _dataflow_cache[key]
+	except KeyError:
+		pass
+	res = RegisterDataflow(shader_type, code_lines)
+	if len(_dataflow_cache) >= _dataflow_cache_size:
+		_dataflow_cache.clear()
+	_dataflow_cache[key] = res
+	return res
+
+# endregion
+
+
+# region Optimization of shader blocks: dead writes and redundant moves
+
+# ops, which aren't actual instructions executed by GPU:
+_op_not_instructions = {'vs', 'ps', 'dcl', 'def', 'defi', 'defb', 'nop', 'label'}
+_op_flow_control = {'if', 'else', 'endif', 'rep', 'endrep', 'loop', 'endloop', 'break', 'breakp', 'call', 'callnz', 'ret'}
+
+
+def instruction_count(
+	code_lines  # type: Iterable[LineData]
+):
+	"""
+	The number of actual instructions in the block (no declarations, comments or empty lines).
+	"""
+	not_instructions = _op_not_instructions
+	return sum(
+		1 for line in code_lines
+		if line.op is not None and _parse_op(line.op).base not in not_instructions
+	)
+
+
+def _dest_with_mask(
+	arg,  # type: _str_h
+	mask  # type: str
+):
+	operand = _parse_operand(arg)
+	return '{0}{1}.{2}'.format(operand.reg, '' if operand.index is None else operand.index, mask)
+
+
+def _remove_dead_writes(
+	lines,  # type: List[LineData]
+	flow  # type: RegisterDataflow
+):
+	"""
+	Remove the instructions which write only the values never read,
+	and narrow the write mask of those which write some of them.
+
+	:return: the new list of lines, None if nothing has changed.
+	"""
+	changed = False
+	res = list()  # type: List[LineData]
+	def_line, def_last, def_slot = flow.def_line, flow.def_last, flow.def_slot
+	num_defs = len(def_line)
+	d = 0
+	for line_i, line in enumerate(lines):
+		if d >= num_defs or def_line[d] != line_i:
+			res.append(line)
+			continue
+		live = list()  # type: List[int]
+		num = 0
+		while d < num_defs and def_line[d] == line_i:
+			if def_last[d] >= 0:
+				live.append(def_slot[d] % 4)
+			num += 1
+			d += 1
+		if len(live) == num:
+			res.append(line)
+			continue
+		changed = True
+		if not live:
+			continue
+		mask = ''.join(['xyzw'[c] for c in live])
+		res.append(LineData(line.op, (_dest_with_mask(line.args[0], mask), ) + tuple(line.args[1:]), line.comment))
+	return res if changed else None
+
+
+def _collapse_moves(
+	lines,  # type: List[LineData]
+	flow  # type: RegisterDataflow
+):
+	"""
+	Remove the `mov` instructions, which just copy the value computed by
+	the previous instruction and not used anywhere else: that instruction
+	writes directly to the `mov` destination instead.
+	Also, remove moves of a register to itself.
+
+	:return: the new list of lines, None if nothing has changed.
+	"""
+	from array import array
+
+	num_lines = len(lines)
+	# the range of uses in each line:
+	uses_from = array('i', [-1]) * (num_lines + 1)
+	uses_to = array('i', [0]) * (num_lines + 1)
+	for use_i, line_i in enumerate(flow.use_line):
+		if uses_from[line_i] < 0:
+			uses_from[line_i] = use_i
+		uses_to[line_i] = use_i + 1
+	defs_from = dict()  # type: Dict[int, int]
+	defs_num = dict()  # type: Dict[int, int]
+	for def_i, line_i in enumerate(flow.def_line):
+		defs_from.setdefault(line_i, def_i)
+		defs_num[line_i] = defs_num.get(line_i, 0) + 1
+
+	replaced = dict()  # type: Dict[int, Optional[LineData]]
+	for line_i, line in enumerate(lines):
+		if line.op is None or not line.args or len(line.args) != 2:
+			continue
+		op = _parse_op(line.op)
+		if op.base != 'mov' or op.shift or line_i in replaced:
+			continue
+		dest = _parse_operand(line.args[0])
+		src = _parse_operand(line.args[1])
+		if src.swizzle is None or src.neg or src.mod or src.rel or dest.rel:
+			continue
+		mask = dest.swizzle or 'xyzw'
+		if _read_components_ordered(src.swizzle, mask) != [_component_i[c] for c in mask]:
+			continue  # not the same components
+		if (src.reg, src.index) == (dest.reg, dest.index):
+			if not op.sat:
+				replaced[line_i] = None
+			continue
+
+		first_use, last_use = uses_from[line_i], uses_to[line_i]
+		if first_use < 0 or line_i not in defs_from:
+			continue  # not tracked registers
+		# each component is read from the value written by the same single line:
+		producer = None
+		for use_i in _xrange(first_use, last_use):
+			defs = flow.defs_of(use_i)
+			if len(defs) != 1 or len(flow.uses_of(defs[0])) != 1:
+				producer = None
+				break
+			p_line = flow.def_line[defs[0]]
+			if producer is None:
+				producer = p_line
+			elif producer != p_line:
+				producer = None
+				break
+		if producer is None or producer >= line_i or producer in replaced:
+			continue
+		# ... which writes only these components:
+		if defs_num.get(producer) != last_use - first_use:
+			continue
+		p_line = lines[producer]
+		p_op = _parse_op(p_line.op)
+		if (_parse_operand(p_line.args[0]).swizzle or 'xyzw') != mask:
+			continue
+		# the destination isn't touched in between:
+		dest_key = (dest.reg, dest.index)
+		clean = True
+		for between in lines[producer + 1:line_i]:
+			if between.op is None:
+				continue
+			if _parse_op(between.op).base in _op_flow_control:
+				clean = False
+				break
+			for arg in between.args or ():
+				operand = _parse_operand(arg)
+				if operand.rel or (operand.reg, operand.index) == dest_key:
+					clean = False
+					break
+			if not clean:
+				break
+		if not clean:
+			continue
+
+		new_op = p_line.op + '_sat' if op.sat and not p_op.sat else p_line.op
+		replaced[producer] = LineData(new_op, (line.args[0], ) + tuple(p_line.args[1:]), p_line.comment or line.comment)
+		replaced[line_i] = None
+
+	if not replaced:
+		return None
+	res = list()  # type: List[LineData]
+	for line_i, line in enumerate(lines):
+		if line_i in replaced:
+			line = replaced[line_i]
+			if line is None:
+				continue
+		res.append(line)
+	return res
+
+
+_op_not_optimizable = _op_subroutines | {'ret'}
+
+
+def _is_optimizable(
+	code_lines  # type: Sequence[LineData]
+):
+	for op_str, args, comment in code_lines:
+		if op_str is None:
+			continue
+		if op_str.startswith('(') or _parse_op(op_str).base in _op_not_optimizable:
+			return False
+	return True
+
+
+def optimize_block(
+	shader_type,  # type: ShaderType
+	code_lines,  # type: Sequence[LineData]
+	max_passes=16
+):
+	"""
+	Simplify the code of a single shader block, using `RegisterDataflow`:
+		*
+			instructions writing only the values which are never read are removed,
+			the write mask is narrowed for those which write some of them;
+		*
+			a `mov` copying the result of the previous instruction is removed,
+			and that instruction writes to the `mov` destination directly.
+
+	Both are repeated until nothing changes, since each removal may make more writes dead.
+	The `def` constants are folded into expressions at the translation stage
+	(see `_hlsl_code()` `fold_consts` argument).
+
+	Blocks with subroutines or predicated instructions are returned as-is:
+	the removals don't account for them yet.
+
+	:return: new list of code lines, and the number of instructions before and after.
+	"""
+	lines = list(code_lines)
+	before = instruction_count(lines)
+	if not _is_optimizable(lines):
+		return lines, before, before
+	flow = register_dataflow(shader_type, lines)
+	for _ in _xrange(max_passes):
+		new_lines = _remove_dead_writes(lines, flow)
+		if new_lines is None:
+			new_lines = _collapse_moves(lines, flow)
+			if new_lines is None:
+				break
+		lines = new_lines
+		flow = RegisterDataflow(shader_type, lines)
+	return lines, before, instruction_count(lines)
+
+# endregion
+
+
+# region Output
+
+class HlslWriter(object):
+	"""
+	Writes converted shader blocks to the output file as soon as each one is ready,
+	so the memory doesn't depend on the number of blocks.
+
+	Everything goes into a buffered temporary file next to the target,
+	which atomically replaces the target only when the writer is closed without errors.
+	So the previous output is kept intact if the conversion fails half-way.
+	The temporary file is created by the first block: if there's none, the target isn't touched at all.
+	Use it as a context manager.
+	"""
+	def __init__(
+		self,
+		out_path,  # type: _str_h
+		buffer_size=1 << 16  # type: int
+	):
+		super(HlslWriter, self).__init__()
+		self.out_path = out_path
+		self.blocks = 0
+		self.__buffer_size = buffer_size
+		self.__tmp_path = '{0}.{1}.tmp'.format(out_path, _os.getpid())
+		self.__file = None  # type: Optional[IO]
+		self.__closed = False
+
+	def write(
+		self,
+		hlsl_lines  # type: Iterable[str]
+	):
+		"""
+		Write a single converted block, separated from the previous one by an empty line.
+		"""
+		fl = self.__file
+		if fl is None:
+			if _py2:
+				# both byte-strings (from a read file) and unicode ones (from a mapped file) are written:
+				fl = open(self.__tmp_path, 'w', self.__buffer_size)
+			else:
+				import io
+				fl = io.open(self.__tmp_path, 'w', self.__buffer_size, encoding='utf-8')
+			self.__file = fl
+		if self.blocks:
+			fl.write('\n')
+		for line in hlsl_lines:
+			if _py2 and isinstance(line, _unicode):
+				line = line.encode('utf-8')
+			fl.write(line)
+			fl.write('\n')
+		self.blocks += 1
+
+	def close(self):
+		"""
+		Finish writing and replace the target file (if anything was written).
+		"""
+		if self.__closed:
+			return
+		self.__closed = True
+		if self.__file is None:
+			return
+		self.__file.close()
+		try:
+			replace = _os.replace
+		except AttributeError:
+			# py2: rename doesn't overwrite on Windows
+			if _os.name == 'nt' and _os.path.exists(self.out_path):
+				_os.remove(self.out_path)
+			replace = _os.rename
+		replace(self.__tmp_path, self.out_path)
+
+	def discard(self):
+		"""
+		Stop writing and remove the temporary file, keeping the previous output as is.
+		"""
+		self.__closed = True
+		if self.__file is None:
+			return
+		if not self.__file.closed:
+			self.__file.close()
+		if _os.path.exists(self.__tmp_path):
+			_os.remove(self.__tmp_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is None:
+			self.close()
+		else:
+			self.discard()
+
+	def __repr__(self):
+		return '<HlslWriter: {0} blocks to {1}>'.format(self.blocks, repr(self.out_path))
+
+# endregion
+
+
+def output_path(
+	file_path  # type: _str_h
+):
+	"""
+	The output '.hlsl' file for the given source one.
+	The source extension is kept ('x.ps' -> 'x.ps.hlsl'), so 'x.vs' and 'x.ps' don't overwrite each other.
+	"""
+	return file_path + out_ext
+
+
+def _print(
+	msg  # type: _str_h
+):
+	print(msg)
+
+
+def parse_file(
+	file_path,  # type: _str_h
+	print_path=False,
+	log_f=None,  # type: Optional[Callable[[_str_h], Any]]
+	compact=False,
+	dedup=None,  # type: Optional[ShaderDedup]
+	mapped=False,
+	optimize=False,
+	out_path=None  # type: Optional[_str_h]
+):
+	"""
+	Parse a single assembly file and convert it to an hlsl shader.
+
+	:param log_f:
+		Optional function receiving progress messages (when `print_path` is on).
+		They're just printed if not provided.
+	:param compact:
+		Keep the parsed lines as `CompactLines` instead of a list of `LineData`.
+		It's slower, but takes several times less memory on huge files.
+	:param dedup:
+		The cache which converts only unique shader blocks,
+		possibly shared by multiple files. Each block is converted if omitted.
+	:param mapped:
+		Don't read the whole file: memory-map it and parse each block
+		only when it's converted (see `MappedShaderFile`). `compact` is ignored then.
+	:param optimize:
+		Remove dead writes and redundant moves (see `optimize_block()`)
+		and fold `def` constants. The instruction counts of each block are reported.
+	:param out_path:
+		The output file, next to the source one by default (see `output_path()`).
+		Each block is written to it as soon as it's converted (see `HlslWriter`).
+	:return:
+		With `optimize`, the number of instructions in each block, before and after.
+		None otherwise.
+	"""
+	if not _os.path.isfile(file_path):
+		return
+
+	log = _print if log_f is None else log_f
+	if print_path:
+		log('Reading: ' + file_path)
+
+	# file_path = r'E:\1-Projects\SFM\_Tools\dx-shader-decompiler\ME-face-0.ps'
+
+	ext = _os.path.splitext(file_path)[-1].lower()
+
+	convert_f = _hlsl_code if dedup is None else dedup.convert
+	instruction_counts = list() if optimize else None  # type: Optional[List[Tuple[int, int]]]
+
+	def convert(
+		shader_type,  # type: ShaderType
+		shader_model,  # type: int
+		pre_comments,  # type: List[str]
+		code_lines,  # type: Sequence[LineData]
+		post_comments  # type: List[str]
+	):
+		if not optimize:
+			return convert_f(shader_type, shader_model, pre_comments, code_lines, post_comments)
+		code_lines, before, after = optimize_block(shader_type, code_lines)
+		instruction_counts.append((before, after))
+		log('\tShader {0} ({1}, SM {2}): {3} -> {4} instructions'.format(
+			len(instruction_counts), shader_type.name if shader_type else '?', shader_model, before, after
+		))
+		return convert_f(shader_type, shader_model, pre_comments, code_lines, post_comments, True)
+
+	if out_path is None:
+		out_path = output_path(file_path)
+
+	if mapped:
+		with MappedShaderFile(file_path) as mapped_file:
+			if print_path:
+				log('\tParsing... ' + file_path)
+			with HlslWriter(out_path) as out_file:
+				for block in mapped_file:
+					out_file.write(convert(*block))
+		return instruction_counts
+
+	with open(file_path, 'r') as fl:
+		text = fl.read()
+	if compact:
+		lines = CompactLines(text)  # type: Sequence[LineData]
+	else:
+		lines = list(_lex_text(text))  # type: Sequence[LineData]
+	del text
+
+	if print_path and lines:
+		log('\tParsing... ' + file_path)
+	with HlslWriter(out_path) as out_file:
+		for pre_c_r, code_r, post_c_r in _iter_shader_ranges(lines, ext):  # type: (Optional[Range], CodeBlock, Optional[Range])
+			pre_comments = (
+				[l.comment for l in lines[pre_c_r.first:pre_c_r.last+1]]
+				if pre_c_r
+				else list()
+			)  # type: List[str]
+
+			post_comments = (
+				[l.comment for l in lines[post_c_r.first:post_c_r.last+1]]
+				if post_c_r
+				else list()
+			)  # type: List[str]
+
+			shader_type, shader_model, code_first, code_last = code_r  # type: (ShaderType, int, int, int)
+			out_file.write(
+				convert(shader_type, shader_model, pre_comments, lines[code_first:code_last+1], post_comments)
+			)
+	del lines
+	return instruction_counts
+
+
+def is_proper_input_file(file_path):
+	"""
+	Whether the given file path seems to be an HLSL-assembly file.
+	"""
 	if not _os.path.isfile(file_path):
 		return False
 	# file_path = r'E:\1-Projects\SFM\_Tools\dx-shader-decompiler\ME-face-1.ps'
@@ -1191,23 +3408,704 @@ def is_proper_input_file(file_path):
 	return (not ext) or ext.lower() in in_extensions
 
 
-def parse(path, print_paths=False):
+# region Incremental conversion: skip files which haven't changed since the last run
+
+def _file_hash(
+	file_path,  # type: _str_h
+	chunk_size=1024*1024
+):
+	"""
+	Hex-digest of the file contents.
+	"""
+	import hashlib
+	hasher = hashlib.sha1()
+	with open(file_path, 'rb') as fl:
+		chunk = fl.read(chunk_size)
+		while chunk:
+			hasher.update(chunk)
+			chunk = fl.read(chunk_size)
+	return hasher.hexdigest()
+
+
+def _manifest_path(
+	folder  # type: _str_h
+):
+	return _os.path.join(_os.path.abspath(folder), manifest_file_name)
+
+
+def load_manifest(
+	folder  # type: _str_h
+):
+	"""
+	Read the manifest of the previous conversion in the given folder.
+
+	:return:
+		`dict` mapping each source file name to the hash of the contents
+		it had when it was converted.
+		Only the entries made by the current `converter_version` are kept.
+		A missing/broken manifest is the same as an empty one.
+	"""
+	import json
+	try:
+		with open(_manifest_path(folder), 'r') as fl:
+			data = json.load(fl)
+		files = data['files']  # type: Dict[_str_h, Dict[str, Any]]
+		return {
+			nm: entry['hash'] for nm, entry in files.items()
+			if entry.get('version') == converter_version
+		}  # type: Dict[_str_h, str]
+	except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+		return dict()
+
+
+def save_manifest(
+	folder,  # type: _str_h
+	hashes  # type: Dict[_str_h, str]
+):
+	"""
+	Write the manifest for the given folder (see `load_manifest()`).
+	"""
+	import json
+	data = {
+		'files': {
+			nm: {'hash': h, 'version': converter_version}
+			for nm, h in hashes.items()
+		}
+	}
+	with open(_manifest_path(folder), 'w') as fl:
+		json.dump(data, fl, indent=1, sort_keys=True)
+
+# endregion
+
+
+ParseResult = _namedtuple(
+	'ParseResult',
+	['path', 'messages', 'error', 'src_hash', 'skipped', 'blocks', 'converted', 'instructions']
+)  # type: (_str_h, List[_str_h], Optional[_str_h], Optional[str], bool, int, int, Optional[List[Tuple[int, int]]])
+
+
+def _parse_file_task(
+	task  # type: Tuple[_str_h, bool, Optional[str], bool, bool]
+):
+	"""
+	A single independent task for `parse()`.
+	It's a top-level function with a single argument, so it can be sent to a process pool.
+
+	The task is: file path, whether to print it, the hash it had
+	when it was converted last time (`None` if it wasn't), whether to deduplicate blocks
+	and whether to optimize them.
+	If the file is still the same and it's output is there, conversion is skipped.
+	The optimized conversion has a different hash, so switching it on/off re-converts the file.
+	Duplicate blocks are detected among all the files converted by the same process.
+
+	Instead of printing, it collects all the messages (to be printed by the main process),
+	and it never raises: an error is returned as the formatted traceback.
+	"""
+	file_path, print_path, prev_hash, use_dedup, optimize = task
+	messages = list()  # type: List[_str_h]
+	error = None
+	src_hash = None
+	skipped = False
+	instructions = None
+	dedup = _process_dedup if use_dedup else None
+	blocks_before, converted_before = _process_dedup.blocks, _process_dedup.converted
+	try:
+		src_hash = _file_hash(file_path)
+		if optimize:
+			src_hash += '-optimized'
+		if (
+			src_hash == prev_hash and
+			_os.path.isfile(output_path(file_path))
+		):
+			skipped = True
+			if print_path:
+				messages.append('Up to date: ' + file_path)
+		else:
+			instructions = parse_file(file_path, print_path, messages.append, dedup=dedup, optimize=optimize)
+	except Exception:
+		import traceback
+		error = traceback.format_exc()
+	return ParseResult(
+		file_path, messages, error, src_hash, skipped,
+		_process_dedup.blocks - blocks_before,
+		_process_dedup.converted - converted_before,
+		instructions
+	)
+
+
+def parse(
+	path,  # type: _str_h
+	print_paths=False,
+	jobs=1,  # type: Optional[int]
+	use_cache=True,
+	dedup=True,
+	optimize=False
+):
+	"""
+	Convert either a single file or all the suitable files in a folder.
+
+	Each file is an independent task, so with multiple `jobs` files are converted
+	by a pool of processes. Both progress messages and results are still
+	reported in the same (stable) order as files are listed.
+
+	:param jobs:
+		The number of worker processes. 1 (default) means no pool at all.
+		`None` or 0 and less: the number of CPUs.
+	:param use_cache:
+		Skip the files which have the same contents as during the previous
+		conversion (by the same `converter_version`), and keep their previous output.
+		The hashes are stored in the `manifest_file_name` file in the folder.
+	:param dedup:
+		Convert each unique shader block only once (see `ShaderDedup`).
+		The cache is kept for the whole process, so it's shared by subsequent calls, too.
+		In the pool mode, each worker has its own cache.
+	:param optimize:
+		Optimize each shader block (see `parse_file()`) and report
+		the total number of instructions before and after.
+	:return:
+		`ParseResult` for each file which failed to convert
+		(the batch isn't aborted on errors).
+	"""
 	if not _os.path.isdir(path):
-		parse_file(path, print_paths)
+		# a bare file name has no dirname:
+		folder = _os.path.dirname(_os.path.abspath(path))
+		files = [path]
+	else:
+		folder = path
+		files = [_os.path.join(path, f) for f in sorted(_os.listdir(path))]
+		files = [f for f in files if is_proper_input_file(f)]
+		if print_paths and files:
+			print('\nFiles in folder: ' + path)
+
+	manifest = load_manifest(folder) if use_cache else dict()  # type: Dict[_str_h, str]
+	manifest_before = dict(manifest)
+	tasks = [
+		(f, print_paths, manifest.get(_os.path.basename(f)), dedup, optimize)
+		for f in files
+	]
+	if not (isinstance(jobs, int) and jobs > 0):
+		import multiprocessing
+		jobs = multiprocessing.cpu_count()
+	jobs = min(jobs, len(tasks))
+
+	blocks_stats = [0, 0]  # all / converted
+	instructions_stats = [0, 0]  # before / after optimization
+
+	def report(
+		results  # type: Iterable[ParseResult]
+	):
+		failed = list()  # type: List[ParseResult]
+		for res in results:
+			for msg in res.messages:
+				print(msg)
+			blocks_stats[0] += res.blocks
+			blocks_stats[1] += res.converted
+			for before, after in res.instructions or ():
+				instructions_stats[0] += before
+				instructions_stats[1] += after
+			nm = _os.path.basename(res.path)
+			if res.error:
+				print('\tFAILED: ' + res.path)
+				failed.append(res)
+				manifest.pop(nm, None)
+			elif res.src_hash:
+				manifest[nm] = res.src_hash
+		return failed
+
+	if jobs < 2:
+		failed_files = report(_parse_file_task(t) for t in tasks)
+	else:
+		from multiprocessing import Pool
+		pool = Pool(processes=jobs)
+		try:
+			# imap() yields results in the order of tasks, as soon as each next one is ready:
+			failed_files = report(pool.imap(_parse_file_task, tasks))
+		except BaseException:
+			# Ctrl+C or an error: don't wait for all the queued files to be converted
+			pool.terminate()
+			raise
+		pool.close()
+		pool.join()
+
+	if use_cache and manifest != manifest_before:
+		save_manifest(folder, manifest)
+	if print_paths and dedup and blocks_stats[1]:
+		print('Shader blocks: {0}, converted: {1} (dedup ratio: {2:.2f})'.format(
+			blocks_stats[0], blocks_stats[1], blocks_stats[0] / float(blocks_stats[1])
+		))
+	if optimize and instructions_stats[0]:
+		print('Instructions: {0} -> {1} ({2:.1f}% removed)'.format(
+			instructions_stats[0], instructions_stats[1],
+			100.0 * (instructions_stats[0] - instructions_stats[1]) / instructions_stats[0]
+		))
+	return failed_files
+
+
+# region Watch mode: re-convert files as soon as they change
+
+def _file_stamp(
+	file_path  # type: _str_h
+):
+	"""
+	Cheap signature of the file state: size and modification time (in ns, if supported).
+	"""
+	st = _os.stat(file_path)
+	return st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
+class Watcher(object):
+	"""
+	Polls the given files/folders and re-converts only the files which have changed.
+
+	A burst of writes is debounced: a file is converted only after it's stayed
+	the same for `debounce` seconds. The state is kept resident between polls:
+	stamps of all the files, their content hashes (shared with the manifests
+	used by `parse()`) and the process-wide `ShaderDedup` cache, so an edited file
+	only has it's changed blocks converted.
+	"""
+	def __init__(
+		self,
+		paths,  # type: Iterable[_str_h]
+		debounce=0.3,  # type: float
+		print_paths=True,
+		dedup=True,
+		log_f=None,  # type: Optional[Callable[[_str_h], Any]]
+		optimize=False
+	):
+		super(Watcher, self).__init__()
+		self.__paths = list(paths)  # type: List[_str_h]
+		self.debounce = debounce
+		self.print_paths = print_paths
+		self.dedup = dedup
+		self.optimize = optimize
+		self.__log = _print if log_f is None else log_f
+
+		self.__manifests = dict()  # type: Dict[_str_h, Dict[_str_h, str]]
+		self.__pending = dict()  # type: Dict[_str_h, Tuple[Tuple[int, Any], float]]
+		# the current state is considered already converted:
+		self.__stamps = self.scan()  # type: Dict[_str_h, Tuple[int, Any]]
+
+	def __files(self):
+		for path in self.__paths:
+			if not _os.path.isdir(path):
+				if is_proper_input_file(path):
+					yield path
+				continue
+			for f in sorted(_os.listdir(path)):
+				f = _os.path.join(path, f)
+				if is_proper_input_file(f):
+					yield f
+
+	def scan(self):
+		"""
+		The current stamps of all the watched files.
+		"""
+		res = dict()  # type: Dict[_str_h, Tuple[int, Any]]
+		for f in self.__files():
+			try:
+				res[f] = _file_stamp(f)
+			except (IOError, OSError):
+				# removed in the meantime
+				pass
+		return res
+
+	def __manifest(
+		self,
+		folder  # type: _str_h
+	):
+		try:
+			return self.__manifests[folder]
+		except KeyError:
+			pass
+		res = load_manifest(folder)
+		self.__manifests[folder] = res
+		return res
+
+	def poll(
+		self,
+		now=None  # type: Optional[float]
+	):
+		"""
+		Detect the changes since the previous poll and convert the files which have settled.
+
+		:return: `ParseResult` for each file converted during this poll.
+		"""
+		import time
+		if now is None:
+			now = time.time()
+
+		stamps = self.scan()
+		for f, stamp in stamps.items():
+			if self.__stamps.get(f) == stamp:
+				# also, if it's changed back before it's settled:
+				self.__pending.pop(f, None)
+				continue
+			pending = self.__pending.get(f)
+			if pending is None or pending[0] != stamp:
+				# changed (again): restart the debounce timer
+				self.__pending[f] = (stamp, now)
+
+		results = list()  # type: List[ParseResult]
+		for f, (stamp, changed_time) in sorted(self.__pending.items()):
+			if f not in stamps:
+				del self.__pending[f]
+				continue
+			if now - changed_time < self.debounce:
+				continue
+			del self.__pending[f]
+			self.__stamps[f] = stamp
+			results.append(self.__convert(f))
+
+		for f in set(self.__stamps).difference(stamps):
+			del self.__stamps[f]
+		return results
+
+	def __convert(
+		self,
+		file_path  # type: _str_h
+	):
+		folder = _os.path.dirname(_os.path.abspath(file_path))
+		nm = _os.path.basename(file_path)
+		manifest = self.__manifest(folder)
+		res = _parse_file_task((file_path, self.print_paths, manifest.get(nm), self.dedup, self.optimize))
+		for msg in res.messages:
+			self.__log(msg)
+		if res.error:
+			self.__log('\tFAILED: ' + res.path + '\n' + res.error)
+			if manifest.pop(nm, None) is not None:
+				save_manifest(folder, manifest)
+		elif res.src_hash and manifest.get(nm) != res.src_hash:
+			manifest[nm] = res.src_hash
+			save_manifest(folder, manifest)
+		return res
+
+	def run(
+		self,
+		interval=0.5,  # type: float
+		stop_f=None  # type: Optional[Callable[[], bool]]
+	):
+		"""
+		Poll until `stop_f()` returns True (or forever, if it's not provided).
+		"""
+		import time
+		while not (stop_f is not None and stop_f()):
+			self.poll()
+			time.sleep(interval)
+
+	def __repr__(self):
+		return '<Watcher: {0} files, {1} pending>'.format(len(self.__stamps), len(self.__pending))
+
+# endregion
+
+
+# region Corpus statistics: opcode histograms and register pressure
+
+# ops, which sample a texture:
+_op_texture_fetches = {
+	'tex', 'texld', 'texldp', 'texldb', 'texldl', 'texldd',
+	'texreg2ar', 'texreg2gb', 'texreg2rgb', 'texbem', 'texbeml', 'texdp3tex',
+	'texm3x2tex', 'texm3x3tex', 'texm3x3spec', 'texm3x3vspec',
+}
+_temp_registers = {VsRegister.r, PsRegister.r}  # type: Set[AnyRegister]
+
+BlockStats = _namedtuple(
+	'BlockStats',
+	['path', 'block', 'type', 'sm', 'instructions', 'texture_fetches', 'temps', 'peak_temps', 'opcodes']
+)  # type: (_str_h, int, Optional[ShaderType], int, int, int, int, int, Dict[str, int])
+stats_columns = BlockStats._fields  # type: Tuple[str, ...]
+
+
+def peak_live_registers(
+	flow  # type: RegisterDataflow
+):
+	"""
+	The max number of registers simultaneously holding a live value (in any component).
+	A register, which value is last read by an instruction, is free to be written by the same one.
+	"""
+	events = list()  # type: List[Tuple[int, int]]
+	for reg_id in _xrange(len(flow.registers)):
+		ranges = sorted(
+			r for comp in _xrange(4)
+			for r in flow.live_ranges(reg_id * 4 + comp)
+		)
+		merged = list()  # type: List[List[int]]
+		for first, last in ranges:
+			if merged and first < merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], last)
+				continue
+			merged.append([first, last])
+		for first, last in merged:
+			events.append((first, 1))
+			events.append((last, -1))
+	# at the same line, registers are released first:
+	events.sort()
+	peak = cur = 0
+	for _, delta in events:
+		cur += delta
+		if cur > peak:
+			peak = cur
+	return peak
+
+
+def block_stats(
+	shader_type,  # type: Optional[ShaderType]
+	code_lines  # type: Sequence[LineData]
+):
+	"""
+	Statistics of a single shader block.
+
+	:return:
+		tuple: the number of instructions, texture fetches,
+		temporary (`r`) registers used, the peak number of them live at once
+		and the histogram of instructions by their base opcode.
+	"""
+	opcodes = dict()  # type: Dict[str, int]
+	not_instructions = _op_not_instructions
+	for line in code_lines:
+		if line.op is None:
+			continue
+		# '(p0) mov ...' is counted as 'mov':
+		op = _parse_op(_split_predicate(line.op, line.args)[2]).base
+		if op in not_instructions:
+			continue
+		opcodes[op] = opcodes.get(op, 0) + 1
+	instructions = sum(opcodes.values())
+	texture_fetches = sum(n for op, n in opcodes.items() if op in _op_texture_fetches)
+	if shader_type is None:
+		return instructions, texture_fetches, 0, 0, opcodes
+	flow = RegisterDataflow(shader_type, code_lines, _temp_registers)
+	return instructions, texture_fetches, len(flow.registers), peak_live_registers(flow), opcodes
+
+
+def _file_stats_task(
+	file_path  # type: _str_h
+):
+	"""
+	Statistics of all the blocks in a single file: a task for `iter_corpus_stats()`.
+	The file is memory-mapped, and only a single block is parsed at a time.
+
+	:return: the path, `BlockStats` for each block and the formatted traceback on error.
+	"""
+	res = list()  # type: List[BlockStats]
+	error = None
+	try:
+		with MappedShaderFile(file_path) as mapped_file:
+			for i, block in enumerate(mapped_file):
+				res.append(BlockStats(
+					file_path, i, block.type, block.sm, *block_stats(block.type, block.code_lines)
+				))
+	except Exception:
+		import traceback
+		error = traceback.format_exc()
+	return file_path, res, error
+
+
+def _stats_files(
+	paths  # type: Iterable[_str_h]
+):
+	for path in paths:
+		if not _os.path.isdir(path):
+			if is_proper_input_file(path):
+				yield path
+			continue
+		for f in sorted(_os.listdir(path)):
+			f = _os.path.join(path, f)
+			if is_proper_input_file(f):
+				yield f
+
+
+def iter_corpus_stats(
+	paths,  # type: Iterable[_str_h]
+	jobs=1,  # type: Optional[int]
+	errors=None  # type: Optional[List[Tuple[_str_h, _str_h]]]
+):
+	"""
+	Generate `BlockStats` for each shader block in the given files/folders.
+
+	Files are processed by a pool of processes (the `jobs` argument is the same
+	as in `parse()`), but results are still generated in the order of files.
+	Neither the lines of the blocks nor the stats are accumulated,
+	so it scales to any size of the corpus.
+
+	:param errors: Optional list receiving (path, traceback) for each failed file.
+	"""
+	files = _stats_files(paths)
+	if not (isinstance(jobs, int) and jobs > 0):
+		import multiprocessing
+		jobs = multiprocessing.cpu_count()
+
+	def results_gen(
+		results  # type: Iterable[Tuple[_str_h, List[BlockStats], Optional[_str_h]]]
+	):
+		for file_path, file_stats, error in results:
+			if error and errors is not None:
+				errors.append((file_path, error))
+			for stats in file_stats:
+				yield stats
+
+	if jobs < 2:
+		for stats in results_gen(_file_stats_task(f) for f in files):
+			yield stats
 		return
 
-	files = [_os.path.join(path, f) for f in _os.listdir(path)]
-	files = filter(is_proper_input_file, files)
-	if print_paths and files:
-		print('\nFiles in folder: ' + path)
-	for f in files:
-		parse_file(f, print_paths)
-	return
+	from multiprocessing import Pool
+	pool = Pool(processes=jobs)
+	try:
+		for stats in results_gen(pool.imap(_file_stats_task, files, 4)):
+			yield stats
+	except BaseException:
+		# also, when the generator is closed before it's exhausted:
+		pool.terminate()
+		raise
+	pool.close()
+	pool.join()
+
+
+def _stats_row(
+	stats  # type: BlockStats
+):
+	"""
+	Plain values of `BlockStats`, the opcodes are sorted by their counts.
+	"""
+	return stats._replace(
+		type=stats.type.name if stats.type else '',
+		opcodes=sorted(stats.opcodes.items(), key=lambda x: (-x[1], x[0])),
+	)
+
+
+def write_stats(
+	stats,  # type: Iterable[BlockStats]
+	out_path,  # type: _str_h
+	heaviest=0  # type: int
+):
+	"""
+	Write the stats to a file, as they're generated, one row per block.
+	The format is detected by the extension: JSON for '.json', CSV otherwise.
+	In CSV, the opcode histogram is a single column: 'mad:12 mul:7 ...'.
+
+	:param heaviest:
+		If positive, that many blocks with the most instructions are returned
+		(only these are kept in memory).
+	:return: The number of written blocks and the list of the heaviest ones.
+	"""
+	import heapq
+	import json
+
+	is_json = _os.path.splitext(out_path)[-1].lower() == '.json'
+	top = list()  # type: List[Tuple[int, int, BlockStats]]
+	num = 0
+	with open(out_path, 'w') as fl:
+		if is_json:
+			fl.write('[')
+		else:
+			import csv
+			writer = csv.writer(fl, lineterminator='\n')
+			writer.writerow(stats_columns)
+		for block in stats:
+			row = _stats_row(block)
+			if is_json:
+				row = row._asdict()
+				row['opcodes'] = dict(row['opcodes'])
+				fl.write(('\n\t' if not num else ',\n\t') + json.dumps(row, sort_keys=True))
+			else:
+				writer.writerow(row._replace(opcodes=' '.join(
+					'{0}:{1}'.format(op, n) for op, n in row.opcodes
+				)))
+			if heaviest > 0:
+				item = (block.instructions, -num, block)
+				if len(top) < heaviest:
+					heapq.heappush(top, item)
+				else:
+					heapq.heappushpop(top, item)
+			num += 1
+		if is_json:
+			fl.write('\n]\n')
+	return num, [item[-1] for item in sorted(top, reverse=True)]
+
+# endregion
 
 
 if __name__ == '__main__':
-	import sys
-	for p in sys.argv[1:]:
-		parse(p, True)
+	import argparse
+	arg_parser = argparse.ArgumentParser(description='Convert HLSL-assembly files to HLSL code.')
+	arg_parser.add_argument(
+		'paths', nargs='+',
+		help='Files or folders with files to convert.'
+	)
+	arg_parser.add_argument(
+		'-j', '--jobs', type=int, default=1,
+		help='The number of files converted in parallel. 0: the number of CPUs. Default: 1.'
+	)
+	arg_parser.add_argument(
+		'--no-cache', action='store_true',
+		help='Convert all the files, even those which are unchanged since the previous run.'
+	)
+	arg_parser.add_argument(
+		'--no-dedup', action='store_true',
+		help="Convert each shader block, even if it's the same as an already converted one."
+	)
+	arg_parser.add_argument(
+		'-O', '--optimize', action='store_true',
+		help=(
+			'Remove dead writes and redundant moves, fold inline constants. '
+			'Instruction counts of each shader are reported.'
+		)
+	)
+	arg_parser.add_argument(
+		'-w', '--watch', action='store_true',
+		help='After the conversion, keep watching the paths and re-convert files as soon as they change.'
+	)
+	arg_parser.add_argument(
+		'--interval', type=float, default=0.5,
+		help='Watch mode: seconds between polls. Default: 0.5.'
+	)
+	arg_parser.add_argument(
+		'--stats', metavar='OUT',
+		help=(
+			"Don't convert: write per-shader statistics (opcode histogram, texture fetches, "
+			"temp registers) to the given '.csv' or '.json' file."
+		)
+	)
+	arg_parser.add_argument(
+		'--top', type=int, default=10,
+		help='Stats mode: the number of the heaviest shaders to print. Default: 10.'
+	)
+	cli_args = arg_parser.parse_args()
+
+	if cli_args.stats:
+		stats_errors = list()  # type: List[Tuple[_str_h, _str_h]]
+		num_blocks, heaviest_blocks = write_stats(
+			iter_corpus_stats(cli_args.paths, cli_args.jobs, stats_errors),
+			cli_args.stats, cli_args.top
+		)
+		print('Shader blocks: {0}, written to: {1}'.format(num_blocks, cli_args.stats))
+		if heaviest_blocks:
+			print('\nThe heaviest shaders:')
+		for block in heaviest_blocks:
+			print('\t{0} instructions, {1} texture fetches, {2} temps ({3} live at peak): {4} #{5}'.format(
+				block.instructions, block.texture_fetches, block.temps, block.peak_temps, block.path, block.block
+			))
+		for stats_path, stats_error in stats_errors:
+			print('\nFAILED: ' + stats_path + '\n' + stats_error)
+		raise SystemExit(1 if stats_errors else 0)
+
+	failed_files = list()  # type: List[ParseResult]
+	for p in cli_args.paths:
+		failed_files.extend(parse(
+			p, True, cli_args.jobs, not cli_args.no_cache, not cli_args.no_dedup, cli_args.optimize
+		))
+	if failed_files:
+		print('\nFailed files:')
+		for res in failed_files:
+			print('\n' + res.path + '\n' + res.error)
 	print('\nComplete')
-	_input()
+
+	if not cli_args.watch:
+		_input()
+	else:
+		print('\nWatching for changes (Ctrl+C to stop)...')
+		watcher = Watcher(cli_args.paths, dedup=not cli_args.no_dedup, optimize=cli_args.optimize)
+		try:
+			watcher.run(cli_args.interval)
+		except KeyboardInterrupt:
+			pass
@@ -0,0 +1,649 @@
+"""
+Performance measurements for `asm2hlsl` module.
+
+Launch it as a script to print the results:
+	python asm2hlsl_bench.py
+
+Each parsing stage is timed on a synthetic corpus (see `synthetic_corpus()`).
+The results can be saved to JSON and compared with the ones from another commit:
+	python asm2hlsl_bench.py --json before.json
+	python asm2hlsl_bench.py --json after.json --compare before.json
+"""
+
+__author__ = 'Lex Darlog (DRL)'
+
+try:
+	# support type hints in Python 3:
+	from typing import *
+except ImportError:
+	pass
+
+import sys as _sys
+import os as _os
+import json as _json
+import random as _random
+import shutil as _shutil
+import subprocess as _subprocess
+import tempfile as _tempfile
+import timeit as _timeit
+
+from drl_py23 import (
+	xrange as _xrange,
+)
+
+import asm2hlsl as _a2h
+
+
+_sample_block = (
+	'//',
+	'// Generated by Microsoft (R) HLSL Shader Compiler 9.29.952.3111',
+	'//',
+	'// Parameters:',
+	'//',
+	'//   float4 _Color;',
+	'//   sampler2D _MainTex;',
+	'//',
+	'    ps_3_0',
+	'    def c1, 0.858085215, -0.858085215, 0.247708291, 0.429042608',
+	'    dcl_texcoord v0.xy',
+	'    dcl_2d s0',
+	'    texld r0, v0, s0',
+	'    mul r0, r0, c0  // tint',
+	'    mad_pp r1.xyz, r0, c1.x, -r0_abs',
+	'    dp3 r1.w, r1, r1',
+	'    mov oC0, r0',
+	'',
+	'// approximately 5 instruction slots used (1 texture, 4 arithmetic)',
+)
+
+
+def sample_lines(
+	num_lines=100000  # type: int
+):
+	"""
+	A list of raw (not yet classified) lines, with the typical ASM-dump contents.
+	"""
+	block = list(_sample_block)
+	res = block * (num_lines // len(block) + 1)
+	return res[:num_lines]
+
+
+# region Synthetic corpus
+
+_synth_ops = (
+	# op, number of source args
+	('add', 2), ('mul', 2), ('mad', 3), ('dp3', 2), ('dp4', 2), ('max', 2), ('min', 2),
+	('mov', 1), ('rsq', 1), ('rcp', 1), ('frc', 1), ('cmp', 3), ('lrp', 3),
+)
+_synth_swizzles = ('', '', '.x', '.y', '.xy', '.xyz', '.w', '.wzyx', '_abs')
+
+
+def synthetic_block(
+	rnd,  # type: _random.Random
+	shader_type='ps',  # type: str
+	code_lines=40,  # type: int
+	comment_density=0.2,  # type: float
+	num_vars=8,  # type: int
+):
+	"""
+	A single shader block, like the one dumped by the HLSL compiler for SM 3.0:
+	a header with the constant table, the code and an 'approximately' post-comment.
+
+	:param shader_type: 'vs' or 'ps'.
+	:param code_lines: The number of instructions (including `def`/`dcl` ones).
+	:param comment_density:
+		Probability (0..1) for each instruction to get an inline comment,
+		and - with half of it - to be preceded by a comment line.
+	:param num_vars: The number of vars in the constant table.
+	"""
+	is_vs = shader_type == 'vs'
+	res = [
+		'//',
+		'// Generated by Microsoft (R) HLSL Shader Compiler 9.29.952.3111',
+		'//',
+		'// Parameters:',
+		'//',
+	]
+	res.extend('//   float4 _Var{0};'.format(i) for i in _xrange(num_vars))
+	res.extend([
+		'//',
+		'//',
+		'// Registers:',
+		'//',
+		'//   Name         Reg   Size',
+		'//   ------------ ----- ----',
+	])
+	res.extend('//   _Var{0:<8} c{0:<4} 1'.format(i) for i in _xrange(num_vars))
+	res.extend(['//', '', '    {0}_3_0'.format(shader_type)])
+
+	out_reg = 'oPos' if is_vs else 'oC0'
+	in_regs = ('v0', 'v1', 'v2') if is_vs else ('v0', 'v1', 's0')
+	num_const = max(num_vars, 1)
+	code = [
+		'    def c{0}, 0.858085215, -0.858085215, 0.247708291, 0.429042608'.format(num_const),
+		'    dcl_position v0' if is_vs else '    dcl_texcoord v0.xy',
+		'    dcl_normal v1' if is_vs else '    dcl_2d s0',
+	]
+	if not is_vs:
+		code.append('    texld r0, v0, s0')
+
+	def operand():
+		kind = rnd.random()
+		if kind < 0.5:
+			reg = 'r{0}'.format(rnd.randrange(8))
+		elif kind < 0.8:
+			reg = 'c{0}'.format(rnd.randrange(num_const + 1))
+		else:
+			reg = rnd.choice(in_regs[:2])
+		return ('-' if rnd.random() < 0.1 else '') + reg + rnd.choice(_synth_swizzles)
+
+	while len(code) < code_lines - 1:
+		if rnd.random() < comment_density * 0.5:
+			code.append('    // synthetic comment line {0}'.format(len(code)))
+		op, num_args = rnd.choice(_synth_ops)
+		args = ['r{0}{1}'.format(rnd.randrange(8), rnd.choice(('', '.x', '.xyz', '.w')))]
+		args.extend(operand() for _ in _xrange(num_args))
+		line = '    {0} {1}'.format(op + rnd.choice(('', '', '_pp', '_sat')), ', '.join(args))
+		if rnd.random() < comment_density:
+			line += '  // ' + op
+		code.append(line)
+	code.append('    mov {0}, r0'.format(out_reg))
+
+	res.extend(code)
+	res.extend([
+		'',
+		'// approximately {0} instruction slots used'.format(len(code)),
+	])
+	return res
+
+
+def synthetic_corpus(
+	num_blocks=100,  # type: int
+	code_lines=40,  # type: int
+	comment_density=0.2,  # type: float
+	num_vars=8,  # type: int
+	shader_types=('vs', 'ps'),  # type: Sequence[str]
+	seed=0
+):
+	"""
+	A list of raw lines for a whole synthetic ASM dump, with `num_blocks`
+	shader blocks of the given types (interleaved). The same seed always
+	produces the same corpus, so the runs are comparable.
+
+	See `synthetic_block()` for the other arguments.
+	"""
+	rnd = _random.Random(seed)
+	res = list()  # type: List[str]
+	for i in _xrange(num_blocks):
+		res.extend(synthetic_block(
+			rnd, shader_types[i % len(shader_types)], code_lines, comment_density, num_vars
+		))
+	return res
+
+
+def write_corpus(
+	folder,  # type: str
+	num_files=10,  # type: int
+	ext='.fx',  # type: str
+	seed=0,
+	**corpus_kwargs
+):
+	"""
+	Write a set of synthetic files to the given folder.
+	The keyword arguments are passed to `synthetic_corpus()`.
+
+	:return: The list of written file paths.
+	"""
+	if not _os.path.isdir(folder):
+		_os.makedirs(folder)
+	res = list()  # type: List[str]
+	for i in _xrange(num_files):
+		file_path = _os.path.join(folder, 'synthetic_{0:04d}{1}'.format(i, ext)).replace('\\', '/')
+		lines = synthetic_corpus(seed=seed + i, **corpus_kwargs)
+		with open(file_path, 'w') as fl:
+			fl.write('\n'.join(lines))
+			fl.write('\n')
+		res.append(file_path)
+	return res
+
+# endregion
+
+
+def lines_per_second(
+	classify_f,  # type: Callable[[str], Optional[_a2h.LineData]]
+	lines,  # type: List[str]
+	repeat=5
+):
+	"""
+	The best throughput of the given classifier function, in lines per second.
+	"""
+	def run():
+		for l in lines:
+			classify_f(l)
+
+	best = min(_timeit.repeat(run, number=1, repeat=repeat))
+	return len(lines) / best if best > 0 else float('inf')
+
+
+def bench_classify_line(
+	num_lines=100000  # type: int
+):
+	"""
+	Compare the legacy split-based `_classify_line()` with the single-pattern lexer,
+	both per-line and for the entire file text at once.
+
+	:return: `dict` of lines per second for each classifier.
+	"""
+	lines = sample_lines(num_lines)
+	text = '\n'.join(lines)
+
+	def lex_text(txt):
+		for _ in _a2h._lex_text(txt):
+			pass
+
+	res = {
+		'_classify_line': lines_per_second(_a2h._classify_line, lines),
+		'_lex_line': lines_per_second(_a2h._lex_line, lines),
+	}
+	best = min(_timeit.repeat(lambda: lex_text(text), number=1, repeat=5))
+	res['_lex_text'] = len(lines) / best if best > 0 else float('inf')
+	return res
+
+
+def constant_table_comments(
+	num_vars=500  # type: int
+):
+	"""
+	A pre-comment block with a large constant table: a declaration and
+	a register mapping for each var, like the ones generated by the HLSL compiler.
+	"""
+	res = [
+		'//',
+		'// Generated by Microsoft (R) HLSL Shader Compiler 9.29.952.3111',
+		'//',
+		'// Parameters:',
+		'//',
+	]
+	res.extend('//   float4 _Var{0};'.format(i) for i in _xrange(num_vars))
+	res.extend([
+		'//',
+		'//',
+		'// Registers:',
+		'//',
+		'//   Name         Reg   Size',
+		'//   ------------ ----- ----',
+	])
+	res.extend('//   _Var{0:<8} c{0:<4} 1'.format(i) for i in _xrange(num_vars))
+	res.append('//')
+	return res
+
+
+# The commit with the multi-pass `_extract_var_names()`, before it was replaced with a single scan:
+legacy_extractor_commit = '960b8ec'
+
+
+def _legacy_module(
+	commit  # type: str
+):
+	"""
+	`asm2hlsl` module as it was at the given commit, loaded from git history.
+	The asserts are stripped, the same as with `python -O`:
+	some of them fail on the inputs, which the code handles otherwise.
+
+	:return: the module, `None` if git (or the commit) isn't available.
+	"""
+	import ast
+	import types
+
+	class StripAsserts(ast.NodeTransformer):
+		def visit_Assert(self, node):
+			return ast.copy_location(ast.Pass(), node)
+	try:
+		source = _subprocess.check_output(
+			['git', 'show', '{0}:asm2hlsl.py'.format(commit)],
+			cwd=_os.path.dirname(_os.path.abspath(__file__)),
+			stderr=_subprocess.STDOUT,
+		)
+	except (OSError, _subprocess.CalledProcessError):
+		return None
+	file_name = 'asm2hlsl@{0}'.format(commit)
+	tree = StripAsserts().visit(ast.parse(source, file_name))
+	code = compile(tree, file_name, 'exec', 0, True)
+	module = types.ModuleType('asm2hlsl_' + commit)
+	module.__file__ = file_name
+	exec(code, module.__dict__)
+	return module
+
+
+def bench_extract_var_names(
+	num_vars=500,  # type: int
+	repeat=20
+):
+	"""
+	Compare the legacy multi-pass extraction (see `legacy_extractor_commit`)
+	with the single-scan `_extract_var_names()`, on a large constant table.
+	The legacy one is skipped if it can't be loaded from git history.
+
+	:return: `dict` of comment lines per second for each implementation.
+	"""
+	lines = constant_table_comments(num_vars)
+	res = dict()  # type: Dict[str, float]
+	implementations = [('_extract_var_names', _a2h._extract_var_names)]
+	legacy = _legacy_module(legacy_extractor_commit)
+	if legacy is not None:
+		implementations.append(('legacy (multi-pass)', legacy._extract_var_names))
+	for nm, f in implementations:
+		best = min(_timeit.repeat(lambda: f(lines), number=1, repeat=repeat))
+		res[nm] = len(lines) / best if best > 0 else float('inf')
+	return res
+
+
+def _tracemalloc():
+	"""`tracemalloc` module, or `None` where it's not available (py2)."""
+	try:
+		import tracemalloc
+	except ImportError:
+		return None
+	return tracemalloc
+
+
+def bench_compact_memory(
+	num_lines=1000000  # type: int
+):
+	"""
+	Memory taken by the parsed lines: a list of `LineData` vs `CompactLines`.
+	For the latter, the source text it keeps is counted, too.
+
+	:return: `dict` of bytes per line. Empty if `tracemalloc` isn't available.
+	"""
+	tracemalloc = _tracemalloc()
+	if tracemalloc is None:
+		return dict()
+
+	text = '\n'.join(sample_lines(num_lines))
+
+	def measure(
+		parse_f  # type: Callable[[str], Sequence[_a2h.LineData]]
+	):
+		tracemalloc.start()
+		try:
+			parsed = parse_f(text)
+			res = tracemalloc.get_traced_memory()[0]
+			del parsed
+		finally:
+			tracemalloc.stop()
+		return res
+
+	text_size = _sys.getsizeof(text)
+	return {
+		'list of LineData': measure(lambda t: list(_a2h._lex_text(t))) / float(num_lines),
+		'CompactLines': (measure(_a2h.CompactLines) + text_size) / float(num_lines),
+	}
+
+
+# region Per-stage suite
+
+def _best_time(
+	f,  # type: Callable[[], Any]
+	repeat=3
+):
+	return min(_timeit.repeat(f, number=1, repeat=repeat))
+
+
+def _peak_memory(
+	f  # type: Callable[[], Any]
+):
+	"""
+	Peak of the memory allocated while `f()` runs, in bytes.
+	It's measured in a separate run, since `tracemalloc` slows everything down.
+	`None` if `tracemalloc` isn't available.
+	"""
+	tracemalloc = _tracemalloc()
+	if tracemalloc is None:
+		return None
+
+	tracemalloc.start()
+	try:
+		f()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+def _stage_result(
+	f,  # type: Callable[[], Any]
+	num_lines,  # type: int
+	repeat=3
+):
+	seconds = _best_time(f, repeat)
+	return {
+		'lines': num_lines,
+		'seconds': seconds,
+		'lines/s': num_lines / seconds if seconds > 0 else float('inf'),
+		'peak_memory': _peak_memory(f),
+	}
+
+
+def bench_stages(
+	lines,  # type: List[str]
+	ext='.fx',  # type: str
+	repeat=3
+):
+	"""
+	Time each parsing stage separately, on the given raw lines:
+		*
+			`_classify_line` / `_lex_text` - splitting each line to op/args/comment
+			(the legacy per-line function and the whole-text lexer);
+		* `_detect_shader_ranges` - segmentation of the already classified lines;
+		* `_extract_var_names` - on the pre-comments of each block;
+		* `_hlsl_code` - translation of the code lines in each block;
+		* `parse_file` - everything together, for a file with these lines.
+
+	:return:
+		`dict` with stage names as keys. Each value is a `dict` with
+		the number of processed lines, best time (seconds), lines/s and peak memory (bytes).
+	"""
+	text = '\n'.join(lines) + '\n'
+	parsed = list(_a2h._lex_text(text))
+	ranges = _a2h._detect_shader_ranges(parsed, ext) or list()
+	pre_comments = [
+		[l.comment for l in parsed[pre_r.first:pre_r.last + 1]]
+		for pre_r, code_r, post_r in ranges
+		if pre_r
+	]
+
+	blocks = [
+		(
+			code_r.type, code_r.sm,
+			[l.comment for l in parsed[pre_r.first:pre_r.last + 1]] if pre_r else list(),
+			parsed[code_r.first_line:code_r.last_line + 1],
+			[l.comment for l in parsed[post_r.first:post_r.last + 1]] if post_r else list(),
+		)
+		for pre_r, code_r, post_r in ranges
+	]
+
+	def classify():
+		for l in lines:
+			_a2h._classify_line(l)
+
+	def hlsl_code():
+		for block in blocks:
+			_a2h._hlsl_code(*block)
+
+	def extract_var_names():
+		for comments in pre_comments:
+			_a2h._extract_var_names(comments)
+
+	res = {
+		'_classify_line': _stage_result(classify, len(lines), repeat),
+		'_lex_text': _stage_result(lambda: list(_a2h._lex_text(text)), len(lines), repeat),
+		'_detect_shader_ranges': _stage_result(
+			lambda: _a2h._detect_shader_ranges(parsed, ext), len(parsed), repeat
+		),
+		'_extract_var_names': _stage_result(
+			extract_var_names, sum(len(c) for c in pre_comments), repeat
+		),
+		'_hlsl_code': _stage_result(hlsl_code, sum(len(b[3]) for b in blocks), repeat),
+	}
+
+	temp_dir = _tempfile.mkdtemp(prefix='asm2hlsl_bench_')
+	try:
+		file_path = _os.path.join(temp_dir, 'synthetic' + ext)
+		with open(file_path, 'w') as fl:
+			fl.write(text)
+		res['parse_file'] = _stage_result(
+			lambda: _a2h.parse_file(file_path, log_f=lambda msg: None), len(lines), repeat
+		)
+	finally:
+		_shutil.rmtree(temp_dir, ignore_errors=True)
+	return res
+
+
+def _git_commit():
+	"""The current commit of the repo this module is in, if available."""
+	try:
+		res = _subprocess.check_output(
+			['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=_os.path.dirname(_os.path.abspath(__file__)),
+			stderr=_subprocess.STDOUT,
+		)
+	except (OSError, _subprocess.CalledProcessError):
+		return None
+	return res.decode('ascii', 'replace').strip() or None
+
+
+def run_suite(
+	repeat=3,
+	**corpus_kwargs
+):
+	"""
+	Generate a synthetic corpus and benchmark each stage on it.
+	The keyword arguments are passed to `synthetic_corpus()`.
+
+	:return: JSON-serializable `dict` with the results and the run settings.
+	"""
+	lines = synthetic_corpus(**corpus_kwargs)
+	return {
+		'commit': _git_commit(),
+		'python': _sys.version.split()[0],
+		'corpus': dict(corpus_kwargs, lines=len(lines)),
+		'stages': bench_stages(lines, repeat=repeat),
+	}
+
+
+def save_results(
+	results,  # type: Dict[str, Any]
+	json_path  # type: str
+):
+	with open(json_path, 'w') as fl:
+		_json.dump(results, fl, indent=1, sort_keys=True)
+
+
+def load_results(
+	json_path  # type: str
+):
+	with open(json_path, 'r') as fl:
+		res = _json.load(fl)  # type: Dict[str, Any]
+	return res
+
+
+def _print_stages(
+	results,  # type: Dict[str, Any]
+	baseline=None  # type: Optional[Dict[str, Any]]
+):
+	print('\nStages (commit: {0}, {1:,} lines):'.format(
+		results.get('commit'), results['corpus']['lines']
+	))
+	base_stages = baseline['stages'] if baseline else dict()
+	for nm, stage in sorted(results['stages'].items()):
+		peak_memory = stage['peak_memory']
+		line = '\t{0:<22} {1:>12,.0f} lines/s {2}'.format(
+			nm, stage['lines/s'],
+			'{0:>10,.1f} KiB peak'.format(peak_memory / 1024.0) if peak_memory is not None else '      (no tracemalloc)'
+		)
+		base = base_stages.get(nm)
+		if base and base['lines/s'] > 0:
+			line += '   x{0:.2f} speed vs {1}'.format(
+				stage['lines/s'] / base['lines/s'], baseline.get('commit')
+			)
+		print(line)
+
+# endregion
+
+
+def bench_hlsl_code(
+	num_instructions=(1000, 5000, 20000),  # type: Sequence[int]
+	repeat=5
+):
+	"""
+	Throughput of `_hlsl_code()` on single huge shaders with thousands of instructions.
+
+	:return: `dict` of instructions per second for each shader size.
+	"""
+	res = dict()  # type: Dict[str, float]
+	for num in num_instructions:
+		lines = synthetic_block(_random.Random(num), 'ps', num, 0.2, 32)
+		parsed = list(_a2h._lex_text('\n'.join(lines)))
+		pre_r, code_r, post_r = _a2h._detect_shader_ranges(parsed, '.ps')[0]
+		pre_comments = [l.comment for l in parsed[pre_r.first:pre_r.last + 1]]
+		code_lines = parsed[code_r.first_line:code_r.last_line + 1]
+
+		def run():
+			_a2h._hlsl_code(code_r.type, code_r.sm, pre_comments, code_lines, list())
+
+		best = _best_time(run, repeat)
+		res['{0:>6} instructions'.format(num)] = len(code_lines) / best if best > 0 else float('inf')
+	return res
+
+
+def _print_results(
+	title,  # type: str
+	results,  # type: Dict[str, float]
+	units='lines/s'
+):
+	print('\n' + title)
+	for nm, val in sorted(results.items()):
+		print('\t{0:<24} {1:>14,.0f} {2}'.format(nm, val, units))
+
+
+if __name__ == '__main__':
+	import argparse
+
+	arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+	arg_parser.add_argument('--blocks', type=int, default=200, help='Number of shader blocks in the corpus.')
+	arg_parser.add_argument('--code-lines', type=int, default=40, help='Instructions per block.')
+	arg_parser.add_argument(
+		'--comments', type=float, default=0.2,
+		help='Comment density: probability for each instruction to have a comment.'
+	)
+	arg_parser.add_argument('--vars', type=int, default=8, help='Vars in the constant table of each block.')
+	arg_parser.add_argument('--seed', type=int, default=0)
+	arg_parser.add_argument('--repeat', type=int, default=3, help='Take the best of N runs.')
+	arg_parser.add_argument('--json', help='Save the results to this file.')
+	arg_parser.add_argument('--compare', help='Compare with the results previously saved to this file.')
+	arg_parser.add_argument(
+		'--micro', action='store_true', help='Also run the older micro-benchmarks on a repeated sample block.'
+	)
+	args = arg_parser.parse_args()
+
+	suite_res = run_suite(
+		repeat=args.repeat,
+		num_blocks=args.blocks,
+		code_lines=args.code_lines,
+		comment_density=args.comments,
+		num_vars=args.vars,
+		seed=args.seed,
+	)
+	_print_stages(suite_res, load_results(args.compare) if args.compare else None)
+	if args.json:
+		save_results(suite_res, args.json)
+
+	if args.micro:
+		_print_results('Line classification:', bench_classify_line())
+		_print_results('Constant table (500 vars):', bench_extract_var_names())
+		memory_res = bench_compact_memory()
+		if memory_res:
+			_print_results('Memory per line:', memory_res, 'bytes')
+		else:
+			print('\nMemory per line: skipped, tracemalloc is not available in this Python')
+		_print_results('Translation of huge shaders:', bench_hlsl_code(), 'instructions/s')
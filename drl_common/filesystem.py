@@ -2,8 +2,13 @@ __author__ = 'Lex Darlog (DRL)'
 
 import os
 import io
+import threading
 from os import path as _pth
 import shutil as sh
+from collections import (
+	namedtuple as _namedtuple,
+	OrderedDict as _OrderedDict,
+)
 
 try:
 	# support type hints in Python 3:
@@ -28,6 +33,8 @@ from drl_py23 import (
 	str_t as _str_t,
 	str_h as _str_h,
 	t_strict_unicode as _unicode,
+	py2 as _py2,
+	xrange as _xrange,
 )
 from drl_py23.enum import EnumDefault as __EnumDefault
 from drl_os.files import to_unix_path
@@ -247,6 +254,126 @@ def __is_overwrite_enabled(
 	return bool(overwrite)
 
 
+# Folders already verified (or created) by `ensure_breadcrumbs_are_folders()`,
+# so the checks aren't repeated. Keyed by normalized absolute paths (see `_verified_key()`):
+_verified_dirs = set()  # type: _t.Set[_str_h]
+_verified_dirs_lock = threading.Lock()
+
+
+def _verified_key(
+	path,  # type: _str_h
+	cwd=None  # type: _t.Optional[_str_h]
+):
+	"""
+	The key of a folder in `_verified_dirs`: absolute, so it's still valid after `os.chdir()`.
+	For many paths, pass the `cwd` once, to avoid `os.getcwd()` call for each.
+	"""
+	if not os.path.isabs(path):
+		path = os.path.join(os.getcwd() if cwd is None else cwd, path)
+	return os.path.normcase(os.path.normpath(path))
+
+
+def forget_verified_dirs(
+	path=None  # type: _t.Optional[_str_h]
+):
+	"""
+	Invalidate the cache of folders verified by `ensure_breadcrumbs_are_folders()`:
+	either entirely, or just the given folder with all it's sub-folders.
+	"""
+	with _verified_dirs_lock:
+		if path is None:
+			_verified_dirs.clear()
+			return
+		key = _verified_key(path)
+		prefix = key.rstrip(os.sep) + os.sep
+		_verified_dirs.difference_update([
+			d for d in _verified_dirs if d == key or d.startswith(prefix)
+		])
+
+
+def _is_verified_dir(
+	item,  # type: _str_h
+	key  # type: _str_h
+):
+	"""
+	Whether the folder is in the cache and still exists.
+	The cache is trusted only as far as a single `isdir()` check: if the folder was removed
+	by something else, it's (and it's sub-folders') entry is dropped.
+	"""
+	if key not in _verified_dirs:
+		return False
+	if os.path.isdir(item):
+		return True
+	forget_verified_dirs(item)
+	return False
+
+
+def _parent_breadcrumbs(
+	path  # type: _str_h
+):
+	"""
+	:return: the cleaned-up path and all it's parent folders (from the topmost one).
+	"""
+	path = to_unix_path(path, trailing_slash=False)
+	err.NotStringError(path, 'path').raise_if_needed_or_empty()
+	if not path.rstrip('/'):
+		return path, list()
+
+	checked = ''
+	path_for_split = path
+	if path.startswith('/'):
+		path_for_split = path.lstrip('/')
+		path = '/' + path_for_split
+		checked = '/'
+	breadcrumbs = path_for_split.split('/')
+	if len(breadcrumbs) < 2:
+		return path, list()
+
+	checked += breadcrumbs[0]
+	parents = [checked]
+	for item in breadcrumbs[1:-1]:
+		checked += '/' + item
+		parents.append(checked)
+	return path, parents
+
+
+def _ensure_folder(
+	item,  # type: _str_h
+	path,  # type: _str_h
+	overwrite=0,  # type: _t.Union[int, bool]
+	is_top=False,
+	key=None  # type: _t.Optional[_str_h]
+):
+	"""
+	Handle single breadcrumb item (aka path element / parent folder).
+	Check if it's a valid folder. And if not:
+
+	* try to create it if path is available
+	* try to remove file at this path and replace with a folder (if allowed)
+
+	On success, the folder is remembered as verified.
+	"""
+	try:
+		if is_top and item.endswith(':') and not os.path.exists(item):
+			raise _fl_errors.NotExist(item, "No such disk found in system")
+		if not os.path.exists(item):
+			os.makedirs(item)
+		elif not os.path.isdir(item):
+			if not os.path.isfile(item):
+				raise _fl_errors.UnknownObject(item)
+			# we're facing a file (not a dir):
+			if not __is_overwrite_enabled(overwrite, item):
+				raise _fl_errors.ParentFolderIsFile(path, item, overwrite)
+			os.remove(item)
+			os.makedirs(item)
+	except Exception:
+		# the filesystem isn't what we've thought it is:
+		forget_verified_dirs()
+		raise
+	with _verified_dirs_lock:
+		_verified_dirs.add(_verified_key(item) if key is None else key)
+
+
 def ensure_breadcrumbs_are_folders(
 	path,  # type: _str_h
 	overwrite=0  # type: _t.Union[int, bool]
@@ -259,6 +386,12 @@ def ensure_breadcrumbs_are_folders(
 	If any of parents is actually a file itself, either it's removed
 	or an error is thrown.
 
+	Each folder verified (or created) is remembered for the whole process,
+	so the repeated calls for the same folders do a single `isdir()` check
+	(of the deepest remembered one). If it's gone, the cache entry is dropped and the
+	parents above are checked as usual. The whole cache is invalidated on any error,
+	or explicitly with `forget_verified_dirs()`.
+
 	:param path: File path (absolute recommended).
 	:param overwrite:
 		What to do if a parent folder is actually a file itself:
@@ -279,61 +412,89 @@ def ensure_breadcrumbs_are_folders(
 		* ParentFolderIsFile - a breadcrumb is a file, and overwrite is disabled.
 	"""
 	# path = r'e:\1-Projects\0-Common_Code\qqq\\'
-	path = to_unix_path(path, trailing_slash=False)
-	err.NotStringError(path, 'path').raise_if_needed_or_empty()
-	if not path.rstrip('/'):
-		return path
-
-	checked = ''
-	path_for_split = path
-	if path.startswith('/'):
-		path_for_split = path.lstrip('/')
-		path = '/' + path_for_split
-		checked = '/'
-	breadcrumbs = path_for_split.split('/')
-
-	if len(breadcrumbs) < 2:
-		return path
-	del path_for_split
-
-	breadcrumbs = breadcrumbs[:-1]
-	checked += breadcrumbs.pop(0)
-	if checked.endswith(':') and not os.path.exists(checked):
-		raise _fl_errors.NotExist(checked, "No such disk found in system")
-
-	# we're sure at least the disk exists
+	path, parents = _parent_breadcrumbs(path)
+	cwd = os.getcwd()
+	keys = [_verified_key(p, cwd) for p in parents]
+	# an existing verified folder means all it's parents were verified, too.
+	# So, only the folders below the deepest verified one are checked:
+	first = len(parents)
+	while first > 0 and not _is_verified_dir(parents[first - 1], keys[first - 1]):
+		first -= 1
+	for i in range(first, len(parents)):
+		_ensure_folder(parents[i], path, overwrite, i == 0, keys[i])
+	return path
 
-	def __check_item(item):
-		"""
-		Handle single breadcrumb item (aka path element / parent folder).
-		Check if it's a valid folder. And if not:
 
-		* try to create it if path is available
-		* try to remove file at this path and replace with a folder (if allowed)
-		"""
-		if not os.path.exists(item):
-			os.makedirs(item)
-			return
-		# path already exist:
+def ensure_many(
+	paths,  # type: _t.Iterable[_str_h]
+	overwrite=0  # type: _t.Union[int, bool]
+):
+	"""
+	`ensure_breadcrumbs_are_folders()` for many paths at once.
 
-		if os.path.isdir(item):
-			return
-		if not os.path.isfile(item):
-			raise _fl_errors.UnknownObject(item)
-		# we're facing a file (not a dir):
+	All the parent folders are first gathered into a prefix tree,
+	so each distinct folder is checked just once, parents before children.
+	A folder verified already is re-checked with a single `isdir()`,
+	and only if it's the deepest verified one in it's branch.
 
-		if __is_overwrite_enabled(overwrite, item):
-			os.remove(item)
-			os.makedirs(item)
-			return
-		raise _fl_errors.ParentFolderIsFile(path, item, overwrite)
+	:return: the cleaned-up paths, in the same order.
+	"""
+	cleaned = list()  # type: _t.List[_str_h]
+	cwd = os.getcwd()
+	# each node: the first path with this parent, the child nodes and the cache key:
+	trie = dict()  # type: _t.Dict[_str_h, list]
+	for path in paths:
+		path, parents = _parent_breadcrumbs(path)
+		cleaned.append(path)
+		nodes = trie
+		for parent in parents:
+			node = nodes.get(parent)
+			if node is None:
+				node = nodes[parent] = [path, dict(), _verified_key(parent, cwd)]
+			nodes = node[1]
+
+	# each stack item: a folder, it's node and the linked list of it's parents: (item, key, parents)
+	stack = [(item, node, None) for item, node in trie.items()]
+	while stack:
+		item, (path, children, key), parents = stack.pop()
+		if key not in _verified_dirs:
+			_ensure_folder(item, path, overwrite, parents is None, key)
+		elif not (
+			# the verified children are checked themselves:
+			children and all(child[2] in _verified_dirs for child in children.values())
+			or _is_verified_dir(item, key)
+		):
+			# a verified folder is gone, so the skipped parents can't be trusted either:
+			_ensure_stale_branch(item, key, path, overwrite, parents)
+		parents = (item, key, parents)
+		stack.extend((child, node, parents) for child, node in children.items())
+	return cleaned
 
-	__check_item(checked)  # we already have the beginning to check
-	while breadcrumbs:
-		__check_item(checked)
-		checked += '/' + breadcrumbs.pop(0)
 
-	return path
+def _ensure_stale_branch(
+	item,  # type: _str_h
+	key,  # type: _str_h
+	path,  # type: _str_h
+	overwrite,  # type: _t.Union[int, bool]
+	parents  # type: _t.Optional[tuple]
+):
+	"""
+	`ensure_many()` helper: a verified folder has vanished. Like in
+	`ensure_breadcrumbs_are_folders()`, the stale cache entries up the branch are dropped
+	and the folders below the deepest still existing one are checked (honouring `overwrite`).
+	"""
+	branch = [(item, key)]
+	top = 0  # the index of the topmost path element in the branch, if it's reached
+	while parents is not None:
+		parent, parent_key, parents = parents
+		if _is_verified_dir(parent, parent_key):
+			top = -1
+			break
+		branch.append((parent, parent_key))
+	if top == 0:
+		top = len(branch) - 1
+	for i in range(len(branch) - 1, -1, -1):
+		_ensure_folder(branch[i][0], path, overwrite, i == top, branch[i][1])
 
 
 def clean_path_for_folder(
@@ -430,8 +591,22 @@ def clean_path_for_file(
 
 	if not os.path.exists(path):
 		return path, False, False
+	return _clean_existing_file_path(
+		path, os.path.isfile(path), os.path.isdir(path), overwrite_folders, remove_file
+	)
+
 
-	if os.path.isfile(path):
+def _clean_existing_file_path(
+	path,  # type: _str_h
+	is_file,  # type: bool
+	is_dir,  # type: bool
+	overwrite_folders=0,  # type: _t.Union[int, bool]
+	remove_file=0  # type: _t.Union[int, bool]
+):
+	"""
+	The part of `clean_path_for_file()` handling an object which already exists at the path.
+	"""
+	if is_file:
 		overwritten = __is_overwrite_enabled(
 			remove_file, path, no_button='No',
 			message='File already exist. Overwrite it (remove)?\n{0}',
@@ -443,7 +618,7 @@ def clean_path_for_file(
 		user_cancelled = remove_file > 1 and not overwritten
 		return path, overwritten, user_cancelled
 
-	if os.path.isdir(path):
+	if is_dir:
 		overwritten = __is_overwrite_enabled(
 			remove_file, path,
 			message='Folder already exist at the same path as the file. Remove it?\n{0}',
@@ -454,11 +629,68 @@ def clean_path_for_file(
 		user_cancelled = remove_file > 1 and not overwritten
 		if overwritten:
 			sh.rmtree(path)
+			forget_verified_dirs(path)
 			return path, overwritten, user_cancelled
 		raise _fl_errors.FileAlreadyExist(path, overwrite_folders, 'Folder already exist at the file path')
 
 	raise _fl_errors.UnknownObject(path)
 
+
+def clean_paths_for_files(
+	paths,  # type: _t.Iterable[_str_h]
+	overwrite_folders=0,  # type: _t.Union[int, bool]
+	remove_file=0  # type: _t.Union[int, bool]
+):
+	"""
+	`clean_path_for_file()` for many paths at once (like a whole sequence of output frames).
+
+	Parent folders are ensured with `ensure_many()`. Then the paths are grouped
+	by their folder, and each folder is listed just once (with `scandir()`)
+	to find the existing files/folders, instead of checking each path separately.
+
+	For the arguments, see `clean_path_for_file()`.
+
+	:return: The same 3 results as `clean_path_for_file()` gives, for each path (in the same order).
+	"""
+	cleaned = ensure_many(paths, overwrite_folders)
+	by_folder = dict()  # type: _t.Dict[_str_h, _t.List[int]]
+	for i, path in enumerate(cleaned):
+		folder, _, name = path.rpartition('/')
+		if not folder:
+			folder = '/' if path.startswith('/') else '.'
+		by_folder.setdefault(folder, list()).append(i)
+
+	res = [(path, False, False) for path in cleaned]  # type: _t.List[_t.Tuple[_str_h, bool, bool]]
+	normcase = _pth.normcase
+	for folder, indices in by_folder.items():
+		try:
+			entries = _scandir(folder)
+		except OSError:
+			raise _fl_errors.NotReadable(folder)
+		# only the ones which are among the paths:
+		names = set(normcase(cleaned[i].rpartition('/')[2]) for i in indices)
+		existing = dict()  # type: _t.Dict[_str_h, _t.Tuple[bool, bool]]
+		for entry in entries:
+			name = normcase(entry.name)
+			if name not in names:
+				continue
+			try:
+				is_file, is_dir = entry.is_file(), entry.is_dir()
+			except OSError:
+				continue
+			if is_file or is_dir or not entry.is_symlink():
+				# a broken link is treated as non-existent, like `os.path.exists()` does
+				existing[name] = (is_file, is_dir)
+		if not existing:
+			continue
+		for i in indices:
+			path = cleaned[i]
+			# popped: a duplicate path is already cleaned
+			found = existing.pop(normcase(path.rpartition('/')[2]), None)
+			if found is not None:
+				res[i] = _clean_existing_file_path(path, found[0], found[1], overwrite_folders, remove_file)
+	return res
+
 # ---------------------------------------------------------
 
 
@@ -497,10 +729,310 @@ class DetectEncodingMode(__EnumDefault):
 _detEncMode = DetectEncodingMode
 
 
-def empty_dir(path, overwrite=0):
+# The file inside each trash folder (see `_move_to_trash()`), exclusively locked while
+# the trash is in use. So a trash is provably abandoned only if it's lock can be taken:
+_trash_lock_name = '.trash.lock'
+
+
+def _try_lock_file(
+	file_path,  # type: _str_h
+	create=False
+):
+	"""
+	Open the file and take an exclusive lock on it, without waiting.
+	The lock is released when the file is closed (or the process is gone).
+
+	:return: the open file, `None` if it's locked by anyone else (or it doesn't exist).
+	"""
+	try:
+		fl = open(file_path, 'a+b' if create else 'r+b')
+	except (IOError, OSError):
+		return None
+	try:
+		if os.name == 'nt':
+			import msvcrt
+			fl.seek(0)
+			msvcrt.locking(fl.fileno(), msvcrt.LK_NBLCK, 1)
+		else:
+			import fcntl
+			fcntl.flock(fl.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except (IOError, OSError):
+		fl.close()
+		return None
+	return fl
+
+
+class TrashDeletion(object):
+	"""
+	Deletes a folder tree in the background, on a pool of threads:
+	each sub-folder is listed (with `scandir()`) and emptied by a separate task,
+	so independent sub-trees are deleted in parallel.
+	A folder itself is removed as soon as all of it's contents are gone.
+
+	The progress is available at any moment: `removed` entries (files and folders)
+	of those `found` so far. Entries which couldn't be removed are in `errors`.
+
+	The threads are daemons, so call `wait()` to make sure deletion finishes before exit.
+
+	:param lock:
+		The open locked file inside the folder (see `_try_lock_file()`).
+		It's kept till the rest of the folder is deleted, and then it's removed, too
+		(unless there are errors: the folder is left to be deleted later then).
+	"""
+	def __init__(
+		self,
+		folder,  # type: _str_h
+		workers=4,  # type: int
+		lock=None  # type: _t.Optional[_t.IO]
+	):
+		super(TrashDeletion, self).__init__()
+		from multiprocessing.pool import ThreadPool
+		self.folder = folder
+		self.__lock_file = lock
+		self.found = 1
+		self.removed = 0
+		self.errors = list()  # type: _t.List[_t.Tuple[_str_h, OSError]]
+		self.__lock = threading.Lock()
+		self.__done = threading.Event()
+		self.__pool = ThreadPool(max(1, workers))
+		self.__submit(folder, None)
+
+	def __submit(
+		self,
+		folder,  # type: _str_h
+		parent  # type: _t.Optional[list]
+	):
+		# a node: folder path, parent node, the number of unfinished parts
+		# (it's own listing and each sub-folder):
+		self.__pool.apply_async(self.__empty_folder, ([folder, parent, 1], ))
+
+	def __error(
+		self,
+		path,  # type: _str_h
+		error  # type: OSError
+	):
+		with self.__lock:
+			self.errors.append((path, error))
+
+	def __empty_folder(
+		self,
+		node  # type: list
+	):
+		folder = node[0]
+		try:
+			entries = _scandir(folder)
+		except OSError as e:
+			self.__error(folder, e)
+			entries = list()
+		sub_dirs = list()  # type: _t.List[_str_h]
+		removed = 0
+		if node[1] is None and self.__lock_file is not None:
+			entries = [entry for entry in entries if entry.name != _trash_lock_name]
+		for entry in entries:
+			try:
+				is_dir = entry.is_dir(follow_symlinks=False)
+			except OSError:
+				is_dir = False
+			if is_dir:
+				sub_dirs.append(entry.path)
+				continue
+			try:
+				os.remove(entry.path)
+				removed += 1
+			except OSError as e:
+				self.__error(entry.path, e)
+		with self.__lock:
+			self.found += len(entries)
+			self.removed += removed
+			node[2] += len(sub_dirs)
+		for sub_dir in sub_dirs:
+			self.__submit(sub_dir, node)
+		self.__finish(node)
+
+	def __finish(
+		self,
+		node  # type: _t.Optional[list]
+	):
+		"""
+		Mark a part of the folder as done, and remove it if it was the last one.
+		The same is then done for it's parent.
+		"""
+		while node is not None:
+			with self.__lock:
+				node[2] -= 1
+				if node[2] > 0:
+					return
+			if node[1] is None:
+				self.__release()
+			try:
+				os.rmdir(node[0])
+				with self.__lock:
+					self.removed += 1
+			except OSError as e:
+				self.__error(node[0], e)
+			node = node[1]
+		# the root is done:
+		self.__pool.close()
+		self.__done.set()
+
+	def __release(self):
+		lock_file = self.__lock_file
+		if lock_file is None:
+			return
+		self.__lock_file = None
+		lock_path = lock_file.name
+		lock_file.close()
+		if self.errors:
+			return
+		try:
+			os.remove(lock_path)
+		except OSError as e:
+			self.__error(lock_path, e)
+
+	@property
+	def done(self):
+		return self.__done.is_set()
+
+	def wait(
+		self,
+		timeout=None  # type: _t.Optional[float]
+	):
+		"""
+		Block until the deletion is finished (or the timeout expires).
+
+		:return: whether it's finished.
+		"""
+		return self.__done.wait(timeout)
+
+	def __repr__(self):
+		return '<TrashDeletion: {0}/{1} removed{2} in {3}>'.format(
+			self.removed, self.found, ', done' if self.done else '', repr(self.folder)
+		)
+
+
+def _move_to_trash(
+	path  # type: _str_h
+):
+	"""
+	Move all the contents of the folder to a new sibling trash folder.
+	The folder itself is just renamed and then re-created with the same permissions,
+	it's children are moved one by one only if that's impossible.
+	Those which still can't be moved are removed right away.
+
+	If the path is a symlink, it's target folder is emptied (and the link is kept).
+
+	The trash is in use while the lock file in it is locked (see `_trash_lock_name`).
+	Other trash folders of the same folder, which are provably abandoned
+	(the lock file is there, but no one holds it: the process was interrupted),
+	are moved into the new one, to be deleted with it.
+
+	:return:
+		The trash folder and it's open lock file (for `TrashDeletion`),
+		`None` if it can't be created next to the folder.
+	"""
+	import stat
+	import tempfile
+
+	path = os.path.realpath(path).replace('\\', '/')
+	parent, name = _pth.split(path.rstrip('/'))
+	prefix = '.{0}.trash-'.format(name)
+	try:
+		trash = tempfile.mkdtemp(prefix=prefix, dir=parent or '.')
+	except OSError:
+		return None
+	trash = trash.replace('\\', '/')
+	lock = _try_lock_file(trash + '/' + _trash_lock_name, create=True)
+	if lock is None:
+		os.rmdir(trash)
+		return None
+
+	def release():
+		lock.close()
+		os.remove(lock.name)
+
+	stale = 0
+	for entry in _scandir(parent or '.'):
+		if not (
+			entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False)
+			and entry.path.replace('\\', '/') != trash
+		):
+			continue
+		stale_lock = _try_lock_file(_pth.join(entry.path, _trash_lock_name))
+		if stale_lock is None:
+			# still in use (or not created by `_move_to_trash()` at all)
+			continue
+		stale_lock.close()
+		try:
+			os.rename(entry.path, trash + '/' + entry.name)
+			stale += 1
+		except OSError:
+			pass
+
+	mode = stat.S_IMODE(os.stat(path).st_mode)
+	try:
+		os.rename(path, trash + '/' + name)
+	except OSError:
+		pass
+	else:
+		try:
+			os.mkdir(path)
+			os.chmod(path, mode)
+		except OSError:
+			# roll back: the folder must stay in place, even if not emptied
+			if os.path.isdir(path):
+				os.rmdir(path)
+			os.rename(trash + '/' + name, path)
+			if stale:
+				# the reclaimed trash is left for the next time
+				lock.close()
+			else:
+				release()
+				os.rmdir(trash)
+			return None
+		return trash, lock
+
+	# the folder itself is in use:
+	for entry in _scandir(path):
+		try:
+			os.rename(entry.path, trash + '/' + entry.name)
+		except OSError:
+			if entry.is_dir(follow_symlinks=False):
+				sh.rmtree(entry.path)
+			else:
+				os.remove(entry.path)
+	return trash, lock
+
+
+def empty_dir(
+	path,  # type: _str_h
+	overwrite=0,  # type: _t.Union[int, bool]
+	background=False,
+	workers=4  # type: int
+):
+	"""
+	Make sure the folder exists and it's empty.
+
+	:param overwrite: see `clean_path_for_folder()`.
+	:param background:
+		The fast mode. All the contents are moved at once into a sibling trash folder,
+		so the folder is empty and usable right away. The trash is then deleted
+		in the background, on a pool of `workers` threads (see `TrashDeletion`),
+		together with any trash abandoned by an interrupted process.
+	:return:
+		`TrashDeletion` in the background mode (to track or wait for the deletion),
+		`None` otherwise, or if there was nothing to delete.
+	"""
 	path = clean_path_for_folder(path, overwrite)
 	if not os.path.exists(path):
 		os.makedirs(path)
+		return None
+
+	if background:
+		moved = _move_to_trash(path)
+		if moved is not None:
+			forget_verified_dirs(path)
+			trash, lock = moved
+			return TrashDeletion(trash, workers, lock)
 
 	files = os.listdir(path)
 	for f in files:
@@ -508,122 +1040,482 @@ def empty_dir(path, overwrite=0):
 		filepath = os.path.join(path, f)
 		if os.path.isdir(filepath) and not os.path.islink(filepath):
 			sh.rmtree(filepath)
+			forget_verified_dirs(filepath)
 		else:
 			os.remove(filepath)
+	return None
 
 
-def detect_file_encoding(
+# a buffer reused by all the reads in each thread:
+_read_buffers = threading.local()
+# ... but it's not kept if a bigger one was needed:
+_read_buffer_max_kept = 1024*1024  # 1 Mb
+
+
+def _read_file_head(
 	file_path,  # type: _str_h
-	limit=64*1024,  # 64 Kb
-	mode=None  # type: _t.Optional[DetectEncodingMode, int]
+	limit=None  # type: _t.Optional[int]
 ):
 	"""
+	Read the beginning of a file into the reusable buffer, with a single `open()`.
 
-	:param file_path: the path of file to read.
-	:param limit:
-		max amount of bytes read from the file.
-		If non-int or 0 and less, read it entirely.
-	:param mode:
-		One of the options from ``DetectEncodingMode`` enum.
-		**FALLBACK_CHARDET_DAMMIT** if omitted.
+	:param limit: max amount of bytes read from the file. `None`: read it entirely.
 	:return:
-		* `str` detected encoding
-		* `float` how sure the detector is:
-			* in **BUILT_IN** mode:
-				* 1.5 on success (to differentiate from the actual detection),
-				* 0.0 if default encoding returned
-			* in `chardet` mode, the actual 'sureness' of detector
-			* in `UnicodeDammit` mode, always excactly 2.5
+		* `memoryview` of the read bytes. It's valid only until the next call in the same thread.
+		* `bool` whether the entire file is read.
 	"""
-	# file_path = r'p:\0-Unity\builtin_shaders\CGIncludes\AutoLight.cginc'
-	import codecs
-
-	# first, try to detect BOM.
-	# an extension of: https://stackoverflow.com/questions/13590749/reading-unicode-file-data-with-bom-chars-in-python
-	file_path = _fl_error_check.file_readable(file_path)
 	try:
-		first_bytes = min(32, _pth.getsize(file_path))  # int for now
-		with open(file_path, 'rb') as fl_first:
-			first_bytes = fl_first.read(first_bytes)  # str now
+		with open(file_path, 'rb') as fl:
+			size = os.fstat(fl.fileno()).st_size
+			to_read = size if limit is None else min(size, limit)
+			buf = getattr(_read_buffers, 'buf', None)  # type: _t.Optional[bytearray]
+			if buf is None or len(buf) < to_read:
+				buf = bytearray(max(to_read, 64*1024))
+				if len(buf) <= _read_buffer_max_kept:
+					_read_buffers.buf = buf
+			view = memoryview(buf)
+			n = 0
+			while n < to_read:
+				n_read = fl.readinto(view[n:to_read])
+				if not n_read:
+					break
+				n += n_read
 	except IOError:
 		raise _fl_errors.NotReadable(file_path)
-	for bom, enc in (
-		(codecs.BOM_UTF32_BE, 'utf-32-be'),
-		(codecs.BOM_UTF32_LE, 'utf-32-le'),
-		(codecs.BOM_UTF8, 'utf-8-sig'),
-		(codecs.BOM_UTF16_BE, 'utf-16-be'),
-		(codecs.BOM_UTF16_LE, 'utf-16-le'),
-	):
-		if first_bytes.startswith(bom):
-			return enc, 1.5
-	del first_bytes
-
-	if isinstance(mode, float):
-		mode = int(mode)
-	mode = _detEncMode.get(
-		mode, default=_detEncMode.FALLBACK_CHARDET_DAMMIT
-	)
+	return view[:n], n >= size
 
-	if not (isinstance(limit, int) and limit > 0):
-		limit = None
 
-	raw = ''
-	try:
-		with open(file_path, 'rb') as fl:
-			raw = fl.read() if limit is None else fl.read(limit)
-	except IOError:
-			raise _fl_errors.NotReadable(file_path)
+def _buffer_decoded(
+	raw,  # type: memoryview
+	encoding  # type: str
+):
+	"""Decode the buffer without copying it to a `bytes` object first (where possible)."""
+	import codecs
+	if _py2:
+		raw = raw.tobytes()
+	return codecs.decode(raw, encoding)
 
-	def _mode_no_modules(bytes_string):
-		"""
-		The simplest mode.
-		It has no dependencies on external modules, but can only differentiate ascii
-		from UTF and assumes the default codepage if neither of those is detected.
 
-		Based on: https://unicodebook.readthedocs.io/guess_encoding.html
-		"""
-		def is_ascii():
-			try:
-				# print(raw.decode('koi8-r')[1181:1230])
-				# print(raw.decode('cp1252')[1181:1230])
-				# print(raw.decode('ascii')[1181:1230])
-				bytes_string.decode('ascii')
-			except UnicodeDecodeError:
-				return False
-			else:
-				return True
+def _encoding_limit(
+	limit  # type: _t.Optional[int]
+):
+	return limit if isinstance(limit, int) and limit > 0 else None
 
-		def detect_utf8_strict():
-			enc_utf = 'utf-8'
-			try:
-				# print(raw.decode('koi8-r')[1181:1230])
-				# print(raw.decode('cp1252')[1181:1230])
-				# print(raw.decode('ascii')[1181:1230])
-				# print(raw.decode('utf-8')[1181:1230])
-				# print(raw.decode('ISO-8859-1')[1181:1230])
-				# print(b'\xED\xB2\x80'.decode('utf-8'))
-				bytes_string.decode(enc_utf)
-			except UnicodeDecodeError:
-				enc_utf = 'utf-8-sig'
-				try:
-					bytes_string.decode(enc_utf)
-				except UnicodeDecodeError:
-					return None
-			else:
-				for ch in bytes_string:
-					ch_i = ch if isinstance(ch, int) else ord(ch)  # Py2: need ord()l Py3: bytes[i] is already an int
-					if 0xD800 <= ch_i <= 0xDFFF:
-						return None
-				return enc_utf
-
-		if is_ascii():
-			return 'ascii'
-		detected_utf = detect_utf8_strict()
-		if detected_utf:
-			return detected_utf
-		return ''
 
-	def _mode_chardet(bytes_string):
+def _file_stamp(
+	file_path  # type: _str_h
+):
+	"""
+	Cheap signature of the file state, without reading it: size, modification time (ns) and inode.
+	"""
+	st = os.stat(file_path)
+	mtime_ns = getattr(st, 'st_mtime_ns', None)
+	if mtime_ns is None:
+		mtime_ns = int(st.st_mtime * 1000000000)
+	return st.st_size, mtime_ns, st.st_ino
+
+
+class EncodingCache(object):
+	"""
+	Results of `detect_file_encoding()`, so unchanged files aren't detected again.
+
+	Each entry is keyed by the file path, and it's valid only while
+	the file has the same size, modification time and inode
+	(and for the same detection mode and limit).
+
+	In-process, it's an LRU of up to `max_size` entries.
+	If `file_path` is given, it's also persisted there (as JSON):
+	loaded on creation and written by `save()`. Only `max_size` of the most recently
+	used entries are persisted, too.
+	"""
+	def __init__(
+		self,
+		file_path=None,  # type: _t.Optional[_str_h]
+		max_size=4096  # type: int
+	):
+		super(EncodingCache, self).__init__()
+		self.max_size = max_size
+		self.file_path = file_path
+		self.__lru = _OrderedDict()  # type: _t.Dict[_str_h, list]
+		self.__disk = _OrderedDict()  # type: _t.Dict[_str_h, list]  # the most recently used is the last
+		self.__lock = threading.Lock()
+		self.__changed = False
+		self.hits = 0
+		self.misses = 0
+		if file_path and _pth.isfile(file_path):
+			self.load()
+
+	@staticmethod
+	def __key(
+		file_path  # type: _str_h
+	):
+		return _pth.normcase(_pth.abspath(file_path))
+
+	def get(
+		self,
+		file_path,  # type: _str_h
+		stamp,  # type: _t.Tuple[int, int, int]
+		mode,  # type: int
+		limit  # type: _t.Optional[int]
+	):
+		"""
+		:return: cached `(encoding, confidence)`, None if there's no valid entry.
+		"""
+		key = self.__key(file_path)
+		with self.__lock:
+			entry = self.__lru.get(key)
+			if entry is None:
+				entry = self.__disk.get(key)
+				if entry is not None:
+					self.__lru_add(key, entry)
+			else:
+				# the most recently used is the last:
+				del self.__lru[key]
+				self.__lru[key] = entry
+			if entry is not None and key in self.__disk:
+				self.__disk_add(key, self.__disk.pop(key))
+			if entry is None or entry[:5] != [stamp[0], stamp[1], stamp[2], mode, limit]:
+				self.misses += 1
+				return None
+			self.hits += 1
+			return entry[5], entry[6]
+
+	def put(
+		self,
+		file_path,  # type: _str_h
+		stamp,  # type: _t.Tuple[int, int, int]
+		mode,  # type: int
+		limit,  # type: _t.Optional[int]
+		encoding,  # type: str
+		confidence  # type: float
+	):
+		key = self.__key(file_path)
+		entry = [stamp[0], stamp[1], stamp[2], mode, limit, encoding, confidence]
+		with self.__lock:
+			self.__lru.pop(key, None)
+			self.__lru_add(key, entry)
+			if self.file_path:
+				self.__disk.pop(key, None)
+				self.__disk_add(key, entry)
+				self.__changed = True
+
+	def __lru_add(self, key, entry):
+		lru = self.__lru
+		lru[key] = entry
+		while len(lru) > self.max_size:
+			lru.popitem(last=False)
+
+	def __disk_add(self, key, entry):
+		disk = self.__disk
+		disk[key] = entry
+		while len(disk) > self.max_size:
+			disk.popitem(last=False)
+			self.__changed = True
+
+	def clear(self):
+		with self.__lock:
+			self.__lru.clear()
+			if self.__disk:
+				self.__disk.clear()
+				self.__changed = True
+
+	def load(self):
+		"""
+		Read the persisted entries from `file_path`. A broken file is just ignored.
+		"""
+		import json
+		try:
+			with open(self.file_path, 'r') as fl:
+				data = json.load(fl, object_pairs_hook=_OrderedDict)
+		except (IOError, OSError, ValueError):
+			return
+		if not isinstance(data, dict):
+			return
+		with self.__lock:
+			self.__disk = _OrderedDict()
+			self.__changed = False
+			for k, v in data.items():
+				if isinstance(v, list) and len(v) == 7:
+					self.__disk_add(k, v)
+
+	def save(self):
+		"""
+		Write the entries to `file_path`, if there's any change since the last load/save.
+		It's replaced as a whole, so the file is never left half-written.
+		"""
+		import json
+		if not (self.file_path and self.__changed):
+			return
+		with self.__lock:
+			# in the order of use, to be restored by `load()`:
+			data = _OrderedDict(self.__disk)
+			self.__changed = False
+		tmp_path = '{0}.{1}.tmp'.format(self.file_path, os.getpid())
+		try:
+			with open(tmp_path, 'w') as fl:
+				json.dump(data, fl, separators=(',', ':'))
+			if hasattr(os, 'replace'):
+				os.replace(tmp_path, self.file_path)
+			else:
+				if os.path.exists(self.file_path):
+					os.remove(self.file_path)
+				os.rename(tmp_path, self.file_path)
+		except (IOError, OSError):
+			raise _fl_errors.NotWriteable(self.file_path)
+
+	def __repr__(self):
+		return '<EncodingCache: {0} entries, {1} hits, {2} misses{3}>'.format(
+			len(self.__lru), self.hits, self.misses,
+			', at ' + repr(self.file_path) if self.file_path else ''
+		)
+
+
+# The cache used by `detect_file_encoding()` and `read_file_lines_best_enc()` by default:
+encoding_cache = EncodingCache()
+
+
+def set_encoding_cache_file(
+	file_path,  # type: _t.Optional[_str_h]
+	max_size=4096  # type: int
+):
+	"""
+	Make the default `encoding_cache` persistent, at the given file.
+	It's saved automatically on exit (or call `encoding_cache.save()` explicitly).
+	The previous default cache is saved right away.
+	`None` switches back to the in-process cache only.
+	"""
+	global encoding_cache
+	global _encoding_cache_exit_registered
+	_save_encoding_cache()
+	encoding_cache = EncodingCache(file_path, max_size)
+	if file_path and not _encoding_cache_exit_registered:
+		# a single handler, saving whichever cache is the default one at exit:
+		import atexit
+		atexit.register(_save_encoding_cache)
+		_encoding_cache_exit_registered = True
+	return encoding_cache
+
+
+_encoding_cache_exit_registered = False
+
+
+def _save_encoding_cache():
+	# the cache is just an optimization: an unwritable file shouldn't break anything
+	try:
+		encoding_cache.save()
+	except Exception:
+		pass
+
+
+def _cached_encoding_key(
+	file_path,  # type: _str_h
+	mode  # type: _t.Optional[DetectEncodingMode, int]
+):
+	"""
+	The file stamp and the normalized detection mode, as they're stored in the cache.
+	The stamp is None if the file can't be stat'ed (it's then checked as usual).
+	"""
+	if isinstance(mode, float):
+		mode = int(mode)
+	mode = _detEncMode.get(mode, default=_detEncMode.FALLBACK_CHARDET_DAMMIT)
+	try:
+		stamp = _file_stamp(file_path)
+	except (IOError, OSError):
+		stamp = None
+	return stamp, int(mode)
+
+
+_validate_chunk_size = 1024*1024  # 1 Mb
+
+try:
+	# py3.7+
+	_bytes_isascii = bytes.isascii
+except AttributeError:
+	_bytes_isascii = None
+
+
+def _is_ascii(
+	chunk  # type: memoryview
+):
+	if _bytes_isascii is None:
+		try:
+			_buffer_decoded(chunk, 'ascii')
+		except UnicodeDecodeError:
+			return False
+		return True
+	return _bytes_isascii(chunk.tobytes())
+
+
+def _file_chunks(
+	head,  # type: memoryview
+	file_path=None,  # type: _t.Optional[_str_h]
+	chunk_size=_validate_chunk_size  # type: int
+):
+	"""
+	Generate the file contents as `memoryview` chunks: first, from the already read `head`,
+	then, if `file_path` is given, the rest of the file (read into a single reused buffer).
+	Each chunk is valid only until the next one is generated.
+	"""
+	n = len(head)
+	for i in range(0, n, chunk_size):
+		yield head[i:i + chunk_size]
+	if not file_path:
+		return
+	buf = memoryview(bytearray(chunk_size))
+	try:
+		with open(file_path, 'rb') as fl:
+			fl.seek(n)
+			while True:
+				n_read = fl.readinto(buf)
+				if not n_read:
+					break
+				yield buf[:n_read]
+	except IOError:
+		raise _fl_errors.NotReadable(file_path)
+
+
+def _validate_ascii_utf8(
+	chunks  # type: _t.Iterable[memoryview]
+):
+	"""
+	Check whether the data is entirely ascii or valid UTF-8.
+	Everything is done by C-level functions, chunk by chunk: while the data is ascii,
+	each chunk is just checked for it, and from the first non-ascii one,
+	the rest is validated with an incremental decoder (which also properly handles
+	multi-byte chars split between chunks, and rejects surrogates).
+
+	Py2's utf-8 codec accepts encoded surrogates, so there they're searched for
+	with a regex over the raw bytes of the non-ascii tail.
+
+	:return: 'ascii', 'utf-8' or empty string if it's neither.
+	"""
+	import codecs
+	is_ascii = True
+	decoder = codecs.getincrementaldecoder('utf-8')('strict')
+	if _py2:
+		import re
+		# U+D800..U+DFFF are encoded as ED A0..BF xx:
+		surrogate_match = re.compile(b'\xed[\xa0-\xbf]').search
+	prev_byte = b''  # a surrogate may be split between chunks, too
+	try:
+		for chunk in chunks:
+			if is_ascii:
+				if _is_ascii(chunk):
+					continue
+				is_ascii = False
+			if _py2:
+				chunk = chunk.tobytes()
+				if surrogate_match(prev_byte + chunk[:1]) or surrogate_match(chunk):
+					return ''
+				prev_byte = chunk[-1:]
+			decoder.decode(chunk)
+		decoder.decode(b'', True)
+	except UnicodeDecodeError:
+		return ''
+	return 'ascii' if is_ascii else 'utf-8'
+
+
+def detect_file_encoding(
+	file_path,  # type: _str_h
+	limit=64*1024,  # 64 Kb
+	mode=None,  # type: _t.Optional[DetectEncodingMode, int]
+	cache=True  # type: _t.Union[bool, EncodingCache]
+):
+	"""
+
+	:param file_path: the path of file to read.
+	:param limit:
+		max amount of bytes read from the file for the external detectors.
+		If non-int or 0 and less, read it entirely.
+		The built-in ascii/UTF-8 check always validates the whole file.
+	:param mode:
+		One of the options from ``DetectEncodingMode`` enum.
+		**FALLBACK_CHARDET_DAMMIT** if omitted.
+	:param cache:
+		Reuse the result of previous detection for the same unchanged file.
+		`True`: the default `encoding_cache`, `False`: always detect.
+		Or a specific `EncodingCache` instance.
+	:return:
+		* `str` detected encoding
+		* `float` how sure the detector is:
+			* in **BUILT_IN** mode:
+				* 1.5 on success (to differentiate from the actual detection),
+				* 0.0 if default encoding returned
+			* in `chardet` mode, the actual 'sureness' of detector
+			* in `UnicodeDammit` mode, always excactly 2.5
+	"""
+	# file_path = r'p:\0-Unity\builtin_shaders\CGIncludes\AutoLight.cginc'
+	file_path = _fl_error_check.file_readable(file_path)
+	limit = _encoding_limit(limit)
+	if cache is True:
+		cache = encoding_cache
+	stamp = None
+	if cache:
+		stamp, mode_key = _cached_encoding_key(file_path, mode)
+		if stamp is not None:
+			cached = cache.get(file_path, stamp, mode_key, limit)
+			if cached is not None:
+				return cached
+	# the file is read just once, with at least enough bytes for BOM:
+	raw, is_whole = _read_file_head(file_path, None if limit is None else max(limit, 32))
+	res = _detect_buffer_encoding(raw, limit, mode, None if is_whole else file_path)
+	if stamp is not None:
+		cache.put(file_path, stamp, mode_key, limit, res[0], res[1])
+	return res
+
+
+def _detect_buffer_encoding(
+	raw,  # type: memoryview
+	limit=None,  # type: _t.Optional[int]
+	mode=None,  # type: _t.Optional[DetectEncodingMode, int]
+	file_path=None  # type: _t.Optional[_str_h]
+):
+	"""
+	The actual implementation of `detect_file_encoding()`,
+	working on the (beginning of) file contents which are already read.
+
+	:param file_path:
+		If `raw` is only the beginning of a file, it's path.
+		The built-in detection reads the rest of it, too.
+	"""
+	import codecs
+
+	# first, try to detect BOM.
+	# an extension of: https://stackoverflow.com/questions/13590749/reading-unicode-file-data-with-bom-chars-in-python
+	first_bytes = raw[:32].tobytes()
+	for bom, enc in (
+		(codecs.BOM_UTF32_BE, 'utf-32-be'),
+		(codecs.BOM_UTF32_LE, 'utf-32-le'),
+		(codecs.BOM_UTF8, 'utf-8-sig'),
+		(codecs.BOM_UTF16_BE, 'utf-16-be'),
+		(codecs.BOM_UTF16_LE, 'utf-16-le'),
+	):
+		if first_bytes.startswith(bom):
+			return enc, 1.5
+	del first_bytes
+
+	if isinstance(mode, float):
+		mode = int(mode)
+	mode = _detEncMode.get(
+		mode, default=_detEncMode.FALLBACK_CHARDET_DAMMIT
+	)
+
+	head = raw
+	if limit is not None:
+		raw = raw[:limit]
+
+	def _mode_no_modules():
+		"""
+		The simplest mode.
+		It has no dependencies on external modules, but can only differentiate ascii
+		from UTF and assumes the default codepage if neither of those is detected.
+		Unlike the other modes, it checks the entire file, so the answer is definitive.
+
+		Based on: https://unicodebook.readthedocs.io/guess_encoding.html
+		"""
+		return _validate_ascii_utf8(_file_chunks(head, file_path))
+
+	def _mode_chardet(bytes_string):
 		import chardet
 		from chardet.universaldetector import UniversalDetector
 		detect = chardet.detect(bytes_string)
@@ -657,7 +1549,7 @@ def detect_file_encoding(
 		_detEncMode.FALLBACK_CHARDET_DAMMIT
 	}:
 		# try to detect using no external modules:
-		detected = _mode_no_modules(raw)
+		detected = _mode_no_modules()
 		if detected:
 			return detected, 1.5
 		# we had no success. The next behavior depends on the mode:
@@ -682,7 +1574,7 @@ def detect_file_encoding(
 
 	if mode is _detEncMode.CHARDET:
 		# actually, also FALLBACK_CHARDET if no-modules approach didn't do the job
-		return _mode_chardet(raw)
+		return _mode_chardet(raw.tobytes())
 
 	# the 'UnicodeDammit+chardet' mode if we got here
 
@@ -695,7 +1587,57 @@ def detect_file_encoding(
 		except ImportError:
 			_inst('pip beautifulsoup4')
 
-	return _mode_unicode_dammit(raw)
+	return _mode_unicode_dammit(raw.tobytes())
+
+
+def _line_f(
+	strip_newline_char=True,
+	line_process_f=None  # type: _t.Optional[_t.Callable[[_str_h], _str_h]]
+):
+	"""
+	The function processing each line as it's read, for `read_file_lines()`.
+	`None` if lines are kept as they are.
+	"""
+	def _rstrip_with_processing(
+		line_str  # type: _str_h
+	):
+		return line_process_f(line_str.rstrip('\r\n'))
+
+	def _rstrip_only(
+		line_str  # type: _str_h
+	):
+		return line_str.rstrip('\r\n')
+
+	is_f_given = callable(line_process_f)
+	if strip_newline_char:
+		return _rstrip_with_processing if is_f_given else _rstrip_only
+	return line_process_f if is_f_given else None
+
+
+def _buffer_lines(
+	raw,  # type: memoryview
+	encoding=None,  # type: _t.Optional[str]
+	f=None  # type: _t.Optional[_t.Callable[[_str_h], _str_h]]
+):
+	"""
+	Split the already read file contents into lines the same way
+	`read_file_lines()` reads them from the file itself.
+
+	:raises UnicodeDecodeError: if it can't be decoded with the given encoding.
+	"""
+	if isinstance(encoding, _str_t) and encoding:
+		# like io.open() in text mode, with universal newlines:
+		lines = io.StringIO(_buffer_decoded(raw, encoding), newline=None)
+	elif _py2:
+		# the basic open() in py2 doesn't decode anything:
+		lines = io.BytesIO(raw.tobytes())
+	else:
+		# ... while in py3, it uses the default encoding:
+		import locale
+		lines = io.StringIO(_buffer_decoded(raw, locale.getpreferredencoding(False)), newline=None)
+	if f is None:
+		return list(lines)
+	return [f(l) for l in lines]
 
 
 def read_file_lines(
@@ -731,22 +1673,7 @@ def read_file_lines(
 		(your function already gets a string with no trailing newline-char).
 	"""
 	_fl_error_check.file_readable(file_path)
-
-	def _rstrip_with_processing(
-		line_str  # type: _str_h
-	):
-		return line_process_f(line_str.rstrip('\r\n'))
-
-	def _rstrip_only(
-		line_str  # type: _str_h
-	):
-		return line_str.rstrip('\r\n')
-
-	is_f_given = callable(line_process_f)
-	if strip_newline_char:
-		f = _rstrip_with_processing if is_f_given else _rstrip_only
-	else:
-		f = line_process_f if is_f_given else None
+	f = _line_f(strip_newline_char, line_process_f)
 
 	if isinstance(encoding, _str_t) and encoding:
 		# we do have an encoding
@@ -778,7 +1705,8 @@ def read_file_lines_best_enc(
 	line_process_f=None,  # type: _t.Optional[_t.Callable[[_str_h], _str_h]]
 	detect_limit=64*1024,  # 64 Kb
 	detect_mode=None,
-	sure_thresh=0.5
+	sure_thresh=0.5,
+	cache=True  # type: _t.Union[bool, EncodingCache]
 ):
 	"""
 	A wrapper, combining `detect_file_encoding()` and `read_file_lines()` and
@@ -802,28 +1730,186 @@ def read_file_lines_best_enc(
 		* `string` encoding on success, `None` if the basic `open()` was used.
 		* `float` how sure the detector is about it's encoding.
 	"""
-	encoding, enc_sure = detect_file_encoding(
-		file_path, limit=detect_limit, mode=detect_mode
-	)
+	file_path = _fl_error_check.file_readable(file_path)
+	detect_limit = _encoding_limit(detect_limit)
+	if cache is True:
+		cache = encoding_cache
+	cached = stamp = None
+	if cache:
+		stamp, mode_key = _cached_encoding_key(file_path, detect_mode)
+		if stamp is not None:
+			cached = cache.get(file_path, stamp, mode_key, detect_limit)
+
+	# A single read for both detection and decoding.
+	# Only if the file is bigger than the detection limit, it's read once again
+	# (or just once, when the encoding is known from cache):
+	if cached is not None and detect_limit is not None and stamp[0] > detect_limit:
+		raw, is_whole = None, False
+	else:
+		raw, is_whole = _read_file_head(file_path, None if detect_limit is None else max(detect_limit, 32))
+	if cached is not None:
+		encoding, enc_sure = cached
+	else:
+		encoding, enc_sure = _detect_buffer_encoding(
+			raw, detect_limit, detect_mode, None if is_whole else file_path
+		)
+		if stamp is not None:
+			cache.put(file_path, stamp, mode_key, detect_limit, encoding, enc_sure)
+
+	if is_whole:
+		f = _line_f(strip_newline_char, line_process_f)
+
+		def read_lines(
+			enc  # type: _t.Optional[str]
+		):
+			return _buffer_lines(raw, enc, f)
+	else:
+		raw = None
+
+		def read_lines(
+			enc  # type: _t.Optional[str]
+		):
+			return read_file_lines(file_path, enc, strip_newline_char, line_process_f)
+
 	not_enough_sure = bool(enc_sure < sure_thresh)
 	if not_enough_sure or not encoding:
 		try:
 			encoding = 'ascii'
-			lines = read_file_lines(
-				file_path, encoding, strip_newline_char, line_process_f
-			)
+			lines = read_lines(encoding)
 			if not_enough_sure:
 				enc_sure = 1.0
 		except UnicodeDecodeError:
 			encoding = None
-			lines = read_file_lines(
-				file_path, encoding, strip_newline_char, line_process_f
-			)
+			lines = read_lines(encoding)
 	else:
-		lines = read_file_lines(
-			file_path, encoding, strip_newline_char, line_process_f
-		)
+		lines = read_lines(encoding)
+
+	return lines, encoding, enc_sure
+
+
+def _iter_chunks(
+	items,  # type: _t.Iterable
+	chunk_size  # type: int
+):
+	"""Group the items into lists of up to `chunk_size` ones."""
+	from itertools import islice
+	items = iter(items)
+	while True:
+		chunk = list(islice(items, chunk_size))
+		if not chunk:
+			return
+		yield chunk
+
+
+def iter_file_lines(
+	file_path,  # type: _str_h
+	encoding=None,  # type: _t.Optional[str]
+	strip_newline_char=True,
+	line_process_f=None,  # type: _t.Optional[_t.Callable[[_str_h], _str_h]]
+	chunk_size=None,  # type: _t.Optional[int]
+	buffer_size=64*1024  # type: int
+):
+	"""
+	A generator counterpart of `read_file_lines()`, with the same arguments.
+	Lines are yielded as they're read, so only a bounded buffer is in memory
+	at any time, no matter how big the file is.
+
+	The file is checked right away, but it's opened only when iteration starts
+	(and closed as soon as the generator is exhausted or closed).
+
+	:param chunk_size:
+		If positive, yield lists of up to that many lines instead of individual lines
+		(for batch processing).
+	:param buffer_size: the size of the read buffer, in bytes.
+	"""
+	_fl_error_check.file_readable(file_path)
+	f = _line_f(strip_newline_char, line_process_f)
+
+	if isinstance(encoding, _str_t) and encoding:
+		def open_f():
+			return io.open(file_path, 'rt', buffer_size, encoding=encoding)
+	else:
+		def open_f():
+			return open(file_path, 'rt', buffer_size)
+
+	def lines_gen():
+		try:
+			fl = open_f()
+		except IOError:
+			raise _fl_errors.NotReadable(file_path)
+		with fl:
+			if f is None:
+				for line in fl:
+					yield line
+			else:
+				for line in fl:
+					yield f(line)
+
+	if isinstance(chunk_size, int) and chunk_size > 0:
+		return _iter_chunks(lines_gen(), chunk_size)
+	return lines_gen()
+
+
+def _is_file_ascii(
+	file_path,  # type: _str_h
+	buffer_size=64*1024  # type: int
+):
+	"""
+	Whether the entire file is ascii, checked with a bounded buffer.
+	"""
+	try:
+		with open(file_path, 'rb') as fl:
+			while True:
+				chunk = fl.read(buffer_size)
+				if not chunk:
+					return True
+				try:
+					chunk.decode('ascii')
+				except UnicodeDecodeError:
+					return False
+	except IOError:
+		raise _fl_errors.NotReadable(file_path)
+
+
+def iter_file_lines_best_enc(
+	file_path,  # type: _str_h
+	strip_newline_char=True,
+	line_process_f=None,  # type: _t.Optional[_t.Callable[[_str_h], _str_h]]
+	detect_limit=64*1024,  # 64 Kb
+	detect_mode=None,
+	sure_thresh=0.5,
+	cache=True,  # type: _t.Union[bool, EncodingCache]
+	chunk_size=None,  # type: _t.Optional[int]
+	buffer_size=64*1024  # type: int
+):
+	"""
+	A streaming counterpart of `read_file_lines_best_enc()`, with the same arguments
+	and the same choice of encoding, plus `chunk_size` and `buffer_size`
+	of `iter_file_lines()`.
+
+	The encoding has to be chosen before the first line is yielded.
+	So, when the detector isn't sure enough, the file is scanned once
+	(with a bounded buffer) to check whether it's entirely ascii.
 
+	:return:
+		* `generator` of lines (or of lists of lines, with `chunk_size`).
+		* `string` encoding, `None` if the basic `open()` is used.
+		* `float` how sure the detector is about it's encoding.
+	"""
+	encoding, enc_sure = detect_file_encoding(
+		file_path, limit=detect_limit, mode=detect_mode, cache=cache
+	)
+	not_enough_sure = bool(enc_sure < sure_thresh)
+	if not_enough_sure or not encoding:
+		if _is_file_ascii(file_path, buffer_size):
+			encoding = 'ascii'
+			if not_enough_sure:
+				enc_sure = 1.0
+		else:
+			encoding = None
+	lines = iter_file_lines(
+		file_path, encoding, strip_newline_char, line_process_f, chunk_size, buffer_size
+	)
 	return lines, encoding, enc_sure
 
 
@@ -857,6 +1943,214 @@ def write_file_lines(
 		raise _fl_errors.NotWriteable(file_path)
 
 
+def _offsets_typecode():
+	"""
+	64-bit unsigned ints ('Q') are supported by `array` only in py3.3+.
+	In py2, 'L' is used where it's 64-bit, or doubles (exact up to 2**53 bytes) otherwise.
+	"""
+	from array import array
+	for typecode in ('Q', 'L'):
+		try:
+			if array(typecode).itemsize == 8:
+				return typecode
+		except ValueError:
+			pass
+	return 'd'
+
+
+class LineIndex(object):
+	"""
+	Byte offsets of each line start in a text file, for random access to any range of lines.
+
+	The index is built in a single buffered pass over the file and kept as
+	a compact array of 64-bit ints (see `_offsets_typecode()`). It can be persisted next to the file (`index_path`,
+	'<file>.lidx' by default) and it's reused only while the file has the same
+	size and modification time.
+
+	The lines themselves are read from the memory-mapped file, so `get_lines()`
+	takes the same time regardless of where the range starts.
+	Lines are split by '\\n' bytes, so only the encodings compatible with ascii
+	are supported (not utf-16/32).
+
+	Use it as a context manager (or call `close()` explicitly).
+	"""
+	__magic = 0x3158444e49454e4c  # 'LNEIDNX1'
+	# all the supported typecodes are 8 bytes. The header of an index saved with doubles
+	# doesn't match the one with ints (and vice versa), so it's rebuilt:
+	__typecode = _offsets_typecode()
+	index_ext = '.lidx'
+
+	def __init__(
+		self,
+		file_path,  # type: _str_h
+		encoding='utf-8',  # type: _t.Optional[str]
+		persist=False,
+		index_path=None,  # type: _t.Optional[_str_h]
+		buffer_size=1024*1024  # type: int
+	):
+		"""
+		:param encoding: lines are decoded with it. `None`: lines are `bytes`.
+		:param persist: load the index from `index_path` if it's valid, save it there otherwise.
+		"""
+		super(LineIndex, self).__init__()
+		from array import array
+
+		self.file_path = _fl_error_check.file_readable(file_path)
+		self.encoding = encoding
+		self.index_path = index_path or self.file_path + self.index_ext
+		st = os.stat(self.file_path)
+		self.size = st.st_size
+		self.mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+		self.offsets = array(self.__typecode)
+		self.__map = None
+
+		if not (persist and self.__load()):
+			self.__build(buffer_size)
+			if persist:
+				self.save()
+
+	def __build(
+		self,
+		buffer_size  # type: int
+	):
+		offsets = self.offsets
+		append = offsets.append
+		if self.size:
+			append(0)
+		pos = 0
+		try:
+			with open(self.file_path, 'rb') as fl:
+				while True:
+					chunk = fl.read(buffer_size)
+					if not chunk:
+						break
+					find = chunk.find
+					i = find(b'\n')
+					while i >= 0:
+						append(pos + i + 1)
+						i = find(b'\n', i + 1)
+					pos += len(chunk)
+		except IOError:
+			raise _fl_errors.NotReadable(self.file_path)
+		# no empty line after the trailing newline:
+		if offsets and offsets[-1] >= self.size:
+			offsets.pop()
+
+	def __header(
+		self,
+		num_lines  # type: int
+	):
+		from array import array
+		return array(self.__typecode, [self.__magic, self.size, self.mtime_ns, num_lines])
+
+	def __load(self):
+		"""
+		Read the persisted index, if it's there and it's made for the current state of the file.
+		"""
+		from array import array
+		header = array(self.__typecode)
+		try:
+			with open(self.index_path, 'rb') as fl:
+				header.fromfile(fl, 4)
+				if header[:3] != self.__header(0)[:3]:
+					return False
+				offsets = array(self.__typecode)
+				offsets.fromfile(fl, int(header[3]))
+		except (IOError, OSError, EOFError):
+			return False
+		self.offsets = offsets
+		return True
+
+	def save(
+		self,
+		index_path=None  # type: _t.Optional[_str_h]
+	):
+		"""Write the index, together with the size and mtime of the file it's built for."""
+		index_path = index_path or self.index_path
+		try:
+			with open(index_path, 'wb') as fl:
+				self.__header(len(self.offsets)).tofile(fl)
+				self.offsets.tofile(fl)
+		except (IOError, OSError):
+			raise _fl_errors.NotWriteable(index_path)
+
+	def __data(self):
+		if self.__map is None:
+			import mmap
+			if not self.size:
+				self.__map = b''
+			else:
+				with open(self.file_path, 'rb') as fl:
+					# the map stays valid after the file is closed:
+					self.__map = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.__map
+
+	def get_lines(
+		self,
+		start=0,  # type: int
+		stop=None,  # type: _t.Optional[int]
+		strip_newline_char=True
+	):
+		"""
+		The lines in `[start, stop)` range (the same as in a slice, but with no negative indices).
+		Unlike the text-mode `open()`, '\r\n' isn't converted when newline-chars are kept.
+		"""
+		offsets = self.offsets
+		num_lines = len(offsets)
+		if stop is None or stop > num_lines:
+			stop = num_lines
+		if start < 0 or start >= stop:
+			return list()
+		data = self.__data()
+		starts = offsets[start:stop]
+		ends = offsets[start + 1:stop]
+		ends.append(offsets[stop] if stop < num_lines else self.size)
+		if starts.typecode == 'd':
+			starts, ends = map(int, starts), map(int, ends)
+		lines = [data[first:last] for first, last in zip(starts, ends)]
+		if strip_newline_char:
+			lines = [l.rstrip(b'\r\n') for l in lines]
+		if self.encoding:
+			encoding = self.encoding
+			lines = [l.decode(encoding) for l in lines]
+		return lines
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __getitem__(self, item):
+		if isinstance(item, slice):
+			start, stop, step = item.indices(len(self.offsets))
+			if step == 1:
+				return self.get_lines(start, stop)
+			indices = _xrange(start, stop, step)
+			if not indices:
+				return list()
+			# the whole range is read at once, then the step is applied:
+			first = min(indices[0], indices[-1])
+			lines = self.get_lines(first, max(indices[0], indices[-1]) + 1)
+			return [lines[i - first] for i in indices]
+		if item < 0:
+			item += len(self.offsets)
+		if not 0 <= item < len(self.offsets):
+			raise IndexError('line index out of range: {}'.format(item))
+		return self.get_lines(item, item + 1)[0]
+
+	def close(self):
+		if self.__map is not None and not isinstance(self.__map, bytes):
+			self.__map.close()
+		self.__map = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def __repr__(self):
+		return '<LineIndex: {0} lines in {1}>'.format(len(self.offsets), repr(self.file_path))
+
+
 def dir_tree_gen(
 	root,  # type: _str_h
 	topdown=True,
@@ -907,3 +2201,416 @@ def dir_tree_gen(
 		yield cur_root
 		for fl in files:
 			yield cur_trailed + fl
+
+
+TreeEntry = _namedtuple(
+	'TreeEntry', ['path', 'name', 'is_dir', 'size', 'mtime_ns', 'inode']
+)  # type: (_str_h, _str_h, bool, _t.Optional[int], _t.Optional[int], _t.Optional[int])
+
+
+class _ListdirEntry(object):
+	"""
+	A minimal stand-in for `os.DirEntry`, when `os.scandir()` isn't available (py2).
+	"""
+	__slots__ = ('name', 'path', '__stat')
+
+	def __init__(self, folder, name):
+		super(_ListdirEntry, self).__init__()
+		self.name = name
+		self.path = _pth.join(folder, name)
+		self.__stat = None
+
+	def stat(self, follow_symlinks=True):
+		if not follow_symlinks:
+			return os.lstat(self.path)
+		if self.__stat is None:
+			self.__stat = os.stat(self.path)
+		return self.__stat
+
+	def is_dir(self, follow_symlinks=True):
+		return (_pth.isdir if follow_symlinks else lambda p: _pth.isdir(p) and not _pth.islink(p))(self.path)
+
+	def is_file(self, follow_symlinks=True):
+		return (_pth.isfile if follow_symlinks else lambda p: _pth.isfile(p) and not _pth.islink(p))(self.path)
+
+	def is_symlink(self):
+		return _pth.islink(self.path)
+
+	def inode(self):
+		return self.stat(False).st_ino
+
+
+def _scandir(
+	folder  # type: _str_h
+):
+	"""
+	`os.scandir()` entries of the folder, as a list (the folder handle is released right away).
+	"""
+	try:
+		scandir = os.scandir
+	except AttributeError:
+		return [_ListdirEntry(folder, nm) for nm in os.listdir(folder)]
+	with scandir(folder) as entries:
+		return list(entries)
+
+
+def _tree_entry(
+	path,  # type: _str_h
+	entry,  # os.DirEntry
+	is_dir,  # type: bool
+	with_stat=True
+):
+	if not with_stat:
+		return TreeEntry(path, entry.name, is_dir, None, None, entry.inode())
+	try:
+		st = entry.stat()
+	except OSError:
+		# a broken link
+		st = entry.stat(follow_symlinks=False)
+	mtime_ns = getattr(st, 'st_mtime_ns', None)
+	if mtime_ns is None:
+		mtime_ns = int(st.st_mtime * 1000000000)
+	return TreeEntry(path, entry.name, is_dir, st.st_size, mtime_ns, st.st_ino)
+
+
+def file_filter_match_f(
+	file_filter  # type: _t.Union[FileFilter, _str_h, _t.Iterable[_str_h], None]
+):
+	"""
+	Compile the masks of a file filter (see ``FileFilter.error_check_as_argument()``)
+	into a single function checking a file name.
+	'*' and '*.*' masks match any file. `None` is returned if the filter matches everything.
+	"""
+	import fnmatch
+	import re
+
+	masks = FileFilter.error_check_as_argument(file_filter, 'file_filter').filters
+	if not masks or any(m in ('*', '*.*') for m in masks):
+		return None
+	flags = re.IGNORECASE if _pth.normcase('A') == 'a' else 0
+	return re.compile(
+		'|'.join('(?:{})'.format(fnmatch.translate(m)) for m in masks), flags
+	).match
+
+
+def _root_tree_entry(
+	root,  # type: _str_h
+	with_stat=True
+):
+	"""
+	`TreeEntry` for the root of a walk, with the path cleaned up the same way `dir_tree_gen()` does.
+
+	:raises OSError: if the root doesn't exist.
+	"""
+	root = root[0] + root[1:].replace('\\', '/').rstrip('/')
+	st = os.stat(root)
+	mtime_ns = getattr(st, 'st_mtime_ns', None)
+	if mtime_ns is None:
+		mtime_ns = int(st.st_mtime * 1000000000)
+	return TreeEntry(
+		root, _pth.basename(root), True,
+		st.st_size if with_stat else None, mtime_ns if with_stat else None, st.st_ino
+	)
+
+
+def _list_tree_folder(
+	folder,  # type: _str_h
+	match_f=None,  # type: _t.Optional[_t.Callable[[_str_h], _t.Any]]
+	prune_f=None,  # type: _t.Optional[_t.Callable[[TreeEntry], bool]]
+	followlinks=False,
+	with_stat=True
+):
+	"""
+	A single step of the tree walk: list the folder with one `scandir()`.
+
+	:return: the matching files and the sub-folders to enter, both as lists of `TreeEntry`.
+	:raises OSError: if the folder can't be listed.
+	"""
+	trailed = folder + '/' if folder != '/' else folder
+	files = list()  # type: _t.List[TreeEntry]
+	sub_dirs = list()  # type: _t.List[TreeEntry]
+	for entry in _scandir(folder):
+		try:
+			is_dir = entry.is_dir()
+		except OSError:
+			is_dir = False
+		path = trailed + entry.name
+		if is_dir:
+			if not followlinks and entry.is_symlink():
+				continue
+			tree_entry = _tree_entry(path, entry, True, with_stat)
+			if prune_f is None or not prune_f(tree_entry):
+				sub_dirs.append(tree_entry)
+			continue
+		if match_f is None or match_f(entry.name):
+			files.append(_tree_entry(path, entry, False, with_stat))
+	return files, sub_dirs
+
+
+def scan_tree(
+	root,  # type: _str_h
+	file_filter=None,  # type: _t.Union[FileFilter, _str_h, _t.Iterable[_str_h], None]
+	prune_f=None,  # type: _t.Optional[_t.Callable[[TreeEntry], bool]]
+	onerror=None,  # type: _t.Optional[_t.Callable[[OSError], _t.Any]]
+	followlinks=False,
+	with_stat=True
+):
+	"""
+	A faster alternative to `dir_tree_gen()`, built on `os.scandir()`.
+	Instead of bare path strings, it yields `TreeEntry` items with the data
+	`scandir()` already has, so there's no need for any extra `isdir()`/`getsize()` calls.
+
+	The order is the same as `dir_tree_gen()` with `topdown=True`:
+	each folder, then it's files, then it's sub-folders (recursively).
+	Paths use unix-style slashes and have no trailing one.
+
+	:param file_filter:
+		Only the files matching it are yielded (folders are always walked).
+		Anything accepted by ``FileFilter.error_check_as_argument()``.
+	:param prune_f:
+		Called for each sub-folder. If it returns `True`, the folder is neither yielded nor entered.
+	:param onerror:
+		The same as in `os.walk()`: called with the `OSError` if a folder can't be listed.
+	:param followlinks:
+		Enter the symlinked folders. If disabled, they're skipped, like in `os.walk()`.
+	:param with_stat:
+		If disabled, `size` and `mtime_ns` are `None`, to save a `stat()` call
+		per entry on the systems where `scandir()` doesn't provide them for free
+		(everywhere but Windows).
+	"""
+	if not (root and isinstance(root, _str_t)):
+		return
+	match_f = file_filter_match_f(file_filter)
+	try:
+		root_entry = _root_tree_entry(root, with_stat)
+	except OSError as e:
+		if onerror is not None:
+			onerror(e)
+		return
+
+	# folders to walk, in reversed order:
+	stack = [root_entry]  # type: _t.List[TreeEntry]
+	while stack:
+		folder_entry = stack.pop()
+		try:
+			files, sub_dirs = _list_tree_folder(
+				folder_entry.path, match_f, prune_f, followlinks, with_stat
+			)
+		except OSError as e:
+			if onerror is not None:
+				onerror(e)
+			continue
+		yield folder_entry
+		for file_entry in files:
+			yield file_entry
+		stack.extend(reversed(sub_dirs))
+
+
+class _TreeWalkNode(object):
+	"""A folder in the concurrent walk: it's listing is set by a worker thread."""
+	__slots__ = ('entry', 'files', 'sub_nodes', 'error', 'failure', 'submitted', 'done')
+
+	def __init__(
+		self,
+		entry  # type: TreeEntry
+	):
+		super(_TreeWalkNode, self).__init__()
+		self.entry = entry
+		self.files = None  # type: _t.Optional[_t.List[TreeEntry]]
+		self.sub_nodes = None  # type: _t.Optional[_t.List[_TreeWalkNode]]
+		self.error = None  # type: _t.Optional[OSError]
+		# any other exception (from `prune_f` or a filter), re-raised in the consumer:
+		self.failure = None  # type: _t.Optional[BaseException]
+		self.submitted = False
+		self.done = threading.Event()
+
+
+class _DaemonThreads(object):
+	"""
+	A minimal pool of daemon threads, running the submitted calls.
+	Unlike `ThreadPool`, it's stopped instantly: in py2, `ThreadPool.terminate()` alone
+	takes ~0.1 s (it's handler threads are polling), which is more than a whole walk of a small tree.
+	The calls are expected to handle their own exceptions.
+	"""
+	def __init__(
+		self,
+		workers  # type: int
+	):
+		super(_DaemonThreads, self).__init__()
+		try:
+			from queue import Queue
+		except ImportError:
+			from Queue import Queue
+		self.__queue = Queue()
+		self.__stopped = False
+		self.__threads = [threading.Thread(target=self.__run) for _ in range(max(1, workers))]
+		for thread in self.__threads:
+			thread.daemon = True
+			thread.start()
+
+	def __run(self):
+		get = self.__queue.get
+		while True:
+			item = get()
+			if item is None or self.__stopped:
+				return
+			f, args = item
+			f(*args)
+
+	def submit(self, f, *args):
+		if not self.__stopped:
+			self.__queue.put((f, args))
+
+	def stop(self):
+		"""Drop all the pending calls. The running ones aren't waited for."""
+		self.__stopped = True
+		for _ in self.__threads:
+			self.__queue.put(None)
+
+
+def scan_tree_concurrent(
+	root,  # type: _str_h
+	file_filter=None,  # type: _t.Union[FileFilter, _str_h, _t.Iterable[_str_h], None]
+	prune_f=None,  # type: _t.Optional[_t.Callable[[TreeEntry], bool]]
+	onerror=None,  # type: _t.Optional[_t.Callable[[OSError], _t.Any]]
+	followlinks=False,
+	with_stat=True,
+	workers=8,  # type: int
+	ordered=True,
+	max_ahead=1024  # type: int
+):
+	"""
+	`scan_tree()` which lists many folders at once, with a pool of `workers` threads.
+	It's meant for network shares, where each listing is a round trip
+	and a serial walk leaves the link idle most of the time.
+
+	As soon as a folder is listed, all it's sub-folders are queued for listing,
+	regardless of how far the caller is with consuming the results.
+
+	:param ordered:
+		* `True`: the same (deterministic) order as `scan_tree()`/`dir_tree_gen()`.
+		*
+			`False`: each folder (followed by it's files) is yielded as soon as it's listed.
+			It's the fastest, but the order is arbitrary.
+	:param prune_f:
+		The same as in `scan_tree()`, but it's called from worker threads.
+		If it raises, the exception is re-raised to the caller.
+	:param max_ahead:
+		Ordered mode only: the max number of folders queued or listed, but not consumed yet.
+		When it's reached, the listing waits for the caller, so a slow consumer doesn't make the
+		whole tree pile up in memory.
+
+	For all the other arguments, see `scan_tree()`.
+	"""
+	try:
+		from queue import Queue
+	except ImportError:
+		from Queue import Queue
+
+	if not (root and isinstance(root, _str_t)):
+		return
+	match_f = file_filter_match_f(file_filter)
+	try:
+		root_node = _TreeWalkNode(_root_tree_entry(root, with_stat))
+	except OSError as e:
+		if onerror is not None:
+			onerror(e)
+		return
+
+	pool = _DaemonThreads(workers)
+	listed = Queue()  # type: Queue  # unordered mode only
+	stopped = list()  # type: list  # non-empty when the walk is closed early
+	ahead_lock = threading.Lock()
+	ahead = [0]  # ordered mode: submitted, but not consumed yet
+	max_ahead = max(1, max_ahead)
+
+	def list_node(
+		node  # type: _TreeWalkNode
+	):
+		try:
+			node.files, sub_dirs = _list_tree_folder(
+				node.entry.path, match_f, prune_f, followlinks, with_stat
+			)
+			node.sub_nodes = [_TreeWalkNode(d) for d in sub_dirs]
+		except OSError as e:
+			node.error = e
+			node.files, node.sub_nodes = [], []
+		except BaseException as e:
+			node.failure = e
+			node.files, node.sub_nodes = [], []
+		node.done.set()
+		if not ordered:
+			# before the sub-folders are submitted, so the consumer counts them before they're listed:
+			listed.put(node)
+			for sub_node in node.sub_nodes:
+				submit(sub_node)
+			return
+		for sub_node in node.sub_nodes:
+			if not submit_ahead(sub_node):
+				# the rest is submitted by the consumer, when it gets to them
+				break
+
+	def submit(
+		node  # type: _TreeWalkNode
+	):
+		if stopped:
+			return
+		node.submitted = True
+		pool.submit(list_node, node)
+
+	def submit_ahead(
+		node  # type: _TreeWalkNode
+	):
+		with ahead_lock:
+			if node.submitted:
+				return True
+			if ahead[0] >= max_ahead:
+				return False
+			ahead[0] += 1
+			submit(node)
+		return True
+
+	def node_entries(
+		node  # type: _TreeWalkNode
+	):
+		if node.failure is not None:
+			raise node.failure
+		if node.error is not None:
+			if onerror is not None:
+				onerror(node.error)
+			return
+		yield node.entry
+		for file_entry in node.files:
+			yield file_entry
+
+	try:
+		if ordered:
+			stack = [root_node]  # type: _t.List[_TreeWalkNode]
+			while stack:
+				node = stack.pop()
+				with ahead_lock:
+					if not node.submitted:
+						# deferred by the limit: this one is needed right now
+						ahead[0] += 1
+						submit(node)
+				node.done.wait()
+				with ahead_lock:
+					ahead[0] -= 1
+				stack.extend(reversed(node.sub_nodes))
+				# prefetch the folders needed next, deferred by the limit:
+				for next_node in reversed(stack):
+					if next_node.submitted or not submit_ahead(next_node):
+						break
+				for tree_entry in node_entries(node):
+					yield tree_entry
+		else:
+			submit(root_node)
+			pending = 1
+			while pending:
+				node = listed.get()
+				pending += len(node.sub_nodes) - 1
+				for tree_entry in node_entries(node):
+					yield tree_entry
+	finally:
+		stopped.append(True)
+		pool.stop()
@@ -0,0 +1,167 @@
+"""
+Performance measurements for the directory walkers in `drl_common.filesystem`.
+
+Launch it as a script to print the results:
+	python filesystem_bench.py
+
+A synthetic tree is created in a temp folder. To emulate a network share
+on a local disk, each folder listing is delayed by `--latency` seconds:
+	python filesystem_bench.py --latency 0.005 --workers 1 4 16
+"""
+
+__author__ = 'Lex Darlog (DRL)'
+
+try:
+	# support type hints in Python 3:
+	from typing import *
+except ImportError:
+	pass
+
+import os as _os
+import shutil as _shutil
+import tempfile as _tempfile
+import time as _time
+import timeit as _timeit
+from contextlib import contextmanager as _contextmanager
+
+from drl_py23 import (
+	xrange as _xrange,
+)
+
+from drl_common import filesystem as _fs
+
+
+def make_tree(
+	folder,  # type: str
+	depth=3,
+	fanout=5,
+	files=10
+):
+	"""
+	Create a tree of `fanout` sub-folders on each of `depth` levels, each folder with `files` empty files.
+
+	:return: the number of created folders (including the root).
+	"""
+	num = 1
+	if not _os.path.isdir(folder):
+		_os.makedirs(folder)
+	for i in _xrange(files):
+		open(_os.path.join(folder, 'file_{0:03d}.txt'.format(i)), 'w').close()
+	if depth > 0:
+		for i in _xrange(fanout):
+			num += make_tree(_os.path.join(folder, 'dir_{0:03d}'.format(i)), depth - 1, fanout, files)
+	return num
+
+
+@_contextmanager
+def injected_latency(
+	seconds  # type: float
+):
+	"""
+	Delay each folder listing made by `drl_common.filesystem` walkers, like a network round trip does.
+	`time.sleep()` releases the GIL, so the concurrent listings overlap the same way they would on a share.
+	"""
+	orig_scandir = _fs._scandir
+
+	def slow_scandir(folder):
+		_time.sleep(seconds)
+		return orig_scandir(folder)
+
+	_fs._scandir = slow_scandir
+	try:
+		yield
+	finally:
+		_fs._scandir = orig_scandir
+
+
+def _best_time(
+	f,  # type: Callable[[], Any]
+	repeat=3
+):
+	return min(_timeit.repeat(f, number=1, repeat=repeat))
+
+
+def bench_walkers(
+	root,  # type: str
+	latency=0.0,  # type: float
+	workers=(1, 4, 16),  # type: Iterable[int]
+	repeat=3
+):
+	"""
+	Time of a full walk (in seconds) by each walker, with the given latency of each listing.
+
+	:return: list of (name, time) pairs.
+	"""
+	def walk_f(gen_f):
+		return lambda: sum(1 for _ in gen_f())
+
+	def dir_tree_gen_stat():
+		# the way its results are usually consumed:
+		for path in _fs.dir_tree_gen(root):
+			yield path, _os.path.isdir(path), _os.path.getsize(path), _os.path.getmtime(path)
+
+	walkers = [
+		('dir_tree_gen + isdir/getsize/getmtime', walk_f(dir_tree_gen_stat)),
+		('dir_tree_gen (paths only)', walk_f(lambda: _fs.dir_tree_gen(root))),
+		('scan_tree', walk_f(lambda: _fs.scan_tree(root))),
+		('scan_tree (with_stat=False)', walk_f(lambda: _fs.scan_tree(root, with_stat=False))),
+	]
+	for n in workers:
+		walkers.append((
+			'scan_tree_concurrent ({0} workers, ordered)'.format(n),
+			walk_f(lambda n=n: _fs.scan_tree_concurrent(root, workers=n)),
+		))
+		walkers.append((
+			'scan_tree_concurrent ({0} workers, unordered)'.format(n),
+			walk_f(lambda n=n: _fs.scan_tree_concurrent(root, workers=n, ordered=False)),
+		))
+
+	res = list()  # type: List[Tuple[str, float]]
+	with injected_latency(latency):
+		for name, f in walkers:
+			if latency and name.startswith('dir_tree_gen'):
+				# it uses os.walk(), which isn't affected by the injected latency
+				continue
+			res.append((name, _best_time(f, repeat)))
+	return res
+
+
+def _print_results(
+	title,  # type: str
+	results  # type: List[Tuple[str, float]]
+):
+	print(title)
+	base = results[0][1] if results else 0.0
+	for name, t in results:
+		print('\t{0}: {1:.4f} s ({2:.1f}x)'.format(name, t, base / t if t else 0.0))
+
+
+if __name__ == '__main__':
+	import argparse
+
+	arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+	arg_parser.add_argument('--depth', type=int, default=3, help='Levels of sub-folders.')
+	arg_parser.add_argument('--fanout', type=int, default=5, help='Sub-folders in each folder.')
+	arg_parser.add_argument('--files', type=int, default=10, help='Files in each folder.')
+	arg_parser.add_argument(
+		'--latency', type=float, default=0.005,
+		help='Seconds each folder listing is delayed by, in the latency test. Default: 0.005.'
+	)
+	arg_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+	arg_parser.add_argument('--repeat', type=int, default=3, help='Take the best of N runs.')
+	args = arg_parser.parse_args()
+
+	temp_dir = _tempfile.mkdtemp(prefix='filesystem_bench_')
+	try:
+		tree_root = _os.path.join(temp_dir, 'tree')
+		num_folders = make_tree(tree_root, args.depth, args.fanout, args.files)
+		print('Tree: {0} folders, {1} files\n'.format(num_folders, num_folders * args.files))
+		_print_results('Local disk:', bench_walkers(tree_root, 0.0, args.workers, args.repeat))
+		if args.latency:
+			print('')
+			_print_results(
+				'Latency of {0} ms per listing:'.format(args.latency * 1000),
+				bench_walkers(tree_root, args.latency, args.workers, args.repeat)
+			)
+	finally:
+		_shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,69 @@
+"""
+Regression tests for `asm2hlsl`:
+	python -m pytest tests
+"""
+
+__author__ = 'Lex Darlog (DRL)'
+
+import pytest
+
+import asm2hlsl as _a2h
+
+
+def _code_lines(
+	code,  # type: str
+	ext='.ps'
+):
+	parsed = list(_a2h._lex_text(code))
+	code_r = _a2h._detect_shader_ranges(parsed, ext)[0][1]
+	return code_r.type, parsed[code_r.first_line:code_r.last_line + 1]
+
+
+def _instructions(lines):
+	return {
+		' '.join(filter(None, (op, ', '.join(args or ())))) for op, args, comment in lines if op
+	}
+
+
+# (shader code, instructions which must survive `optimize_block()`):
+_optimizer_regressions = {
+	'write read by a subroutine': (
+		'''
+		ps_3_0
+		mov r0, c0
+		call l0
+		mov oC0, r0
+		ret
+		label l0
+		mov r0, c1
+		ret
+		''',
+		('mov r0, c0', 'mov r0, c1'),
+	),
+	'predicate read by a predicated instruction': (
+		'''
+		ps_3_0
+		setp_gt p0, r2, c1
+		mov r0, c0
+		(p0) mov r0, r1
+		mov oC0, r0
+		''',
+		('setp_gt p0, r2, c1', 'mov r0, c0', '(p0) mov r0, r1'),
+	),
+}
+
+
+@pytest.mark.parametrize('name', sorted(_optimizer_regressions))
+def test_optimizer_keeps_used_writes(name):
+	code, required = _optimizer_regressions[name]
+	shader_type, code_lines = _code_lines(code)
+	lines, before, after = _a2h.optimize_block(shader_type, code_lines)
+	kept = _instructions(lines)
+	assert [instr for instr in required if instr not in kept] == []
+
+
+def test_dataflow_reads_predicate():
+	shader_type, code_lines = _code_lines(_optimizer_regressions['predicate read by a predicated instruction'][0])
+	flow = _a2h.RegisterDataflow(shader_type, code_lines)
+	# all the writes are live: the predicated 'mov' doesn't kill the previous value of r0
+	assert all(last > line for line, last in zip(flow.def_line, flow.def_last))